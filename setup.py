@@ -11,6 +11,7 @@ PACKAGE_VERSION = '0.4.0a1'
 
 INSTALL_REQUIRES = [
     'coloredlogs',
+    'futures; python_version < "3"',
     'ipython',
     'jsondiff',
     'pygments',
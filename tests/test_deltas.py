@@ -0,0 +1,53 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+import trellosa.deltas as deltas
+
+
+class TestDeltas(unittest.TestCase):
+
+    a = {
+        "cards": {"c1": {"name": "One", "labels": ["x"]}, "c2": {"name": "Two"}, "c3": {"name": "Three"}},
+        "meta": {"snapshot_time": 1, "missing": ["bugs"]},
+        "lists": {"l1": {"name": "List"}}
+    }
+    b = {
+        "cards": {"c1": {"name": "One", "labels": ["x", "y"]}, "c3": {"name": "Three"}, "c4": {"name": "Four"}},
+        "meta": {"snapshot_time": 2},
+        "bugs": {"1": {"id": 1}}
+    }
+
+    def test_round_trip(self):
+        self.assertEqual(deltas.apply_delta(self.a, deltas.make_delta(self.a, self.b)), self.b)
+        self.assertEqual(deltas.apply_delta(self.b, deltas.make_delta(self.b, self.a)), self.a)
+
+    def test_deleted_keys(self):
+        delta = deltas.make_delta(self.a, self.b)
+        self.assertEqual(delta["unset"], ["lists"])
+        self.assertEqual(delta["patch"]["cards"]["unset"], ["c2"])
+        self.assertEqual(delta["patch"]["meta"]["unset"], ["missing"])
+
+    def test_unchanged(self):
+        self.assertEqual(deltas.make_delta(self.a, deltas.copy_data(self.a)), {})
+        self.assertEqual(deltas.delta_size({}), 0)
+
+    def test_lists_are_replaced(self):
+        delta = deltas.make_delta(self.a, self.b)
+        self.assertEqual(delta["patch"]["cards"]["patch"]["c1"], {"set": {"labels": ["x", "y"]}})
+        self.assertEqual(deltas.delta_size(delta), 7)
+
+    def test_apply_does_not_modify(self):
+        a = deltas.copy_data(self.a)
+        deltas.apply_delta(a, deltas.make_delta(a, self.b))
+        self.assertEqual(a, self.a)
+
+    def test_copy_data(self):
+        copy = deltas.copy_data(self.a)
+        self.assertEqual(copy, self.a)
+        copy["cards"]["c1"]["labels"].append("z")
+        self.assertEqual(self.a["cards"]["c1"]["labels"], ["x"])
@@ -0,0 +1,55 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import unittest
+
+import trellosa.jsonstream as jsonstream
+
+
+ITEMS = [
+    {"id": 1, "summary": u"Crash in élève ☃", "flags": [True, False, None]},
+    {"id": 22, "summary": "Quotes \" and backslashes \\ and \\\" combined", "score": -12.5e3},
+    {"id": 333, "summary": "Brackets ] } [ { and commas , inside strings", "nested": {"a": [1, [2, [3]]]}},
+    {"id": 4444, "summary": u"Escapes \n\t\u0041 / \x00", "empty": {}, "none": []},
+    12345678901234567890,
+    "plain string"
+]
+
+
+def chunked(data, size):
+    return [data[start:start + size] for start in xrange(0, len(data), size)]
+
+
+class TestArrayStream(unittest.TestCase):
+
+    def test_split_at_every_boundary(self):
+        document = json.dumps(ITEMS, ensure_ascii=False).encode("utf-8")
+        for position in xrange(len(document) + 1):
+            chunks = [document[:position], document[position:]]
+            self.assertEqual(list(jsonstream.iter_items(chunks)), ITEMS, "split at %d" % position)
+
+    def test_single_byte_chunks(self):
+        document = json.dumps(ITEMS, ensure_ascii=False, indent=2).encode("utf-8")
+        self.assertEqual(list(jsonstream.iter_items(chunked(document, 1))), ITEMS)
+
+    def test_key_in_object(self):
+        document = json.dumps({"faults": ["a", {"b": "]"}], "bugs": ITEMS, "after": 1}).encode("utf-8")
+        for size in [1, 2, 3, 7, 64]:
+            self.assertEqual(list(jsonstream.iter_items(chunked(document, size), key="bugs")), ITEMS)
+
+    def test_empty_array(self):
+        self.assertEqual(list(jsonstream.iter_items([" [", " ] "])), [])
+        self.assertEqual(list(jsonstream.iter_items(['{"bugs": [', "]}"], key="bugs")), [])
+
+    def test_missing_key(self):
+        with self.assertRaises(ValueError):
+            list(jsonstream.iter_items(['{"faults": []}'], key="bugs"))
+
+    def test_truncated_document(self):
+        document = json.dumps(ITEMS)
+        with self.assertRaises(ValueError):
+            list(jsonstream.iter_items(chunked(document[:-10], 16)))
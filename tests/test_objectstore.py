@@ -0,0 +1,108 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import shutil
+import tempfile
+import threading
+import unittest
+
+import trellosa.deltas as deltas
+import trellosa.objectstore as objectstore
+
+
+class TestObjectStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = objectstore.ObjectStore(self.tmp_dir)
+        self.data = {
+            "firefox_trello": {"cards": {"c1": {"name": "One"}, "c2": {"name": "Two"}}, "meta": {"time": 1}},
+            "bugzilla": {"bugs": {"1": {"id": 1}}, "meta": {"time": 1}}
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        root = objectstore.store_snapshot(self.store, self.data)
+        self.assertEqual(objectstore.load_snapshot(self.store, root), self.data)
+
+    def test_streamed_collections(self):
+        data = deltas.copy_data(self.data)
+        data["firefox_trello"]["cards"] = (item for item in self.data["firefox_trello"]["cards"].items())
+        root = objectstore.store_snapshot(self.store, data)
+        self.assertEqual(objectstore.load_snapshot(self.store, root), self.data)
+
+    def test_unchanged_objects_are_stored_once(self):
+        objectstore.store_snapshot(self.store, self.data)
+        count = len(list(self.store.hashes()))
+        changed = deltas.copy_data(self.data)
+        changed["firefox_trello"]["cards"]["c2"]["name"] = "Changed"
+        objectstore.store_snapshot(self.store, changed)
+        self.assertEqual(len(list(self.store.hashes())), count + 1)
+
+    def test_remove_unreferenced(self):
+        first = objectstore.store_snapshot(self.store, self.data)
+        changed = deltas.copy_data(self.data)
+        changed["bugzilla"]["bugs"]["2"] = {"id": 2}
+        del changed["firefox_trello"]["cards"]["c1"]
+        second = objectstore.store_snapshot(self.store, changed)
+        self.assertEqual(self.store.remove_unreferenced(objectstore.references(second)), 1)
+        self.assertEqual(objectstore.load_snapshot(self.store, second), changed)
+        with self.assertRaises(Exception):
+            objectstore.load_snapshot(self.store, first)
+
+    def test_manifest_diff(self):
+        first = objectstore.store_snapshot(self.store, self.data)
+        changed = deltas.copy_data(self.data)
+        changed["firefox_trello"]["cards"]["c3"] = {"name": "Three"}
+        second = objectstore.store_snapshot(self.store, changed)
+        manifest = objectstore.make_manifest(second, "base", first, 1)
+        objectstore.check_manifest(manifest)
+        self.assertNotIn("root", manifest)
+        self.assertEqual(deltas.apply_delta(first, manifest["diff"]), second)
+
+    def test_deferred_items_come_last(self):
+        consumed = []
+
+        def cards():
+            for key in ["c1", "c2"]:
+                consumed.append(key)
+                yield key, {}
+
+        def referenced():
+            return {"consumed": list(consumed)}
+
+        data = {"a": {"late": objectstore.Deferred(referenced), "z": 1}, "b": {"cards": cards()}}
+        items = list(objectstore.ordered_items(data, 1))
+        self.assertEqual([key for key, _ in items], ["b", "a"])
+        dict(items[0][1]["cards"])
+        late = list(objectstore.ordered_items(items[1][1], 0))
+        self.assertEqual(late, [("z", 1), ("late", {"consumed": ["c1", "c2"]})])
+
+    def test_concurrent_reads(self):
+        cards = dict([("c%d" % x, {"name": "Card %d" % x * (x % 7 + 1)}) for x in range(200)])
+        objectstore.store_snapshot(self.store, {"firefox_trello": {"cards": cards}})
+        hashes = list(self.store.hashes())
+        expected = dict([(object_hash, self.store.get(object_hash)) for object_hash in hashes])
+        store = objectstore.ObjectStore(self.tmp_dir)
+        errors = []
+
+        def read():
+            try:
+                for _ in range(5):
+                    for object_hash in hashes:
+                        if store.get(object_hash) != expected[object_hash]:
+                            errors.append(object_hash)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
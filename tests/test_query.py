@@ -0,0 +1,84 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import shutil
+import tempfile
+import unittest
+
+from trellosa.command.query import QueryMode
+import trellosa.deltas as deltas
+import trellosa.snapshots as snapshots
+
+
+SNAPSHOT = {
+    "firefox_trello": {"cards": {"c1": {"name": "One"}, "c12": {"name": "Twelve"}}, "meta": {"time": 1}},
+    "bugzilla": {"bugs": {"1": {"id": 1}}, "meta": {"time": 1}}
+}
+
+
+class TestQueryMode(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.args = argparse.Namespace(command="query", workdir=self.tmp_dir, snapshot="1", id="c1")
+        self.printed = []
+        self.loads = []
+        self.patched = {}
+        self.patch(snapshots, "json_highlight_print", self.printed.append)
+        self.patch(snapshots, "fetch_online", lambda args, **kwargs: deltas.copy_data(SNAPSHOT))
+        load = snapshots.SnapshotDB.load
+
+        def counting_load(snapshot_db, handle, sections=None, ids=None):
+            self.loads.append(ids)
+            return load(snapshot_db, handle, sections, ids)
+
+        self.patch(snapshots.SnapshotDB, "load", counting_load)
+
+    def tearDown(self):
+        for (obj, name), value in self.patched.iteritems():
+            setattr(obj, name, value)
+        shutil.rmtree(self.tmp_dir)
+
+    def patch(self, obj, name, value):
+        self.patched[(obj, name)] = vars(obj)[name]
+        setattr(obj, name, value)
+
+    def save(self, storage):
+        snapshot_db = snapshots.SnapshotDB(self.args)
+        snapshot_db.save("2026-01-01Z00-00-00", deltas.copy_data(SNAPSHOT), storage=storage)
+
+    def run_query(self):
+        return QueryMode(self.args, self.tmp_dir).run()
+
+    def test_online(self):
+        self.args.snapshot = "0"
+        self.assertEqual(self.run_query(), 0)
+        self.assertEqual(self.printed, [{"firefox_trello": {"cards": {"c1": {"name": "One"}}}}])
+
+    def test_indexed_exact_match(self):
+        self.save("indexed")
+        self.assertEqual(self.run_query(), 0)
+        self.assertEqual(self.loads, [["c1"]])
+        self.assertEqual(self.printed, [{"firefox_trello": {"cards": {"c1": {"name": "One"}}}}])
+
+    def test_indexed_partial_match(self):
+        self.save("indexed")
+        self.args.id = "c"
+        self.assertEqual(self.run_query(), 0)
+        self.assertEqual(self.loads, [["c"], None])
+        self.assertEqual(self.printed, [{"firefox_trello": {"cards": SNAPSHOT["firefox_trello"]["cards"]}}])
+
+    def test_blob_is_loaded_once(self):
+        self.save("blob")
+        self.args.id = "c"
+        self.assertEqual(self.run_query(), 0)
+        self.assertEqual(self.loads, [None])
+        self.assertEqual(self.printed, [{"firefox_trello": {"cards": SNAPSHOT["firefox_trello"]["cards"]}}])
+
+
+if __name__ == "__main__":
+    unittest.main()
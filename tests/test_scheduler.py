@@ -0,0 +1,71 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+import trellosa.scheduler as scheduler
+
+
+class FakeClock(object):
+    """
+    Stands in for the time module, sleeping advances the clock
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.time = scheduler.time
+        self.clock = FakeClock()
+        scheduler.time = self.clock
+
+    def tearDown(self):
+        scheduler.time = self.time
+
+    def test_burst(self):
+        bucket = scheduler.TokenBucket(rate=10, burst=3)
+        self.assertEqual([bucket.acquire() for _ in xrange(3)], [0.0, 0.0, 0.0])
+        self.assertAlmostEqual(bucket.acquire(), 0.1)
+
+    def test_refill(self):
+        bucket = scheduler.TokenBucket(rate=10, burst=3)
+        for _ in xrange(3):
+            bucket.acquire()
+        self.clock.now += 0.2
+        self.assertEqual([bucket.acquire() for _ in xrange(2)], [0.0, 0.0])
+        self.assertAlmostEqual(bucket.acquire(), 0.1)
+
+    def test_refill_is_capped_at_burst(self):
+        bucket = scheduler.TokenBucket(rate=10, burst=3)
+        for _ in xrange(3):
+            bucket.acquire()
+        self.clock.now += 60
+        self.assertEqual([bucket.acquire() for _ in xrange(3)], [0.0, 0.0, 0.0])
+        self.assertAlmostEqual(bucket.acquire(), 0.1)
+
+    def test_pause(self):
+        bucket = scheduler.TokenBucket(rate=10, burst=3)
+        bucket.pause(5)
+        self.assertAlmostEqual(bucket.acquire(), 5.0)
+        self.assertEqual(bucket.acquire(), 0.0)
+
+    def test_set_rate(self):
+        bucket = scheduler.TokenBucket(rate=10, burst=3)
+        for _ in xrange(3):
+            bucket.acquire()
+        bucket.set_rate(1, burst=1)
+        self.assertAlmostEqual(bucket.acquire(), 1.0)
@@ -0,0 +1,72 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import trellosa.compression as compression
+import trellosa.sectionfile as sectionfile
+
+
+class TestSectionFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.tmp_dir, "snapshot.sections.gz")
+        self.data = {
+            "firefox_trello": {
+                "cards": dict([("c%04d" % number, {"id": "c%04d" % number, "name": "Card " * 20})
+                               for number in xrange(0, 1000, 3)]),
+                "meta": {"snapshot_time": 1.0},
+                "labels": {}
+            },
+            "bugzilla": {
+                "bugs": dict([(str(number), {"id": number}) for number in xrange(100, 200)]),
+                "meta": {"versions": [1, 2]}
+            }
+        }
+        # Small blocks, so collections span many of them
+        self.block_size = sectionfile.BLOCK_SIZE
+        sectionfile.BLOCK_SIZE = 1024
+        with open(self.file_name, "wb") as f:
+            sectionfile.SectionWriter(f, compression.get_codec("gzip")).write(self.data)
+
+    def tearDown(self):
+        sectionfile.BLOCK_SIZE = self.block_size
+        shutil.rmtree(self.tmp_dir)
+
+    def test_load_all(self):
+        with sectionfile.SectionReader(self.file_name) as reader:
+            self.assertEqual(reader.load(), self.data)
+
+    def test_ids_across_block_boundaries(self):
+        with sectionfile.SectionReader(self.file_name) as reader:
+            blocks = reader.index["root"]["sections"]["firefox_trello"]["sections"]["cards"]["collection"]
+            self.assertGreater(len(blocks), 10)
+            cards = self.data["firefox_trello"]["cards"]
+            for card_id in sorted(cards.keys()):
+                result = reader.load(sections=["firefox_trello.cards"], ids=[card_id])
+                self.assertEqual(result, {"firefox_trello": {"cards": {card_id: cards[card_id]}}})
+            # First IDs of blocks, and IDs before, between and after the stored ones
+            first_ids = [block[0] for block in blocks]
+            result = reader.load(sections=["firefox_trello.cards"], ids=first_ids + ["a", "c0001", "c9999"])
+            self.assertEqual(sorted(result["firefox_trello"]["cards"].keys()), sorted(first_ids))
+
+    def test_ids_in_all_sections(self):
+        with sectionfile.SectionReader(self.file_name) as reader:
+            result = reader.load(ids=["c0999", "150"])
+        self.assertEqual(result["firefox_trello"]["cards"].keys(), ["c0999"])
+        self.assertEqual(result["bugzilla"]["bugs"].keys(), ["150"])
+        self.assertEqual(result["bugzilla"]["meta"], self.data["bugzilla"]["meta"])
+        self.assertEqual(result["firefox_trello"]["labels"], {})
+
+    def test_sections(self):
+        with sectionfile.SectionReader(self.file_name) as reader:
+            result = reader.load(sections=["firefox_trello.meta", "bugzilla", "missing", "bugzilla.missing"])
+        self.assertEqual(result, {"firefox_trello": {"meta": {"snapshot_time": 1.0}},
+                                  "bugzilla": self.data["bugzilla"]})
@@ -0,0 +1,181 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Non-blocking API clients. This package targets Python 2, which has no asyncio,
+# so the asynchronous layer is built on futures running on a bounded thread pool.
+
+from concurrent.futures import ALL_COMPLETED, FIRST_EXCEPTION, ThreadPoolExecutor, TimeoutError, wait
+import logging
+import threading
+
+from trellosa.bugzilla import BugzillaClient
+from trellosa.trello import FirefoxTrello, TrelloClient
+
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher(object):
+    """
+    Runs API calls on a bounded pool of workers and keeps track of their
+    futures, so outstanding calls can be cancelled as a whole. Must be shut
+    down after use, preferably by using it as context manager.
+    """
+
+    def __init__(self, max_workers=4, timeout=None):
+        """
+        :param max_workers: int maximum number of concurrent calls
+        :param timeout: float default seconds to wait in gather() or None
+        """
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.futures = set()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.cancel_all()
+        self.shutdown()
+
+    def submit(self, call, *args, **kwargs):
+        """
+        Schedule a call
+        :return: concurrent.futures.Future
+        """
+        future = self.executor.submit(call, *args, **kwargs)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self.__forget)
+        return future
+
+    def __forget(self, future):
+        with self.lock:
+            self.futures.discard(future)
+
+    def cancel_all(self):
+        """
+        Cancel all calls that have not started yet. Calls that are already
+        running can not be interrupted and run to completion.
+        :return: int number of cancelled calls
+        """
+        with self.lock:
+            futures = list(self.futures)
+        cancelled = len(filter(lambda x: x.cancel(), futures))
+        if cancelled > 0:
+            logger.debug("Cancelled %d pending API calls" % cancelled)
+        return cancelled
+
+    def gather(self, futures, timeout=None):
+        """
+        Wait for futures and return their results. If any of them fails or the
+        timeout expires, the others are cancelled and the error is raised.
+        :param futures: dict mapping names to futures
+        :param timeout: float seconds or None for the dispatcher default
+        :return: dict mapping the same names to results
+        """
+        if timeout is None:
+            timeout = self.timeout
+        done, not_done = wait(futures.values(), timeout=timeout, return_when=FIRST_EXCEPTION)
+        if len(not_done) > 0:
+            for future in not_done:
+                future.cancel()
+            for future in done:
+                if future.exception() is not None:
+                    raise future.exception()
+            raise TimeoutError("%d of %d API calls did not finish within %ss"
+                               % (len(not_done), len(futures), timeout))
+        return dict([(name, future.result()) for name, future in futures.iteritems()])
+
+    def gather_partial(self, futures, timeout=None):
+        """
+        Wait for futures and return what could be gathered. Calls that fail
+        or do not finish within the timeout are reported as errors.
+        :param futures: dict mapping names to futures
+        :param timeout: float seconds or None for the dispatcher default
+        :return: tuple of dict mapping names to results and dict mapping names to exceptions
+        """
+        if timeout is None:
+            timeout = self.timeout
+        wait(futures.values(), timeout=timeout, return_when=ALL_COMPLETED)
+        results = {}
+        errors = {}
+        for name, future in futures.iteritems():
+            if not future.done():
+                future.cancel()
+                errors[name] = TimeoutError("API call did not finish within %ss" % timeout)
+            elif future.exception() is not None:
+                errors[name] = future.exception()
+            else:
+                results[name] = future.result()
+        return results, errors
+
+    def shutdown(self, wait_for_calls=True):
+        self.executor.shutdown(wait=wait_for_calls)
+
+
+class AsyncClient(object):
+    """
+    Wraps a synchronous client. Calling any of its methods schedules the
+    call on the dispatcher and returns a future for the result.
+    """
+
+    sync_class = None
+
+    def __init__(self, *args, **kwargs):
+        """
+        Arguments are passed on to the constructor of the synchronous client,
+        except for `dispatcher` and `client`, which wraps an existing client.
+        """
+        self.dispatcher = kwargs.pop("dispatcher", None)
+        if self.dispatcher is None:
+            raise Exception("Asynchronous clients require a dispatcher")
+        client = kwargs.pop("client", None)
+        if client is None:
+            client = self.sync_class(*args, **kwargs)
+        self.sync = client
+
+    def __getattr__(self, name):
+        attribute = getattr(self.sync, name)
+        if not callable(attribute):
+            return attribute
+
+        def schedule(*args, **kwargs):
+            return self.dispatcher.submit(attribute, *args, **kwargs)
+        return schedule
+
+    def attribute(self, name):
+        """
+        Resolve a lazy property like `security_notes_id` in the background
+        :param name: str with attribute name
+        :return: concurrent.futures.Future
+        """
+        return self.dispatcher.submit(getattr, self.sync, name)
+
+    def snapshot(self, previous=None, stream=False):
+        """
+        Schedule all calls required for a snapshot
+        :param previous: dict with previous snapshot for incremental updates or None
+        :param stream: bool
+        :return: dict mapping call names to futures
+        """
+        calls = self.sync.snapshot_calls(previous, stream=stream)
+        return dict([(name, self.dispatcher.submit(call)) for name, call in calls.iteritems()])
+
+
+class AsyncTrelloClient(AsyncClient):
+    sync_class = TrelloClient
+
+
+class AsyncFirefoxTrello(AsyncClient):
+    sync_class = FirefoxTrello
+
+
+class AsyncBugzillaClient(AsyncClient):
+    sync_class = BugzillaClient
@@ -4,12 +4,21 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import datetime
+import json
 import logging
 import requests
+import urllib
 from requests.exceptions import HTTPError
 import time
 import re
 
+import trellosa.cache as cache
+import trellosa.jsonstream as jsonstream
+import trellosa.parallel as parallel
+import trellosa.profiles as profiles
+import trellosa.scheduler as scheduler
+import trellosa.session as session
 from trellosa.trello import parse_firefox_version
 
 
@@ -20,17 +29,57 @@ def generate_token_url():
     return "https://bugzilla.mozilla.org/userprefs.cgi?tab=apikey"
 
 
+def bugzilla_time(timestamp):
+    """
+    Convert epoch timestamp to the date format used by the Bugzilla API
+    :param timestamp: float
+    :return: str
+    """
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
 class BugzillaClient(object):
     # FIXME use production url---v
     # URL = "https://bugzilla-dev.allizom.org/rest/bug"
     API_URL = "https://bugzilla.mozilla.org/rest"
     # TODO use production url -^
 
-    def __init__(self, token=None):
+    # Bugs matching the snapshot search
+    SEARCH = {
+        "component": "Security: Review Requests",
+        "product": "Firefox"
+    }
+
+    # Stand-ins for the results of snapshot calls that failed, see assemble_snapshot()
+    EMPTY_SECTIONS = {
+        "bugs": {"bugs": {}},
+        "milestones": {"milestones": []},
+        "versions": {"versions": []}
+    }
+
+    def __init__(self, token=None, http_session=None, request_scheduler=None, profile=profiles.DEFAULT_PROFILE,
+                 metadata_cache=None, page_size=None, jobs=1, api_url=None):
         self.token = token
+        if api_url is None:
+            api_url = session.base_url("bugzilla", self.API_URL)
+        self.api_url = api_url
+        self.profile = profile
+        self.page_size = page_size
+        self.jobs = jobs
+        if http_session is None:
+            http_session = session.get_session("bugzilla")
+        self.session = http_session
+        if request_scheduler is None:
+            request_scheduler = scheduler.get_scheduler("bugzilla")
+        self.scheduler = request_scheduler
+        if metadata_cache is None:
+            metadata_cache = cache.get_metadata_cache()
+        self.metadata_cache = metadata_cache
         self.__firefox_product_id = None
-        self.__firefox_versions = None
-        self.__firefox_milestones = None
+        # Field values as tuple and as frozenset for lookups, by field name
+        self.__field_values = {}
+        self.__refreshed_fields = set()
+        self.__version_map = {}
 
     @staticmethod
     def generate_token_url():
@@ -43,27 +92,182 @@ class BugzillaClient(object):
     def set_token(self, token):
         self.token = token
 
-    def get_snapshot(self):
-        params = {
-            "include_fields": "_all", # could also be "id,summary,status,url,version,target_milestone"
-            "component": "Security: Review Requests",
-            "product": "Firefox"
+    def count_bugs(self, **search):
+        result = self.get("bug", count_only=1, **search)
+        return int(result["bug_count"])
+
+    def search_bugs(self, **search):
+        """
+        Search bugs, page by page if the client has a page size. Pages are
+        fetched in parallel and checked for completeness against the number
+        of matching bugs.
+        :param search: search parameters
+        :return: dict mapping bug IDs to bugs
+        """
+        params = dict(search)
+        params["include_fields"] = profiles.bug_fields(self.profile)
+        if self.page_size is None:
+            result = self.get("bug", **params)
+            return dict([(str(x["id"]), x) for x in result['bugs']])
+
+        for attempt in range(2):
+            total = self.count_bugs(**search)
+            calls = {}
+            for offset in xrange(0, total, self.page_size):
+                page_params = dict(params, limit=self.page_size, offset=offset, order="bug_id")
+                calls[offset] = lambda p=page_params: self.get("bug", **p)["bugs"]
+            logger.debug("Fetching %d bugs in %d pages" % (total, len(calls)))
+            pages = parallel.call_all(calls, jobs=self.jobs)
+            bugs = {}
+            for page in pages.itervalues():
+                bugs.update([(str(x["id"]), x) for x in page])
+            if len(bugs) == total:
+                return bugs
+            # Bugs that changed during the search can shift pages
+            logger.warning("Fetched %d bugs, but %d were expected" % (len(bugs), total))
+        return bugs
+
+    def iter_bugs(self, **search):
+        """
+        Search bugs and decode them while the results are still arriving.
+        Pages are fetched one after another if the client has a page size.
+        :param search: search parameters
+        :return: generator of bugs
+        """
+        params = dict(search)
+        params["include_fields"] = profiles.bug_fields(self.profile)
+        if self.page_size is None:
+            for bug in self.iter_get("bug", "bugs", **params):
+                yield bug
+            return
+
+        offset = 0
+        while True:
+            page_params = dict(params, limit=self.page_size, offset=offset, order="bug_id")
+            count = 0
+            for bug in self.iter_get("bug", "bugs", **page_params):
+                count += 1
+                yield bug
+            if count < self.page_size:
+                return
+            offset += count
+
+    def get_bugs(self):
+        return self.search_bugs(**self.SEARCH)
+
+    def get_bugs_by_id(self, bug_ids, chunk_size=200):
+        """
+        Fetch specific bugs with multi-id requests, in parallel chunks
+        :param bug_ids: iterable of bug IDs
+        :param chunk_size: int maximum number of bugs per request
+        :return: dict mapping bug IDs to bugs, missing inaccessible bugs
+        """
+        bug_ids = sorted(set(map(str, bug_ids)), key=int)
+        calls = {}
+        for start in xrange(0, len(bug_ids), chunk_size):
+            params = {
+                "id": ",".join(bug_ids[start:start + chunk_size]),
+                "include_fields": profiles.bug_fields(self.profile)
+            }
+            calls[start] = lambda p=params: self.get("bug", **p)["bugs"]
+        bugs = {}
+        for chunk in parallel.call_all(calls, jobs=self.jobs).itervalues():
+            bugs.update([(str(x["id"]), x) for x in chunk])
+        return bugs
+
+    def get_bug_ids(self, **search):
+        result = self.get("bug", include_fields="id", **search)
+        return set([str(x["id"]) for x in result["bugs"]])
+
+    def get_incremental_bugs(self, previous):
+        """
+        Update the bugs of a previous snapshot. Only bugs changed since the
+        previous snapshot are fetched again. An ID-only search drops bugs that
+        were deleted or moved out of the component.
+        :param previous: dict with previous Bugzilla snapshot
+        :return: dict mapping section names to results
+        """
+        prev_meta = previous["meta"]
+        # Overlap a little with the previous snapshot to be safe from clock skew
+        since = bugzilla_time(prev_meta["snapshot_time"] - 60)
+        calls = {
+            "changed": lambda: self.search_bugs(last_change_time=since, **self.SEARCH),
+            "ids": lambda: self.get_bug_ids(**self.SEARCH)
+        }
+        result = parallel.call_all(calls, jobs=self.jobs)
+        changed = result["changed"]
+        ids = result["ids"]
+        logger.debug("%d bugs changed since last pull" % len(changed))
+
+        bugs = dict([(bid, bug) for bid, bug in previous["bugs"].iteritems() if bid in ids])
+        bugs.update(changed)
+        missing = ids - set(bugs.keys())
+        if len(missing) > 0:
+            logger.debug("Fetching %d bugs unknown to the previous snapshot" % len(missing))
+            bugs.update(self.get_bugs_by_id(missing))
+
+        return {
+            "bugs": bugs,
+            "profile": self.profile,
+            "pull_mode": "incremental",
+            "full_snapshot_time": prev_meta.get("full_snapshot_time", prev_meta["snapshot_time"])
+        }
+
+    def snapshot_calls(self, previous=None, stream=False):
+        """
+        Independent API calls required for a snapshot, see assemble_snapshot()
+        :param previous: dict with previous snapshot for incremental pulls or None
+        :param stream: bool whether to return bugs as generator of (id, bug) pairs
+        :return: dict mapping call names to callables returning dicts of sections
+        """
+        def bugs_call():
+            if previous is not None and previous["meta"].get("profile", profiles.DEFAULT_PROFILE) == self.profile:
+                return self.get_incremental_bugs(previous)
+            elif stream:
+                return {"bugs": ((str(x["id"]), x) for x in self.iter_bugs(**self.SEARCH)), "profile": self.profile}
+            else:
+                return {"bugs": self.get_bugs(), "profile": self.profile}
+
+        return {
+            "bugs": bugs_call,
+            "milestones": lambda: {"milestones": self.firefox_milestones},
+            "versions": lambda: {"versions": self.firefox_versions}
         }
-        result = self.get("bug", **params)
 
-        bugs = dict([(str(x["id"]), x) for x in result['bugs']])
-        if len(bugs) == 0:
+    @staticmethod
+    def assemble_snapshot(sections, now, missing=None):
+        """
+        Build snapshot from the merged results of snapshot_calls()
+        :param sections: dict mapping section names to call results
+        :param now: float with snapshot time
+        :param missing: list of section names that could not be fetched and are empty, see EMPTY_SECTIONS
+        :return: dict with snapshot
+        """
+        if missing is None:
+            missing = []
+        bugs = sections["bugs"]
+        if isinstance(bugs, dict) and len(bugs) == 0 and "bugs" not in missing:
             raise HTTPError("Could not find any bugs at all.")
 
-        now = time.time()
         meta = {
             "snapshot_time": now,
-            "milestones": self.firefox_milestones,
-            "versions": self.firefox_versions
+            "profile": sections.get("profile", profiles.DEFAULT_PROFILE),
+            "pull_mode": sections.get("pull_mode", "full"),
+            "full_snapshot_time": sections.get("full_snapshot_time", now),
+            "milestones": sections["milestones"],
+            "versions": sections["versions"]
         }
+        if len(missing) > 0:
+            meta["missing"] = sorted(missing)
 
         return {"meta": meta, "bugs": bugs}
 
+    def get_snapshot(self, jobs=1, now=None):
+        if now is None:
+            now = time.time()
+        sections = parallel.merge(parallel.call_all(self.snapshot_calls(), jobs=jobs))
+        return self.assemble_snapshot(sections, now)
+
     def create_bug(self, card_id, trello_snapshot):
         card = trello_snapshot['cards'][card_id]
         # labels = trello_snapshot['labels'][card_id]
@@ -82,16 +286,26 @@ class BugzillaClient(object):
 
         return DraftBug(self, bugdata, parsed_version)
 
-    def request(self, method, call, json=None, params=None):
-        """Perform authenticated request, return response as JSON or log errors"""
-        logger.debug("""BugzillaClient.request(method="%s", call="%s", json="%s", params="%s") called"""
+    def send(self, method, call, json=None, params=None, headers=None, stream=False):
+        """Perform authenticated request, return response"""
+        logger.debug("""BugzillaClient.send(method="%s", call="%s", json="%s", params="%s") called"""
                      % (method, call, json, params))
         if params is None:
             params = {}
         if self.token is not None and "api_key" not in params:
             params["api_key"] = self.token
-        url = "%s/%s" % (self.API_URL, call.lstrip("/"))
-        response = requests.request(method, url, json=json, params=params)
+        url = "%s/%s" % (self.api_url, call.lstrip("/"))
+        return self.scheduler.send(self.session, method, url, json=json, params=params, headers=headers,
+                                   stream=stream, timeout=session.default_timeout())
+
+    def request(self, method, call, json=None, params=None, headers=None):
+        """Perform authenticated request, return response as JSON or log errors"""
+        response = self.send(method, call, json=json, params=params, headers=headers)
+        return self.check_response(method, response)
+
+    @staticmethod
+    def check_response(method, response):
+        """Return response as JSON or log errors"""
         try:
             response.raise_for_status()
         except requests.HTTPError as e:
@@ -103,6 +317,20 @@ class BugzillaClient(object):
             raise e
         return response.json()
 
+    def iter_get(self, call, key, **params):
+        """
+        Authenticated GET request for large results. Items of the array under
+        `key` are decoded while the response is still arriving.
+        """
+        response = self.send("GET", call, params=params, stream=True)
+        try:
+            if not response.ok:
+                self.check_response("GET", response)
+            for item in jsonstream.iter_items(response.iter_content(chunk_size=jsonstream.CHUNK_SIZE), key):
+                yield item
+        finally:
+            response.close()
+
     def get(self, call, json=None, **params):
         """Convenience wrapper for authenticated GET requests"""
         return self.request("GET", call, params=params)
@@ -115,16 +343,57 @@ class BugzillaClient(object):
         """Convenience wrapper for authenticated PUT requests"""
         return self.request("PUT", call, json=json, params=params)
 
-    def valid_values(self, field_name, product=None):
+    def cached_get(self, call, ttl=None, **params):
+        """
+        Convenience wrapper for authenticated GET requests through the metadata cache.
+
+        Fresh entries are returned without asking Bugzilla. Expired entries are
+        revalidated with a conditional request if Bugzilla sent validators.
+        """
+        if self.metadata_cache is None:
+            return self.get(call, **params)
+        if ttl is None:
+            ttl = cache.metadata_ttl()
+        key = "bugzilla:/%s?%s" % (call.lstrip("/"), urllib.urlencode(sorted(params.items()), doseq=True))
+        entry = self.metadata_cache.get(key)
+        if self.metadata_cache.is_fresh(entry, ttl):
+            logger.debug("Using cached result for `%s`" % call)
+            return entry["data"]
+
+        headers = {}
+        if entry is not None:
+            if entry["etag"] is not None:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"] is not None:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        response = self.send("GET", call, params=params, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            logger.debug("Cached result for `%s` is still valid" % call)
+            self.metadata_cache.touch(key)
+            return entry["data"]
+        result = self.check_response("GET", response)
+        self.metadata_cache.put(key, result, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return result
+
+    def valid_values(self, field_name, product=None, ttl=None):
+        """
+        Valid values of a bug field, cached on disk
+        :param field_name: str
+        :param product: str with product name or None for Firefox
+        :param ttl: float with seconds to use cached values without revalidation or None for default
+        :return: list of str
+        """
         if product is None:
             product_id = self.firefox_product_id
         else:
             product_id = self.get_product_id(product)
-        result = self.get("field/bug/%s/%s/values" % (field_name, product_id))
+        if ttl is None:
+            ttl = cache.field_values_ttl()
+        result = self.cached_get("field/bug/%s/%s/values" % (field_name, product_id), ttl=ttl)
         return result["values"]
 
     def get_product_id(self, product_name):
-        result = self.get("product", names=[product_name])
+        result = self.cached_get("product", ttl=cache.field_values_ttl(), names=[product_name])
         return result["products"][0]["id"]
 
     @property
@@ -134,30 +403,57 @@ class BugzillaClient(object):
         # return self.__firefox_product_id
         return 21  # Unlikely to ever change
 
+    def field_values(self, field_name, refresh=False):
+        """
+        Valid values of a Firefox bug field, fetched once per client
+        :param field_name: str
+        :param refresh: bool to revalidate cached values with Bugzilla
+        :return: tuple of values and frozenset of the same values
+        """
+        if refresh or field_name not in self.__field_values:
+            values = tuple(self.valid_values(field_name, ttl=0 if refresh else None))
+            self.__field_values[field_name] = (values, frozenset(values))
+        return self.__field_values[field_name]
+
+    def is_valid_value(self, field_name, value):
+        """
+        Check whether a value is valid for a Firefox bug field. Cached values
+        may be outdated, so they are revalidated once on the first miss.
+        :param field_name: str
+        :param value: str
+        :return: bool
+        """
+        if value in self.field_values(field_name)[1]:
+            return True
+        if field_name in self.__refreshed_fields:
+            return False
+        self.__refreshed_fields.add(field_name)
+        return value in self.field_values(field_name, refresh=True)[1]
+
     @property
     def firefox_milestones(self):
-        if self.__firefox_milestones is None:
-            self.__firefox_milestones = self.valid_values("target_milestone")
-        return list(self.__firefox_milestones)
+        return self.field_values("target_milestone")[0]
 
     @property
     def firefox_versions(self):
-        if self.__firefox_versions is None:
-            self.__firefox_versions = self.valid_values("version")
-        return list(self.__firefox_versions)
+        return self.field_values("version")[0]
 
     def map_firefox_version(self, firefox_version):
-        version = "%s Branch" % str(firefox_version)
-        if version not in self.firefox_versions:
-            assert "Trunk" in self.firefox_versions
-            version = "Trunk"
+        firefox_version = str(firefox_version)
+        if firefox_version not in self.__version_map:
+            version = "%s Branch" % firefox_version
+            if not self.is_valid_value("version", version):
+                assert self.is_valid_value("version", "Trunk")
+                version = "Trunk"
+
+            target_milestone = "Firefox %s" % firefox_version
+            if not self.is_valid_value("target_milestone", target_milestone):
+                assert self.is_valid_value("target_milestone", "Future")
+                target_milestone = "Future"
 
-        target_milestone = "Firefox %s" % str(firefox_version)
-        if target_milestone not in self.firefox_milestones:
-            assert "Future" in self.firefox_milestones
-            target_milestone = "Future"
+            self.__version_map[firefox_version] = {"version": version, "target_milestone": target_milestone}
 
-        return {"version": version, "target_milestone": target_milestone}
+        return dict(self.__version_map[firefox_version])
 
     def update(self, bug_id, **json):
         # Updating bugs requires special request body formatting.
@@ -172,6 +468,58 @@ class BugzillaClient(object):
         url_spec = {"url": url}
         self.update(bug_id, **url_spec)
 
+    def bulk_update(self, updates, chunk_size=100):
+        """
+        Apply updates to many bugs with as few requests as possible. Bugs
+        that get the same field values are updated together in one request.
+        :param updates: dict mapping bug IDs to dicts of field values
+        :param chunk_size: int maximum number of bugs per request
+        :return: dict mapping bug IDs to results with `ok`, and `changes` or `error`
+        """
+        groups = {}
+        for bug_id, fields in updates.iteritems():
+            key = json.dumps(fields, sort_keys=True)
+            groups.setdefault(key, []).append(str(bug_id))
+
+        calls = {}
+        for key, bug_ids in groups.iteritems():
+            bug_ids = sorted(bug_ids, key=int)
+            for start in xrange(0, len(bug_ids), chunk_size):
+                chunk = bug_ids[start:start + chunk_size]
+                calls[(key, start)] = lambda k=key, c=chunk: self.__update_many(c, json.loads(k))
+        logger.debug("Updating %d bugs with %d requests" % (len(updates), len(calls)))
+
+        results = {}
+        for chunk_results in parallel.call_all(calls, jobs=self.jobs).itervalues():
+            results.update(chunk_results)
+        return results
+
+    def __update_many(self, bug_ids, fields):
+        """
+        Update several bugs to the same field values in a single request
+        :param bug_ids: list of str with bug IDs
+        :param fields: dict with field values
+        :return: dict mapping bug IDs to results
+        """
+        try:
+            response = self.put("bug/%s" % bug_ids[0], ids=map(int, bug_ids), **fields)
+        except requests.HTTPError as e:
+            return dict([(bug_id, {"ok": False, "error": str(e)}) for bug_id in bug_ids])
+        results = dict([(bug_id, {"ok": False, "error": "Missing from response"}) for bug_id in bug_ids])
+        for bug in response.get("bugs", []):
+            results[str(bug["id"])] = {"ok": True, "changes": bug.get("changes", {})}
+        return results
+
+    def bulk_update_versions(self, firefox_versions):
+        """
+        Update version and target milestone of many bugs
+        :param firefox_versions: dict mapping bug IDs to Firefox versions
+        :return: dict mapping bug IDs to results, see bulk_update()
+        """
+        updates = dict([(bug_id, self.map_firefox_version(firefox_version))
+                        for bug_id, firefox_version in firefox_versions.iteritems()])
+        return self.bulk_update(updates)
+
 
 class DraftBug(object):
     def __init__(self, bz, bugdata, firefox_version=None):
@@ -194,8 +542,6 @@ class DraftBug(object):
         return dict(self.bugdata)
 
     def submit(self):
-        """ Creates a new bug and returns its URL """
-        response = self.bz.post("bug", json=self.bugdata)
-        print response.text
-        response.raise_for_status()
-        return str(response.json()['id'])
+        """ Creates a new bug and returns its ID """
+        result = self.bz.post("bug", **self.bugdata)
+        return str(result["id"])
@@ -0,0 +1,260 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import trellosa.deltas as deltas
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataCache(object):
+    """
+    On-disk cache for rarely changing API metadata like labels, custom field
+    definitions or valid field values. Every entry remembers the validators
+    of its response, so expired entries can be revalidated with conditional
+    requests where the API supports them.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(cache_dir)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.lock = threading.Lock()
+
+    def key_to_file_name(self, key):
+        """
+        Converts a cache key to the name of its entry file
+        :param key: str with cache key
+        :return: str with file name
+        """
+        return os.path.join(self.cache_dir, "%s.json" % hashlib.sha1(key).hexdigest())
+
+    def get(self, key):
+        """
+        Return a cache entry
+        :param key: str with cache key
+        :return: dict with `key`, `time`, `etag`, `last_modified` and `data`, or None
+        """
+        try:
+            with open(self.key_to_file_name(key), "r") as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if entry.get("key") != key:
+            return None
+        return entry
+
+    def put(self, key, data, etag=None, last_modified=None):
+        """
+        Store a cache entry, replacing any previous one
+        :param key: str with cache key
+        :param data: JSON-serializable object
+        :param etag: str with ETag response header or None
+        :param last_modified: str with Last-Modified response header or None
+        :return: None
+        """
+        entry = {
+            "key": key,
+            "time": time.time(),
+            "etag": etag,
+            "last_modified": last_modified,
+            "data": data
+        }
+        file_name = self.key_to_file_name(key)
+        tmp_file_name = "%s.%s.tmp" % (file_name, threading.current_thread().ident)
+        with self.lock:
+            with open(tmp_file_name, "w") as f:
+                json.dump(entry, f)
+            os.rename(tmp_file_name, file_name)
+
+    def touch(self, key):
+        """
+        Mark entry as fresh after successful revalidation
+        :param key: str with cache key
+        :return: None
+        """
+        entry = self.get(key)
+        if entry is not None:
+            self.put(key, entry["data"], entry["etag"], entry["last_modified"])
+
+    def is_fresh(self, entry, ttl):
+        return entry is not None and time.time() - entry["time"] < ttl
+
+    def keys(self):
+        """
+        Returns a list of cached keys
+        :return: list of str
+        """
+        keys = []
+        for file_name in glob.glob(os.path.join(self.cache_dir, "*.json")):
+            try:
+                with open(file_name, "r") as f:
+                    keys.append(json.load(f)["key"])
+            except (IOError, ValueError, KeyError):
+                continue
+        return sorted(keys)
+
+    def invalidate(self, prefix=""):
+        """
+        Remove all entries with keys starting with prefix
+        :param prefix: str
+        :return: int number of removed entries
+        """
+        removed = 0
+        for key in self.keys():
+            if key.startswith(prefix):
+                logger.debug("Invalidating cache entry `%s`" % key)
+                os.remove(self.key_to_file_name(key))
+                removed += 1
+        return removed
+
+
+class OnlineCache(object):
+    """
+    Read-through cache for online snapshots, kept in memory and on disk.
+    Snapshots fetched with the full projection profile also serve requests
+    for any other profile. Callers get copies, so they may modify them.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(cache_dir)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.snapshots = {}
+
+    def profile_to_file_name(self, profile):
+        return os.path.join(self.cache_dir, "%s.json.gz" % profile)
+
+    @staticmethod
+    def snapshot_time(snapshot):
+        return snapshot["firefox_trello"]["meta"]["snapshot_time"]
+
+    def __load(self, profile):
+        if profile not in self.snapshots:
+            try:
+                with gzip.open(self.profile_to_file_name(profile), "r") as f:
+                    self.snapshots[profile] = json.loads(f.read().decode("utf-8"))
+            except (IOError, ValueError):
+                return None
+        return self.snapshots[profile]
+
+    def get(self, profile, max_age):
+        """
+        Return most recent cached online snapshot not older than max_age
+        :param profile: str with projection profile of the requested snapshot
+        :param max_age: float with seconds
+        :return: dict with snapshot or None
+        """
+        candidates = []
+        for candidate_profile in set([profile, "full"]):
+            snapshot = self.__load(candidate_profile)
+            if snapshot is not None:
+                candidates.append(snapshot)
+        candidates = filter(lambda x: time.time() - self.snapshot_time(x) < max_age, candidates)
+        if len(candidates) == 0:
+            return None
+        return deltas.copy_data(max(candidates, key=self.snapshot_time))
+
+    def put(self, profile, snapshot):
+        """
+        Store online snapshot fetched with the given profile
+        :param profile: str with projection profile
+        :param snapshot: dict with snapshot
+        :return: None
+        """
+        self.snapshots[profile] = deltas.copy_data(snapshot)
+        file_name = self.profile_to_file_name(profile)
+        tmp_file_name = "%s.%d.tmp" % (file_name, os.getpid())
+        with gzip.open(tmp_file_name, "w", compresslevel=1) as f:
+            f.write(json.dumps(snapshot, sort_keys=True).encode("utf-8"))
+        os.rename(tmp_file_name, file_name)
+
+    def invalidate(self):
+        """
+        Remove all cached online snapshots
+        :return: int number of removed snapshots
+        """
+        self.snapshots = {}
+        removed = 0
+        for file_name in glob.glob(os.path.join(self.cache_dir, "*.json.gz")):
+            os.remove(file_name)
+            removed += 1
+        return removed
+
+
+# Default time to live of metadata without revalidation, see configure()
+DEFAULT_TTL = 3600
+# Bugzilla field values like versions only change with release cycles
+DEFAULT_FIELD_VALUES_TTL = 86400
+
+__metadata_cache = None
+__ttl = DEFAULT_TTL
+__field_values_ttl = DEFAULT_FIELD_VALUES_TTL
+
+
+__online_caches = {}
+
+
+def metadata_cache_dir(workdir):
+    return os.path.join(workdir, "cache", "metadata")
+
+
+def online_cache_dir(workdir):
+    return os.path.join(workdir, "cache", "online")
+
+
+def get_online_cache(workdir):
+    """
+    Return the process-wide online snapshot cache for a working directory
+    :param workdir: str with working directory
+    :return: OnlineCache
+    """
+    if workdir not in __online_caches:
+        __online_caches[workdir] = OnlineCache(online_cache_dir(workdir))
+    return __online_caches[workdir]
+
+
+def configure(workdir, ttl=None, field_values_ttl=None):
+    """
+    Enable the metadata cache in the working directory
+    :param workdir: str with working directory or None to disable caching
+    :param ttl: float with seconds entries are used without revalidation
+    :param field_values_ttl: float with seconds Bugzilla field values are used without revalidation
+    :return: None
+    """
+    global __metadata_cache, __ttl, __field_values_ttl
+    if workdir is None:
+        __metadata_cache = None
+    else:
+        __metadata_cache = MetadataCache(metadata_cache_dir(workdir))
+    if ttl is not None:
+        __ttl = ttl
+    if field_values_ttl is not None:
+        __field_values_ttl = field_values_ttl
+
+
+def get_metadata_cache():
+    """
+    Return the process-wide metadata cache
+    :return: MetadataCache or None if caching is disabled
+    """
+    return __metadata_cache
+
+
+def metadata_ttl():
+    return __ttl
+
+
+def field_values_ttl():
+    return __field_values_ttl
@@ -0,0 +1,172 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Persistent catalogue of snapshot handles, so that listing and looking up
+# snapshots does not scan the snapshot directories on every command.
+
+import calendar
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Format of snapshot handles
+HANDLE_FORMAT = "%Y-%m-%dZ%H-%M-%S"
+
+# Catalogues of other schema versions are rebuilt
+SCHEMA_VERSION = 2
+
+
+def handle_to_time(handle):
+    """
+    Time a snapshot was taken, by its handle
+    :param handle: str with handle
+    :return: float with UTC epoch time
+    """
+    return float(calendar.timegm(time.strptime(handle, HANDLE_FORMAT)))
+
+
+class Catalogue(object):
+    """
+    Thread-safe SQLite index of snapshot handles, storage formats and codecs.
+    Lookups by handle, by time and of the latest snapshots use indexes.
+    """
+
+    def __init__(self, db_file):
+        """
+        :param db_file: str with path of the database, created if missing
+        """
+        self.db_file = db_file
+        self.is_new = not os.path.isfile(db_file)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        if not self.is_new and self.db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            logger.debug("Rebuilding outdated snapshot catalogue")
+            self.db.execute("DROP TABLE IF EXISTS snapshots")
+            self.is_new = True
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS snapshots "
+                            "(handle TEXT PRIMARY KEY, storage TEXT NOT NULL, codec TEXT NOT NULL, time REAL NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS snapshots_time ON snapshots (time)")
+            self.db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+    def __query(self, sql, *params):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def __first(self, sql, *params):
+        rows = self.__query(sql, *params)
+        return rows[0][0] if len(rows) > 0 else None
+
+    def add(self, handle, storage, codec):
+        """
+        Add a snapshot or change its storage format or codec
+        :param handle: str with handle
+        :param storage: str with storage format
+        :param codec: str with compression codec
+        :return: None
+        """
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO snapshots (handle, storage, codec, time) VALUES (?, ?, ?, ?)",
+                            (handle, storage, codec, handle_to_time(handle)))
+
+    def remove(self, handle):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM snapshots WHERE handle = ?", (handle,))
+
+    def replace(self, entries):
+        """
+        Replace the whole catalogue
+        :param entries: list of tuples of str with handle, storage format and codec
+        :return: None
+        """
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM snapshots")
+            self.db.executemany("INSERT INTO snapshots (handle, storage, codec, time) VALUES (?, ?, ?, ?)",
+                                [(handle, storage, codec, handle_to_time(handle))
+                                 for handle, storage, codec in entries])
+
+    def lookup(self, handle):
+        """
+        :param handle: str with handle
+        :return: tuple of str with storage format and codec, or None if the snapshot does not exist
+        """
+        rows = self.__query("SELECT storage, codec FROM snapshots WHERE handle = ?", handle)
+        return (str(rows[0][0]), str(rows[0][1])) if len(rows) > 0 else None
+
+    def storage(self, handle):
+        """
+        :param handle: str with handle
+        :return: str with storage format or None if the snapshot does not exist
+        """
+        return self.__first("SELECT storage FROM snapshots WHERE handle = ?", handle)
+
+    def codec(self, handle):
+        """
+        :param handle: str with handle
+        :return: str with compression codec or None if the snapshot does not exist
+        """
+        return self.__first("SELECT codec FROM snapshots WHERE handle = ?", handle)
+
+    def count(self):
+        return self.__first("SELECT COUNT(*) FROM snapshots")
+
+    def list(self, storage=None):
+        """
+        :param storage: str to only list snapshots in this storage format
+        :return: sorted list of str with handles
+        """
+        if storage is None:
+            rows = self.__query("SELECT handle FROM snapshots ORDER BY handle")
+        else:
+            rows = self.__query("SELECT handle FROM snapshots WHERE storage = ? ORDER BY handle", storage)
+        return [str(row[0]) for row in rows]
+
+    def ordinal(self, number):
+        """
+        Look up a snapshot by its position from the end. The index is walked
+        from the latest snapshot, so the cost depends on the number, not on
+        the size of the catalogue.
+        :param number: int, 1 for the latest snapshot
+        :return: str with handle or None
+        """
+        if number < 1:
+            return None
+        handle = self.__first("SELECT handle FROM snapshots ORDER BY handle DESC LIMIT 1 OFFSET ?", number - 1)
+        return str(handle) if handle is not None else None
+
+    def before(self, handle):
+        """
+        :param handle: str with handle
+        :return: str with handle of the previous snapshot or None
+        """
+        previous = self.__first("SELECT handle FROM snapshots WHERE handle < ? ORDER BY handle DESC LIMIT 1", handle)
+        return str(previous) if previous is not None else None
+
+    def after(self, handle):
+        """
+        :param handle: str with handle
+        :return: str with handle of the next snapshot or None
+        """
+        following = self.__first("SELECT handle FROM snapshots WHERE handle > ? ORDER BY handle LIMIT 1", handle)
+        return str(following) if following is not None else None
+
+    def at(self, timestamp):
+        """
+        Latest snapshot taken at or before a time
+        :param timestamp: float with UTC epoch time
+        :return: str with handle or None
+        """
+        handle = self.__first("SELECT handle FROM snapshots WHERE time <= ? ORDER BY time DESC LIMIT 1", timestamp)
+        return str(handle) if handle is not None else None
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -34,10 +34,13 @@ def cleanup_handler():
     global __cleanup_done
     if not __cleanup_done:
         __cleanup_done = True
-        for child in CleanUp.__subclasses__():
+        for child in sorted(CleanUp.__subclasses__(), key=lambda x: x.order):
             child.at_exit()
 
 
 class CleanUp(object):
-    """When process terminates, .at_exit() is called on every subclass."""
-    pass
+    """
+    When process terminates, .at_exit() is called on every subclass,
+    in ascending `order`.
+    """
+    order = 0
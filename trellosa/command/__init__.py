@@ -9,17 +9,21 @@ import sys
 
 import basecommand
 import bugs
+import cache
 import diff
+import fakeserver
 import log
 import pull
 import query
+import recompress
 import setup
 import shell
 import stats
 import tag
 import triage
 
-__all__ = ["bugs", "diff", "log", "pull", "query", "setup", "shell", "stats", "tag", "triage"]
+__all__ = ["bugs", "cache", "diff", "fakeserver", "log", "pull", "query", "recompress", "setup", "shell", "stats",
+           "tag", "triage"]
 logger = logging.getLogger(__name__)
 
 
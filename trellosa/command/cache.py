@@ -0,0 +1,56 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+
+from basecommand import BaseCommand
+import trellosa.cache as cache
+
+
+logger = logging.getLogger(__name__)
+
+
+class CacheMode(BaseCommand):
+    """
+    Command for inspecting and invalidating the metadata and online state caches
+    """
+
+    name = "cache"
+    help = "Inspect and invalidate cached API metadata and online state"
+
+    @classmethod
+    def setup_args(cls, parser):
+        """
+        Add subparser for cache-specific arguments.
+
+        :param parser: parent argparser to add to
+        :return: None
+        """
+
+        parser.add_argument("-c", "--clear",
+                            help="Invalidate all cached metadata and online state",
+                            action="store_true")
+        parser.add_argument("-u", "--upstream",
+                            help="Only invalidate metadata of this upstream API",
+                            choices=["trello", "bugzilla"],
+                            action="store")
+
+    def run(self):
+
+        metadata_cache = cache.MetadataCache(cache.metadata_cache_dir(self.args.workdir))
+
+        if self.args.clear or self.args.upstream is not None:
+            prefix = "" if self.args.upstream is None else self.args.upstream + ":"
+            removed = metadata_cache.invalidate(prefix)
+            logger.info("Invalidated %d cached metadata entries" % removed)
+            if self.args.upstream is None:
+                removed = cache.get_online_cache(self.args.workdir).invalidate()
+                logger.info("Invalidated %d cached online snapshots" % removed)
+        else:
+            for key in metadata_cache.keys():
+                print key
+
+        return 0
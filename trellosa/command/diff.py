@@ -57,7 +57,7 @@ class DiffMode(BaseCommand):
         snapshot_db = snapshots.SnapshotDB(self.args)
         tag_db = tags.TagsDB(self.args)
 
-        a_handle, a = snapshots.get(self.args, snapshot_db, tag_db, self.args.a_ref)
+        a_handle, a = snapshots.get(self.args, snapshot_db, tag_db, self.args.a_ref, use_cache=True)
         if a_handle is None:
             logger.critical("Invalid baseline reference (-a --from)")
             return 5
@@ -65,7 +65,7 @@ class DiffMode(BaseCommand):
             logger.critical("Error retrieving baseline content")
             return 5
 
-        b_handle, b = snapshots.get(self.args, snapshot_db, tag_db, self.args.b_ref)
+        b_handle, b = snapshots.get(self.args, snapshot_db, tag_db, self.args.b_ref, use_cache=True)
         if b_handle is None:
             logger.critical("Invalid target reference (-b --to)")
             return 5
@@ -0,0 +1,81 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+
+from basecommand import BaseCommand
+import trellosa.fakeserver as fakeserver
+
+
+logger = logging.getLogger(__name__)
+
+
+class FakeServerMode(BaseCommand):
+    """
+    Command for running a local fake of the Trello and Bugzilla APIs
+    """
+
+    name = "fakeserver"
+    help = "Serve a synthetic board and bugs locally for offline benchmarks"
+
+    @classmethod
+    def setup_args(cls, parser):
+        """
+        Add subparser for fakeserver-specific arguments.
+
+        :param parser: parent argparser to add to
+        :return: None
+        """
+
+        parser.add_argument("-p", "--port",
+                            help="Port to listen on (default: 8666)",
+                            type=int,
+                            action="store",
+                            default=8666)
+        parser.add_argument("-c", "--cards",
+                            help="Number of synthetic Trello cards (default: 1000)",
+                            type=int,
+                            action="store",
+                            default=1000)
+        parser.add_argument("-n", "--bugs",
+                            help="Number of synthetic bugs (default: 1000)",
+                            type=int,
+                            action="store",
+                            default=1000)
+        parser.add_argument("-l", "--latency",
+                            help="Seconds to delay every response (default: 0)",
+                            type=float,
+                            action="store",
+                            default=0.0)
+        parser.add_argument("--jitter",
+                            help="Relative random variation of the latency, 0 to 1 (default: 0)",
+                            type=float,
+                            action="store",
+                            default=0.0)
+        parser.add_argument("--seed",
+                            help="Seed for generating synthetic data (default: 0)",
+                            type=int,
+                            action="store",
+                            default=0)
+
+    def run(self):
+
+        logger.info("Generating %d cards and %d bugs" % (self.args.cards, self.args.bugs))
+        data = fakeserver.FakeData(cards=self.args.cards, bugs=self.args.bugs, board_id=self.args.board,
+                                   seed=self.args.seed)
+        server = fakeserver.FakeServer(data, port=self.args.port, latency=self.args.latency,
+                                       jitter=self.args.jitter)
+        logger.info("Serving on %s. Point trellosa to it with `--trello-url %s --bugzilla-url %s`"
+                    % (server.url, server.trello_url, server.bugzilla_url))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        logger.info("Served %d requests" % server.requests)
+
+        return 0
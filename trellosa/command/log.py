@@ -39,6 +39,14 @@ class LogMode(BaseCommand):
                             help="Delete a snapshot",
                             action="store")
 
+        parser.add_argument("--reindex",
+                            help="Rebuild the snapshot catalogue from the snapshot files",
+                            action="store_true")
+
+        parser.add_argument("--layout",
+                            help="Show snapshot storage formats and sizes, and keyframes and deltas",
+                            action="store_true")
+
     def run(self):
 
         snapshot_db = snapshots.SnapshotDB(self.args)
@@ -58,6 +66,26 @@ class LogMode(BaseCommand):
                 # TODO: Also delete associated tags
                 return 0
 
+        if self.args.reindex:
+            count = snapshot_db.reindex()
+            logger.info("Indexed %d snapshots" % count)
+            return 0
+
+        if self.args.layout:
+            layout = snapshot_db.layout()
+            length = len(layout)
+            for number in xrange(length):
+                entry = layout[number]
+                if "keyframe" not in entry:
+                    description = entry["storage"]
+                elif entry["keyframe"]:
+                    description = "%s keyframe" % entry["storage"]
+                else:
+                    description = "%s %d to %s" % (entry["storage"], entry["depth"], entry["base"])
+                print "%d: %s %9.1fkB %-9s %s" % (length - number, entry["handle"], entry["size"] / 1024.0,
+                                                  entry["codec"], description)
+            return 0
+
         if self.args.show is None:
             handle_list = snapshot_db.list()
             length = len(handle_list)
@@ -70,7 +98,7 @@ class LogMode(BaseCommand):
                 else:
                     print "%d: %s [%s]" % (ref, handle, ",".join(tag_list))
         else:
-            handle, content = snapshots.get(self.args, snapshot_db, tag_db, self.args.show)
+            handle, content = snapshots.get(self.args, snapshot_db, tag_db, self.args.show, use_cache=True)
             if handle is None:
                 logger.critical("Invalid snapshot reference (-s --show)")
                 return 5
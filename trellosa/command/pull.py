@@ -7,6 +7,8 @@
 import logging
 
 from basecommand import BaseCommand
+import trellosa.compression as compression
+import trellosa.profiles as profiles
 import trellosa.snapshots as snapshots
 import trellosa.tags as tags
 
@@ -34,15 +36,62 @@ class PullMode(BaseCommand):
         parser.add_argument("-d", "--dump",
                             help="Just dump online board state to terminal as JSON",
                             action="store_true")
+        parser.add_argument("-p", "--profile",
+                            help="Field projection profile (default: full)",
+                            choices=sorted(profiles.PROFILES.keys()),
+                            action="store",
+                            default=profiles.DEFAULT_PROFILE)
+        parser.add_argument("-s", "--stream",
+                            help="Decode cards and bugs while downloading and writing the snapshot to limit memory use",
+                            action="store_true")
+        parser.add_argument("-i", "--incremental",
+                            help="Only fetch Trello cards and bugs changed since the latest snapshot",
+                            action="store_true")
+        parser.add_argument("--storage",
+                            help="Snapshot storage format. `dedup` stores unchanged cards and bugs only once, "
+                                 "`delta` stores changes to the previous snapshot "
+                                 "and `indexed` allows reading single sections or cards "
+                                 "(default: %s)" % snapshots.SnapshotDB.DEFAULT_STORAGE,
+                            choices=sorted(snapshots.SnapshotDB.STORAGE_SUFFIXES.keys()),
+                            action="store",
+                            default=snapshots.SnapshotDB.DEFAULT_STORAGE)
+        parser.add_argument("-c", "--compression",
+                            help="Snapshot compression codec (default: %s)" % snapshots.SnapshotDB.DEFAULT_CODEC,
+                            choices=compression.available_codecs(),
+                            action="store",
+                            default=snapshots.SnapshotDB.DEFAULT_CODEC)
+        parser.add_argument("--keyframe-interval",
+                            help="With `delta` or `dedup` storage, store every n-th snapshot or manifest in full "
+                                 "(default: %d)"
+                                 % snapshots.SnapshotDB.DEFAULT_KEYFRAME_INTERVAL,
+                            type=int,
+                            action="store",
+                            default=snapshots.SnapshotDB.DEFAULT_KEYFRAME_INTERVAL)
+        parser.add_argument("--allow-partial",
+                            help="Store a partial snapshot if some sections can not be fetched",
+                            action="store_true")
+        parser.add_argument("--full-interval",
+                            help="Seconds after which an incremental pull does a full refresh (default: 86400)",
+                            type=float,
+                            action="store",
+                            default=86400)
 
     def run(self):
         tag_db = tags.TagsDB(self.args)
         snapshot_db = snapshots.SnapshotDB(self.args)
-        _, snapshot = snapshots.get(self.args, snapshot_db, tag_db, "0")  # handle 0 is current online state
+        if self.args.incremental:
+            previous = snapshots.incremental_base(snapshot_db, self.args.full_interval, profile=self.args.profile)
+            snapshot = snapshots.fetch_online(self.args, previous=previous, profile=self.args.profile)
+        elif self.args.stream:
+            snapshot = snapshots.fetch_online(self.args, profile=self.args.profile, stream=True)
+        else:
+            # handle 0 is current online state
+            _, snapshot = snapshots.get(self.args, snapshot_db, tag_db, "0", profile=self.args.profile)
 
         if self.args.dump:
-            snapshots.json_highlight_print(snapshot)
+            snapshots.json_highlight_print(snapshots.materialize(snapshot))
         else:
-            snapshots.store(snapshot_db, snapshot)
+            snapshots.store(snapshot_db, snapshot, storage=self.args.storage,
+                            keyframe_interval=self.args.keyframe_interval)
 
         return 0
@@ -44,19 +44,33 @@ class QueryMode(BaseCommand):
         snapshot_db = snapshots.SnapshotDB(self.args)
         tag_db = tags.TagsDB(self.args)
 
-        handle, content = snapshots.get(self.args, snapshot_db, tag_db, self.args.snapshot)
+        if self.args.id is None:
+            logger.critical("Please specify ID to query with `-i`")
+            return 10
+        tid = str(self.args.id)
+
+        handle = snapshots.match(snapshot_db, tag_db, self.args.snapshot)
         if handle is None:
             logger.critical("Invalid snapshot reference (-s --show)")
             return 5
+
+        # The online state has no handle to look up again, so keep its reference
+        ref = self.args.snapshot if handle == "online" else handle
+
+        # Exact IDs are looked up first in indexed snapshots, which only reads the
+        # blocks holding them. Other storage formats are always decoded whole.
+        content = None
+        if handle != "online" and snapshot_db.catalogue.storage(handle) == "indexed":
+            handle, content = snapshots.get(self.args, snapshot_db, tag_db, ref, ids=[tid])
+            if content is not None and not snapshots.has_id(content, tid):
+                logger.debug("No exact match for `%s`, loading whole snapshot" % tid)
+                content = None
+        if content is None:
+            handle, content = snapshots.get(self.args, snapshot_db, tag_db, ref, use_cache=True)
         if content is None:
             logger.critical("Error retrieving snapshot content")
             return 5
 
-        if self.args.id is None:
-            logger.critical("Please specify ID to query with `-i`")
-            return 10
-
-        tid = str(self.args.id)
         logger.debug("Looking for ID pattern `%s`" % tid)
 
         result = {}
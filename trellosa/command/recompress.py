@@ -0,0 +1,84 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+
+from basecommand import BaseCommand
+import trellosa.compression as compression
+import trellosa.parallel as parallel
+import trellosa.snapshots as snapshots
+
+
+logger = logging.getLogger(__name__)
+
+
+class RecompressMode(BaseCommand):
+    """
+    Command for converting snapshots to another compression codec
+    """
+
+    name = "recompress"
+    help = "Convert snapshots to another compression codec"
+
+    @classmethod
+    def setup_args(cls, parser):
+        """
+        Add subparser for recompress-specific arguments.
+
+        :param parser: parent argparser to add to
+        :return: None
+        """
+
+        parser.add_argument("-c", "--compression",
+                            help="Target compression codec (default: %s)" % snapshots.SnapshotDB.DEFAULT_CODEC,
+                            choices=compression.available_codecs(),
+                            action="store",
+                            default=snapshots.SnapshotDB.DEFAULT_CODEC)
+        parser.add_argument("-t", "--train-dictionary",
+                            help="Train a new zstd dictionary on recent snapshots first",
+                            action="store_true")
+        parser.add_argument("--training-snapshots",
+                            help="Number of recent snapshots to train the dictionary on (default: 10)",
+                            type=int,
+                            action="store",
+                            default=10)
+        parser.add_argument("--dictionary-size",
+                            help="Maximum dictionary size in bytes (default: 112640)",
+                            type=int,
+                            action="store",
+                            default=112640)
+
+    def run(self):
+        snapshot_db = snapshots.SnapshotDB(self.args)
+        codec = self.args.compression
+
+        handles = snapshot_db.list()
+        if self.args.train_dictionary:
+            if not compression.get_codec(codec).supports_dictionary:
+                logger.critical("Codec `%s` does not support dictionaries" % codec)
+                return 5
+            samples = []
+            for handle in handles[-self.args.training_snapshots:]:
+                samples += snapshots.training_samples(snapshot_db.load(handle))
+            logger.info("Training dictionary on %d samples" % len(samples))
+            dict_id = snapshot_db.dictionaries.add(compression.train_dictionary(samples, self.args.dictionary_size))
+            logger.info("Trained dictionary %d" % dict_id)
+        else:
+            # Snapshots that already use the codec are left alone
+            handles = filter(lambda x: snapshot_db.catalogue.codec(x) != codec, handles)
+
+        if len(handles) == 0:
+            logger.info("All snapshots are compressed with `%s`" % codec)
+            return 0
+
+        logger.info("Recompressing %d snapshots with `%s`" % (len(handles), codec))
+        calls = dict([(handle, lambda h=handle: snapshot_db.recompress(h, codec)) for handle in handles])
+        sizes = parallel.call_all(calls, jobs=self.args.jobs).values()
+        before = sum([size[0] for size in sizes])
+        after = sum([size[1] for size in sizes])
+        logger.info("Recompressed %.1fkB to %.1fkB" % (before / 1024.0, after / 1024.0))
+
+        return 0
@@ -50,7 +50,7 @@ class Shell(BaseCommand):
             raise Exception("Unable to continue without token")
         bz = BugzillaClient(token=bz_token)
 
-        snapshot = snapshots.get(self.args, snapshot_db, tag_db, "1")
+        snapshot = snapshots.get(self.args, snapshot_db, tag_db, "1", use_cache=True)
 
         embed()
 
@@ -47,7 +47,8 @@ class StatsMode(BaseCommand):
         snapshot_db = snapshots.SnapshotDB(self.args)
         tag_db = tags.TagsDB(self.args)
 
-        handle, content = snapshots.get(self.args, snapshot_db, tag_db, self.args.snapshot)
+        handle, content = snapshots.get(self.args, snapshot_db, tag_db, self.args.snapshot, profile="stats",
+                                        sections=["firefox_trello.lists", "firefox_trello.cards"], use_cache=True)
         if handle is None:
             logger.critical("Invalid snapshot reference (-s --show)")
             return 5
@@ -95,10 +96,10 @@ class StatsMode(BaseCommand):
             sec_action = sec_label_counts["Security Triage: Action required"] \
                 if "Security Triage: Action required" in sec_label_counts else 0
             sec_missing = num_cards - sec_ok - sec_action
-            l = content["lists"][lid]
+            trello_list = content["lists"][lid]
             result[lid] = {
-                "__name": l["name"],
-                "_closed": l["closed"],
+                "__name": trello_list["name"],
+                "_closed": trello_list["closed"],
                 "active_cards": num_cards,
                 "inactive_cards": num_inactive_cards,
                 "security_label_ok": sec_ok,
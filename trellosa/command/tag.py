@@ -51,13 +51,13 @@ class TagMode(BaseCommand):
             if not tag_db.is_valid_tag(tag):
                 logger.critical("Invalid tag")
                 return 5
-            handle = self.args.snapshot
-            if handle is None:
-                handle = "1"
-            if handle.isdigit():
-                handle = snapshot_db.list()[-int(handle)]
-            if not snapshot_db.exists(handle):
+            ref = self.args.snapshot
+            if ref is None:
+                ref = "1"
+            handle = snapshots.match(snapshot_db, tag_db, ref)
+            if handle is None or handle == "online":
                 logger.critical("Invalid snapshot reference")
+                return 5
             logger.info("Setting `%s` tag for snapshot `%s`" % (tag, handle))
             tag_db.add(tag, handle)
 
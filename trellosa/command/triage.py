@@ -8,7 +8,9 @@ import logging
 import re
 
 from basecommand import BaseCommand
+import trellosa.asyncclient as asyncclient
 from trellosa.bugzilla import BugzillaClient
+import trellosa.mutations as mutations
 import trellosa.snapshots as snapshots
 import trellosa.tags as tags
 import trellosa.token as token
@@ -19,6 +21,22 @@ from trellosa.trello import parse_firefox_version, extract_bugzilla_bug, extract
 logger = logging.getLogger(__name__)
 
 
+def create_bug(tr, bug, card):
+    """
+    Submit a draft bug and link it to its Trello card
+    :param tr: FirefoxTrello
+    :param bug: DraftBug
+    :param card: dict with Trello card
+    :return: str with bug ID
+    """
+    bug_id = bug.submit()
+    logger.critical("Created bug http://bugzil.la/%s" % bug_id)
+    logger.info("Updating security note and label on Trello card %s" % card["shortUrl"])
+    tr.set_security_notes(card["id"], "bug %s" % bug_id)
+    tr.set_security_action_required_label(card["id"])
+    return bug_id
+
+
 class TriageMode(BaseCommand):
     """
     Command for triaging bugs
@@ -67,7 +85,7 @@ class TriageMode(BaseCommand):
             logger.critical("No Bugzilla access token configured. Use `setup` command first")
             return 10
 
-        bz = BugzillaClient(bz_token)
+        bz = BugzillaClient(bz_token, jobs=self.args.jobs)
 
         tr_token = token.read_token(self.args.workdir, token_type="trello")
         if tr_token is None:
@@ -76,7 +94,23 @@ class TriageMode(BaseCommand):
 
         tr = FirefoxTrello(user_token=tr_token)
 
-        a_handle, a = snapshots.get(self.args, snapshot_db, tag_db, self.args.a_ref)
+        # Fetch both snapshots and the metadata needed during triage in the background
+        with asyncclient.Dispatcher(max_workers=max(4, self.args.jobs),
+                                    timeout=self.args.fetch_timeout) as dispatcher:
+            async_tr = asyncclient.AsyncFirefoxTrello(client=tr, dispatcher=dispatcher)
+            async_bz = asyncclient.AsyncBugzillaClient(client=bz, dispatcher=dispatcher)
+            futures = {
+                "a": dispatcher.submit(snapshots.get, self.args, snapshot_db, tag_db, self.args.a_ref),
+                "b": dispatcher.submit(snapshots.get, self.args, snapshot_db, tag_db, self.args.b_ref,
+                                       profile="triage"),
+                "security_notes_id": async_tr.attribute("security_notes_id"),
+                "security_ok_label": async_tr.attribute("security_ok_label"),
+                "firefox_versions": async_bz.attribute("firefox_versions"),
+                "firefox_milestones": async_bz.attribute("firefox_milestones")
+            }
+            results = dispatcher.gather(futures)
+
+        a_handle, a = results["a"]
         if a_handle is None:
             if self.args.a_ref == "triaged":
                 logger.critical("You might want to tag the base snapshot to compare against as `triaged` first")
@@ -87,7 +121,7 @@ class TriageMode(BaseCommand):
             logger.critical("Error retrieving baseline content")
             return 5
 
-        b_handle, b = snapshots.get(self.args, snapshot_db, tag_db, self.args.b_ref)
+        b_handle, b = results["b"]
         if b_handle is None:
             logger.critical("Invalid target reference (-b --to)")
             return 5
@@ -101,6 +135,11 @@ class TriageMode(BaseCommand):
         abz = b["bugzilla"]
         bbz = b["bugzilla"]
 
+        if "referenced_bugs" not in bbz:
+            # Snapshot predates fetching of referenced bugs
+            snapshots.add_referenced_bugs(b, bz)
+        referenced_bugs = bbz["referenced_bugs"]
+
         if self.args.mode == "json":
             from IPython import embed
             embed()
@@ -109,6 +148,9 @@ class TriageMode(BaseCommand):
         # FIXME: Internal state is not updated during operations. Hence full syncronization
         # may require multiple passes.
 
+        # Confirmed changes are applied in the background while the next card is presented
+        queue = mutations.MutationQueue(workers=2)
+
         # Create a new bug for every (relevant) card that is not associated to one, yet.
         for cid, card in bft["cards"].iteritems():
 
@@ -127,8 +169,12 @@ class TriageMode(BaseCommand):
             labels = [l["name"] for l in card["labels"]]
             bug_id = extract_bugzilla_bug(card, tr.security_notes_id)
             if bug_id is not None and bug_id not in bbz["bugs"]:
-                logger.warning("Bug http://bugzil.la/%s referenced by Trello card %s, but not among bug list"
-                               % (bug_id, card["shortUrl"]))
+                if bug_id in referenced_bugs:
+                    logger.debug("Bug http://bugzil.la/%s referenced by Trello card %s is in another component"
+                                 % (bug_id, card["shortUrl"]))
+                else:
+                    logger.warning("Bug http://bugzil.la/%s referenced by Trello card %s, but not accessible"
+                                   % (bug_id, card["shortUrl"]))
             firefox_version = parse_firefox_version(to_list["name"])
 
             # Don't add bugs for cards that were around last triage, unless called with --all
@@ -166,11 +212,8 @@ class TriageMode(BaseCommand):
                     snapshots.json_highlight_print([bug_preview])
                     yes_or_no = raw_input("Do you want to create a bug with that data in Bugzilla? (y/N) ")
                     if yes_or_no.lower().startswith("y"):
-                        bug_id = bug.submit()
-                        logger.critical("Created bug http://bugzil.la/%s" % bug_id)
-                        logger.info("Updating security note and label on Trello card %s" % card["shortUrl"])
-                        tr.set_security_notes(card["id"], "bug %s" % bug_id)
-                        tr.set_security_action_required_label(card["id"])
+                        queue.submit(card["id"], "Create bug for card %s" % card["shortUrl"],
+                                     create_bug, tr, bug, card)
                     else:
                         logger.warning("Skipping bug creation")
 
@@ -181,6 +224,9 @@ class TriageMode(BaseCommand):
         for cid, card in bft["cards"].iteritems():
             short_url_map[card["shortUrl"]] = card
 
+        # Confirmed bug updates are collected and sent in bulk afterwards
+        bug_updates = {}
+
         for bid, bug in bbz["bugs"].iteritems():
 
             # Sometimes bugs still have long Trello URLs
@@ -206,7 +252,7 @@ class TriageMode(BaseCommand):
                                 % (associated_cards[0]["name"], associated_cards[0]["shortUrl"], bid))
                     yes_or_no = raw_input("Do you want to update the bug's URL field? (y/N) ")
                     if yes_or_no.lower().startswith("y"):
-                        bz.update_url(bid, card["shortUrl"])
+                        bug_updates[bid] = {"url": associated_cards[0]["shortUrl"]}
                     else:
                         logger.warn("https://bugzil.la/%s not updated" % bid)
                 elif len(associated_cards) > 1:
@@ -229,10 +275,18 @@ class TriageMode(BaseCommand):
                                       % (old_version, old_milestone, new_version, new_milestone))
                 if yes_or_no.lower().startswith("y"):
                     logger.debug("Updating bug %s to version %s" % (bid, card_bug.firefox_version))
-                    bz.update_version(bid, card_bug.firefox_version)
+                    bug_updates[bid] = {"version": new_version, "target_milestone": new_milestone}
                 else:
                     logger.info("Skipping version update for bug http://bugzil.la/%s" % bid)
 
+        if len(bug_updates) > 0:
+            logger.info("Updating %d bugs" % len(bug_updates))
+            for bid, result in sorted(bz.bulk_update(bug_updates).iteritems()):
+                if result["ok"]:
+                    logger.debug("Updated bug http://bugzil.la/%s: %s" % (bid, result["changes"]))
+                else:
+                    logger.error("Failed to update bug http://bugzil.la/%s: %s" % (bid, result["error"]))
+
         # TODO: Syncronize Trello labels to Bugzilla bug state.
         # Bugzilla state is authoritative.
 
@@ -240,10 +294,12 @@ class TriageMode(BaseCommand):
             bid = extract_bugzilla_bug(card, tr.security_notes_id)
             if bid is None:
                 continue
-            try:
+            if bid in bbz["bugs"]:
                 bug = bbz["bugs"][bid]
-            except KeyError:
-                logger.warn("Card `%s` references unfetched bug http://bugzil.la/%s" % (card["shortUrl"], bid))
+            elif bid in referenced_bugs:
+                bug = referenced_bugs[bid]
+            else:
+                logger.warn("Card `%s` references inaccessible bug http://bugzil.la/%s" % (card["shortUrl"], bid))
                 continue
             if bug["resolution"] == "DUPLICATE":
                 logger.debug("Skipping duplicate bug http://bugzil.la/%s" % bid)
@@ -260,7 +316,8 @@ class TriageMode(BaseCommand):
                     logger.warn("Card %s has no triage label and should have `Action required`" % card["shortUrl"])
                 yes_or_no = raw_input("Do you want to update the card? (y/N) ")
                 if yes_or_no.lower().startswith("y"):
-                    tr.set_security_action_required_label(card["id"])
+                    queue.submit(card["id"], "Set label `Action required` on card %s" % card["shortUrl"],
+                                 tr.set_security_action_required_label, card["id"])
             elif label_should == tr.security_ok_label:
                 if label_is == [tr.security_action_required_label]:
                     logger.warn("Card %s has triage label `Action required`, but should have `OK`" % card["shortUrl"])
@@ -268,9 +325,14 @@ class TriageMode(BaseCommand):
                     logger.warn("Card %s has no triage label and should have `OK`" % card["shortUrl"])
                 yes_or_no = raw_input("Do you want to update the card? (y/N) ")
                 if yes_or_no.lower().startswith("y"):
-                    tr.set_security_ok_label(card["id"])
+                    queue.submit(card["id"], "Set label `OK` on card %s" % card["shortUrl"],
+                                 tr.set_security_ok_label, card["id"])
             else:
                 logger.error("Internal error with card %s / bug http://bugzil.la/%s" % (card["shortUrl"], bug["id"]))
                 raise Exception("Internal error")
 
+        if queue.report() > 0:
+            logger.error("Some changes could not be applied")
+            return 1
+
         return 0
@@ -0,0 +1,414 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Compression codecs for snapshot files. The codec of a file is recorded in
+# its extension, so archives with mixed codecs can still be read. The lzma,
+# zstd and lz4 codecs need optional modules and are only available if these
+# are installed.
+
+import glob
+import logging
+import os
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+
+logger = logging.getLogger(__name__)
+
+# Size of compressed chunks read at once
+CHUNK_SIZE = 65536
+
+# Bytes needed to parse any frame header, see Codec.decompressor()
+HEADER_SIZE = 18
+
+
+class CompressedWriter(object):
+    """
+    Write-only file object compressing into a file
+    """
+
+    def __init__(self, fileobj, compressor):
+        """
+        :param fileobj: file object opened for writing
+        :param compressor: object with zlib-like compress() and flush()
+        """
+        self.fileobj = fileobj
+        self.compressor = compressor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data):
+        self.fileobj.write(self.compressor.compress(data))
+
+    def close(self):
+        if self.fileobj.closed:
+            return
+        try:
+            self.fileobj.write(self.compressor.flush())
+        finally:
+            self.fileobj.close()
+
+
+class CompressedReader(object):
+    """
+    Read-only file object decompressing a file while it is read
+    """
+
+    def __init__(self, fileobj, decompressor):
+        """
+        :param fileobj: file object opened for reading
+        :param decompressor: object with zlib-like decompress()
+        """
+        self.fileobj = fileobj
+        self.decompressor = decompressor
+        self.buffer = ""
+        self.eof = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __fill(self):
+        data = self.fileobj.read(CHUNK_SIZE)
+        if len(data) == 0:
+            self.eof = True
+            if hasattr(self.decompressor, "flush"):
+                # Some decompressors return None
+                self.buffer += self.decompressor.flush() or ""
+        else:
+            self.buffer += self.decompressor.decompress(data)
+
+    def read(self, size=-1):
+        """
+        :param size: int maximum number of bytes to read, negative to read all
+        :return: str
+        """
+        if size < 0:
+            parts = [self.buffer]
+            self.buffer = ""
+            while not self.eof:
+                self.__fill()
+                parts.append(self.buffer)
+                self.buffer = ""
+            return "".join(parts)
+        while not self.eof and len(self.buffer) < size:
+            self.__fill()
+        result, self.buffer = self.buffer[:size], self.buffer[size:]
+        return result
+
+    def readline(self):
+        while "\n" not in self.buffer and not self.eof:
+            self.__fill()
+        end = self.buffer.find("\n")
+        if end < 0:
+            return self.read()
+        result, self.buffer = self.buffer[:end + 1], self.buffer[end + 1:]
+        return result
+
+    def close(self):
+        self.fileobj.close()
+
+
+class Codec(object):
+    """
+    Base class of compression codecs. Codecs provide streaming compressor
+    and decompressor objects with interfaces like zlib's:
+    compressor(dictionary) takes a str with compression dictionary or None
+    and returns an object with compress() and flush(), and
+    decompressor(header, dictionaries) takes a str with the first bytes of
+    the compressed data and a DictionaryStore or None, and returns an object
+    with decompress() and optionally flush().
+    """
+
+    name = None
+    extension = None
+    description = None
+    module = "zlib"
+    supports_dictionary = False
+
+    def available(self):
+        return True
+
+    def open(self, file_name, mode="r", dictionaries=None):
+        """
+        Open a compressed file
+        :param file_name: str
+        :param mode: str `r` or `w`
+        :param dictionaries: DictionaryStore for codecs with dictionary support, or None
+        :return: CompressedReader or CompressedWriter
+        """
+        if not self.available():
+            raise Exception("Compression codec `%s` needs the `%s` module" % (self.name, self.module))
+        if "w" in mode:
+            dictionary = None
+            if self.supports_dictionary and dictionaries is not None:
+                dictionary = dictionaries.latest()
+            compressor = self.compressor(dictionary)
+            return CompressedWriter(open(file_name, "wb"), compressor)
+        f = open(file_name, "rb")
+        header = f.read(HEADER_SIZE)
+        f.seek(0)
+        return CompressedReader(f, self.decompressor(header, dictionaries))
+
+    def compress(self, data, dictionary=None):
+        """
+        Compress a block into a self-contained stream
+        :param data: str
+        :param dictionary: str with compression dictionary or None
+        :return: str with compressed data
+        """
+        if not self.available():
+            raise Exception("Compression codec `%s` needs the `%s` module" % (self.name, self.module))
+        compressor = self.compressor(dictionary if self.supports_dictionary else None)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data, dictionaries=None):
+        """
+        Decompress a block compressed with compress()
+        :param data: str with compressed data
+        :param dictionaries: DictionaryStore or None
+        :return: str
+        """
+        if not self.available():
+            raise Exception("Compression codec `%s` needs the `%s` module" % (self.name, self.module))
+        decompressor = self.decompressor(data[:HEADER_SIZE], dictionaries)
+        result = decompressor.decompress(data)
+        if hasattr(decompressor, "flush"):
+            result += decompressor.flush() or ""
+        return result
+
+
+class GzipCodec(Codec):
+
+    name = "gzip"
+    extension = ".gz"
+    description = "gzip, readable by any tool"
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compressor(self, dictionary=None):
+        return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def decompressor(self, header, dictionaries=None):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+class ZlibFastCodec(Codec):
+
+    name = "zlib-fast"
+    extension = ".zz"
+    description = "zlib at the fastest level"
+
+    def compressor(self, dictionary=None):
+        return zlib.compressobj(1)
+
+    def decompressor(self, header, dictionaries=None):
+        return zlib.decompressobj()
+
+
+class LzmaCodec(Codec):
+
+    name = "lzma"
+    extension = ".xz"
+    description = "xz, slow but small"
+    module = "lzma"
+
+    def available(self):
+        return lzma is not None
+
+    def compressor(self, dictionary=None):
+        return lzma.LZMACompressor()
+
+    def decompressor(self, header, dictionaries=None):
+        return lzma.LZMADecompressor()
+
+
+class ZstdCodec(Codec):
+
+    name = "zstd"
+    extension = ".zst"
+    description = "zstandard, fast and small, can use a trained dictionary"
+    module = "zstandard"
+    supports_dictionary = True
+
+    def __init__(self, level=3):
+        self.level = level
+
+    def available(self):
+        return zstandard is not None
+
+    def compressor(self, dictionary=None):
+        if dictionary is None:
+            return zstandard.ZstdCompressor(level=self.level).compressobj()
+        dictionary = zstandard.ZstdCompressionDict(dictionary)
+        return zstandard.ZstdCompressor(level=self.level, dict_data=dictionary).compressobj()
+
+    def decompressor(self, header, dictionaries=None):
+        dict_id = zstandard.get_frame_parameters(header).dict_id
+        if dict_id == 0:
+            return zstandard.ZstdDecompressor().decompressobj()
+        if dictionaries is None:
+            raise Exception("Compressed data needs zstd dictionary %d" % dict_id)
+        dictionary = zstandard.ZstdCompressionDict(dictionaries.get(dict_id))
+        return zstandard.ZstdDecompressor(dict_data=dictionary).decompressobj()
+
+
+class Lz4Compressor(object):
+    """
+    Adapts lz4 frame compression to the zlib interface
+    """
+
+    def __init__(self):
+        self.compressor = lz4frame.LZ4FrameCompressor()
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        result = self.header + self.compressor.compress(data)
+        self.header = ""
+        return result
+
+    def flush(self):
+        result = self.header + self.compressor.flush()
+        self.header = ""
+        return result
+
+
+class Lz4Codec(Codec):
+
+    name = "lz4"
+    extension = ".lz4"
+    description = "lz4, fastest to read and write"
+    module = "lz4"
+
+    def available(self):
+        return lz4frame is not None
+
+    def compressor(self, dictionary=None):
+        return Lz4Compressor()
+
+    def decompressor(self, header, dictionaries=None):
+        return lz4frame.LZ4FrameDecompressor()
+
+
+CODECS = dict([(codec.name, codec) for codec in [GzipCodec(), ZlibFastCodec(), LzmaCodec(), ZstdCodec(), Lz4Codec()]])
+
+
+def available_codecs():
+    """
+    :return: sorted list of str with names of codecs that can be used
+    """
+    return sorted([name for name, codec in CODECS.iteritems() if codec.available()])
+
+
+def get_codec(name):
+    """
+    :param name: str with codec name
+    :return: Codec
+    """
+    if name not in CODECS:
+        raise Exception("Unknown compression codec `%s`" % name)
+    return CODECS[name]
+
+
+def codec_of(file_name):
+    """
+    Codec of a compressed file, by its extension
+    :param file_name: str
+    :return: Codec or None for unknown extensions
+    """
+    extension = os.path.splitext(file_name)[1]
+    for codec in CODECS.itervalues():
+        if codec.extension == extension:
+            return codec
+    return None
+
+
+class DictionaryStore(object):
+    """
+    Directory of trained compression dictionaries. Compressed data refers
+    to dictionaries by ID, so dictionaries are kept after newer ones were
+    trained. New data is compressed with the latest dictionary.
+    """
+
+    def __init__(self, dictionary_dir):
+        self.dictionary_dir = dictionary_dir
+        self.cache = {}
+
+    def file_name(self, dict_id):
+        return os.path.join(self.dictionary_dir, "%d.dict" % dict_id)
+
+    def get(self, dict_id):
+        """
+        :param dict_id: int with dictionary ID
+        :return: str with dictionary
+        """
+        if dict_id not in self.cache:
+            try:
+                with open(self.file_name(dict_id), "rb") as f:
+                    self.cache[dict_id] = f.read()
+            except IOError:
+                raise Exception("Compression dictionary %d is missing" % dict_id)
+        return self.cache[dict_id]
+
+    def latest(self):
+        """
+        :return: str with the most recently trained dictionary or None
+        """
+        file_names = glob.glob(os.path.join(self.dictionary_dir, "*.dict"))
+        if len(file_names) == 0:
+            return None
+        latest = max(file_names, key=os.path.getmtime)
+        return self.get(int(os.path.basename(latest).split(".")[0]))
+
+    def add(self, dictionary):
+        """
+        Store a new dictionary, which becomes the latest
+        :param dictionary: str with zstd dictionary
+        :return: int with dictionary ID
+        """
+        dict_id = zstandard.ZstdCompressionDict(dictionary).dict_id()
+        if not os.path.isdir(self.dictionary_dir):
+            os.makedirs(self.dictionary_dir)
+        with open(self.file_name(dict_id), "wb") as f:
+            f.write(dictionary)
+        self.cache[dict_id] = dictionary
+        return dict_id
+
+
+def train_dictionary(samples, size):
+    """
+    Train a zstd dictionary
+    :param samples: list of str with typical data
+    :param size: int maximum dictionary size in bytes
+    :return: str with dictionary
+    """
+    if zstandard is None:
+        raise Exception("Dictionary training needs the `zstandard` module")
+    return zstandard.train_dictionary(size, samples).as_bytes()
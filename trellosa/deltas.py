@@ -0,0 +1,87 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Structural deltas between snapshots. A delta describes how to turn one
+# nested dict into another by setting and removing keys, descending into
+# dicts that exist in both. Anything else, like lists, is replaced whole.
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+DELTA_FORMAT = "trellosa-delta"
+DELTA_VERSION = 1
+
+
+def make_delta(a, b):
+    """
+    Compute the structural delta from a to b
+    :param a: dict
+    :param b: dict
+    :return: dict with delta, empty if a equals b
+    """
+    delta = {}
+    changed = {}
+    patched = {}
+    for key, value in b.iteritems():
+        if key not in a:
+            changed[key] = value
+        elif a[key] != value:
+            if isinstance(value, dict) and isinstance(a[key], dict):
+                patched[key] = make_delta(a[key], value)
+            else:
+                changed[key] = value
+    removed = [key for key in a.iterkeys() if key not in b]
+    if len(changed) > 0:
+        delta["set"] = changed
+    if len(removed) > 0:
+        delta["unset"] = sorted(removed)
+    if len(patched) > 0:
+        delta["patch"] = patched
+    return delta
+
+
+def apply_delta(data, delta):
+    """
+    Apply a structural delta. The data is not modified; unchanged parts
+    are shared between the data and the result.
+    :param data: dict
+    :param delta: dict with delta from make_delta()
+    :return: dict
+    """
+    result = dict(data)
+    for key in delta.get("unset", []):
+        del result[key]
+    for key, value in delta.get("set", {}).iteritems():
+        result[key] = value
+    for key, value in delta.get("patch", {}).iteritems():
+        result[key] = apply_delta(result[key], value)
+    return result
+
+
+def delta_size(delta):
+    """
+    Number of changed values in a delta
+    :param delta: dict with delta
+    :return: int
+    """
+    return len(delta.get("set", {})) + len(delta.get("unset", [])) \
+        + sum([delta_size(x) for x in delta.get("patch", {}).itervalues()])
+
+
+def copy_data(data):
+    """
+    Deep copy of JSON data, much faster than copy.deepcopy()
+    :param data: JSON-serializable object
+    :return: copy of data
+    """
+    if isinstance(data, dict):
+        return dict([(key, copy_data(value)) for key, value in data.iteritems()])
+    elif isinstance(data, list):
+        return [copy_data(x) for x in data]
+    else:
+        return data
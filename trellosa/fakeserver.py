@@ -0,0 +1,327 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Local fake of the Trello and Bugzilla APIs for offline benchmarks. It serves
+# a synthetic board and bugs of configurable size with injectable latency.
+# Only the API subset used by trellosa is implemented.
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import random
+from SocketServer import ThreadingMixIn
+import threading
+import time
+import urllib
+import urlparse
+
+
+logger = logging.getLogger(__name__)
+
+TRELLO_PREFIX = "/1"
+BUGZILLA_PREFIX = "/rest"
+
+# Versions of synthetic Firefox lists and bugs
+FIRST_VERSION = 50
+VERSIONS = 20
+
+FIRST_BUG_ID = 1300000
+# Bugs older than this never show up as changed in incremental searches
+BUG_CHANGE_TIME = "2018-01-01T00:00:00Z"
+
+
+class NotFound(Exception):
+    pass
+
+
+class FakeData(object):
+    """
+    Deterministic synthetic board with cards, lists and labels, and bugs
+    referenced by the cards through their security notes
+    """
+
+    def __init__(self, cards=1000, bugs=1000, board_id="5887b9767bc90fd832e669f8", seed=0):
+        rnd = random.Random(seed)
+        self.board_id = board_id
+        self.board = {"id": board_id, "name": "Fake Firefox Board", "closed": False,
+                      "url": "https://trello.com/b/fake/firefox"}
+        self.labels = [
+            {"id": "%024x" % 1, "idBoard": board_id, "name": "Security Triage: OK", "color": "green"},
+            {"id": "%024x" % 2, "idBoard": board_id, "name": "Security Triage: Action required", "color": "red"},
+            {"id": "%024x" % 3, "idBoard": board_id, "name": "Privacy", "color": "blue"}
+        ]
+        self.custom_fields = [
+            {"id": "%024x" % 10, "idModel": board_id, "modelType": "board", "name": "Security Notes",
+             "type": "text"}
+        ]
+        self.lists = [{"id": "%024x" % (100 + n), "idBoard": board_id, "closed": False, "pos": n,
+                       "name": "Firefox %d" % (FIRST_VERSION + n)} for n in xrange(VERSIONS)]
+
+        self.bugs = {}
+        for n in xrange(bugs):
+            bug_id = FIRST_BUG_ID + n
+            version = FIRST_VERSION + rnd.randrange(VERSIONS)
+            status = rnd.choice(["NEW", "ASSIGNED", "RESOLVED", "RESOLVED", "UNCONFIRMED"])
+            self.bugs[bug_id] = {
+                "id": bug_id,
+                "summary": "Risk Assessment: Feature %d" % n,
+                "status": status,
+                "resolution": rnd.choice(["FIXED", "WONTFIX", "INVALID"]) if status == "RESOLVED" else "",
+                "product": "Firefox",
+                "component": "Security: Review Requests",
+                "version": "%d Branch" % version,
+                "target_milestone": "Firefox %d" % version,
+                "whiteboard": "rra",
+                "url": "",
+                "creation_time": BUG_CHANGE_TIME,
+                "last_change_time": BUG_CHANGE_TIME
+            }
+
+        # Card IDs grow with creation time like real Trello IDs
+        self.cards = []
+        for n in xrange(cards):
+            card_id = "%024x" % (0x5a0000000000000000000000 + n)
+            card = {
+                "id": card_id,
+                "idBoard": board_id,
+                "idList": rnd.choice(self.lists)["id"],
+                "name": "Feature %d" % n,
+                "desc": "Synthetic card %d " % n + "lorem ipsum " * rnd.randrange(20),
+                "closed": False,
+                "shortUrl": "https://trello.com/c/%08d" % n,
+                "labels": [rnd.choice(self.labels)] if rnd.random() < 0.8 else [],
+                "dateLastActivity": BUG_CHANGE_TIME,
+                "customFieldItems": []
+            }
+            if n < bugs and rnd.random() < 0.9:
+                card["customFieldItems"].append({"id": "%024x" % (0x5b0000000000000000000000 + n),
+                                                 "idCustomField": self.custom_fields[0]["id"],
+                                                 "idModel": card_id, "value": {"text": "bug %d" % (FIRST_BUG_ID + n)}})
+                self.bugs[FIRST_BUG_ID + n]["url"] = card["shortUrl"]
+            self.cards.append(card)
+        # Newest first, like Trello returns them
+        self.cards.reverse()
+        self.next_bug_id = FIRST_BUG_ID + bugs
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def project(obj, fields):
+        """
+        Limit object to a comma-separated list of fields, always keeping the ID
+        :param obj: dict
+        :param fields: str or None for all fields
+        :return: dict
+        """
+        if fields is None or fields in ["all", "_all"]:
+            return obj
+        keep = set(fields.split(",")) | set(["id"])
+        return dict(filter(lambda x: x[0] in keep, obj.iteritems()))
+
+    def trello(self, method, path, params, body):
+        """
+        Answer a Trello API request
+        :return: JSON-serializable result
+        """
+        parts = filter(None, path.split("/"))
+        if method != "GET":
+            # Changes are acknowledged, but not applied
+            return {}
+        if parts == ["batch"]:
+            results = []
+            for route in params.get("urls", "").split(","):
+                route_parts = urlparse.urlsplit(urllib.unquote(route))
+                route_params = dict(urlparse.parse_qsl(route_parts.query))
+                try:
+                    results.append({"200": self.trello("GET", route_parts.path, route_params, None)})
+                except NotFound:
+                    results.append({"name": "NotFound", "message": "not found", "statusCode": 404})
+            return results
+        if len(parts) == 2 and parts[0] == "tokens":
+            return {"identifier": "TrelloSA",
+                    "permissions": [{"idModel": self.board_id, "modelType": "Board", "read": True, "write": True}]}
+        if len(parts) == 2 and parts[0] == "cards":
+            for card in self.cards:
+                if card["id"] == parts[1]:
+                    return self.card(card, params)
+            raise NotFound()
+        if len(parts) == 2 and parts[0] == "lists":
+            for l in self.lists:
+                if l["id"] == parts[1]:
+                    return l
+            raise NotFound()
+        if len(parts) < 2 or parts[0] != "boards" or parts[1] != self.board_id:
+            raise NotFound()
+        sub = "/".join(parts[2:])
+        if sub == "":
+            return self.board
+        if sub == "labels":
+            return self.labels
+        if sub == "customFields":
+            return self.custom_fields
+        if sub in ["lists", "lists/all"]:
+            return self.lists
+        if sub == "actions":
+            return []
+        if sub in ["cards", "cards/all"]:
+            cards = self.cards
+            if "before" in params:
+                cards = filter(lambda x: x["id"] < params["before"], cards)
+            if "limit" in params:
+                cards = cards[:int(params["limit"])]
+            return [self.card(card, params) for card in cards]
+        raise NotFound()
+
+    def card(self, card, params):
+        result = self.project(card, params.get("fields"))
+        if params.get("customFieldItems") == "true":
+            result["customFieldItems"] = card["customFieldItems"]
+        else:
+            result.pop("customFieldItems", None)
+        return result
+
+    def bugzilla(self, method, path, params, body):
+        """
+        Answer a Bugzilla API request
+        :return: JSON-serializable result
+        """
+        parts = filter(None, path.split("/"))
+        if parts == ["bug"] and method == "POST":
+            with self.lock:
+                bug_id = self.next_bug_id
+                self.next_bug_id += 1
+            return {"id": bug_id}
+        if len(parts) == 2 and parts[0] == "bug" and method == "PUT":
+            ids = body.get("ids", [int(parts[1])]) if body is not None else [int(parts[1])]
+            return {"bugs": [{"id": bug_id, "changes": {}} for bug_id in ids]}
+        if parts == ["bug"]:
+            bugs = sorted(self.bugs.values(), key=lambda x: x["id"])
+            if "id" in params:
+                ids = set(map(int, params["id"].split(",")))
+                bugs = filter(lambda x: x["id"] in ids, bugs)
+            if "last_change_time" in params:
+                bugs = filter(lambda x: x["last_change_time"] >= params["last_change_time"], bugs)
+            if "count_only" in params:
+                return {"bug_count": len(bugs)}
+            offset = int(params.get("offset", 0))
+            if "limit" in params:
+                bugs = bugs[offset:offset + int(params["limit"])]
+            else:
+                bugs = bugs[offset:]
+            return {"bugs": [self.project(bug, params.get("include_fields")) for bug in bugs], "faults": []}
+        if len(parts) == 2 and parts[0] == "bug":
+            bug_id = int(parts[1])
+            if bug_id not in self.bugs:
+                raise NotFound()
+            return {"bugs": [self.bugs[bug_id]], "faults": []}
+        if parts == ["product"]:
+            return {"products": [{"id": 21, "name": "Firefox"}]}
+        if len(parts) == 5 and parts[:2] == ["field", "bug"] and parts[4] == "values":
+            numbers = range(FIRST_VERSION, FIRST_VERSION + VERSIONS)
+            if parts[2] == "version":
+                return {"values": ["%d Branch" % n for n in numbers] + ["Trunk"]}
+            if parts[2] == "target_milestone":
+                return {"values": ["Firefox %d" % n for n in numbers] + ["Future"]}
+        raise NotFound()
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+
+    # Keep-alive connections, like the real APIs
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self):
+        parts = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(parts.query, keep_blank_values=True))
+        body = None
+        length = int(self.headers.get("Content-Length", 0))
+        if length > 0:
+            raw = self.rfile.read(length)
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                body = json.loads(raw)
+            else:
+                body = dict(urlparse.parse_qsl(raw))
+
+        server = self.server
+        if server.latency > 0:
+            time.sleep(server.latency * (1.0 + server.jitter * (2 * random.random() - 1)))
+        server.count_request()
+
+        try:
+            if parts.path.startswith(TRELLO_PREFIX + "/"):
+                result = server.data.trello(self.command, parts.path[len(TRELLO_PREFIX):], params, body)
+            elif parts.path.startswith(BUGZILLA_PREFIX + "/"):
+                result = server.data.bugzilla(self.command, parts.path[len(BUGZILLA_PREFIX):], params, body)
+            else:
+                raise NotFound()
+            status = 200
+        except NotFound:
+            result = {"error": True, "message": "Not found: %s" % parts.path}
+            status = 404
+
+        payload = json.dumps(result)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = handle_request
+    do_POST = handle_request
+    do_PUT = handle_request
+    do_DELETE = handle_request
+
+    def log_message(self, fmt, *args):
+        logger.debug("%s %s" % (self.address_string(), fmt % args))
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server answering Trello API requests below /1 and
+    Bugzilla API requests below /rest
+    """
+
+    daemon_threads = True
+
+    def __init__(self, data, host="localhost", port=0, latency=0.0, jitter=0.0):
+        """
+        :param data: FakeData
+        :param host: str with address to listen on
+        :param port: int with port to listen on, 0 to pick a free one
+        :param latency: float seconds to delay every response
+        :param jitter: float relative variation of latency, 0.0 to 1.0
+        """
+        HTTPServer.__init__(self, (host, port), FakeRequestHandler)
+        self.data = data
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self.counter_lock = threading.Lock()
+
+    def count_request(self):
+        with self.counter_lock:
+            self.requests += 1
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address[:2]
+
+    @property
+    def trello_url(self):
+        return self.url + TRELLO_PREFIX
+
+    @property
+    def bugzilla_url(self):
+        return self.url + BUGZILLA_PREFIX
+
+    def start(self):
+        """
+        Serve requests in a background thread
+        :return: threading.Thread
+        """
+        thread = threading.Thread(target=self.serve_forever, name="FakeServer")
+        thread.daemon = True
+        thread.start()
+        return thread
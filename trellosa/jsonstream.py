@@ -0,0 +1,136 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import codecs
+import json
+from json.decoder import WHITESPACE
+
+
+# Size of chunks to read from streamed responses
+CHUNK_SIZE = 65536
+
+
+class ArrayStream(object):
+    """
+    Incrementally decodes the items of a JSON array from chunks of bytes, so
+    items can be processed while the rest of the document is still arriving.
+    The array is either the document itself or the value of a key in the
+    top-level object, like `bugs` in Bugzilla search results. Only one item
+    is decoded at a time, so memory use is bounded by the largest item
+    rather than the whole document.
+    """
+
+    # Consumed input is dropped from the buffer once it grows beyond this size
+    TRIM_SIZE = 65536
+
+    def __init__(self, chunks, key=None):
+        """
+        :param chunks: iterable of str with raw bytes, like Response.iter_content()
+        :param key: str with key of the array in the top-level object or None
+        """
+        self.chunks = iter(chunks)
+        self.key = key
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = u""
+        self.pos = 0
+        self.eof = False
+
+    def __iter__(self):
+        return self.items()
+
+    def more(self):
+        """
+        Append the next chunk to the buffer
+        :return: bool False if the input is exhausted
+        """
+        if self.eof:
+            return False
+        if self.pos > self.TRIM_SIZE:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            self.buffer += self.utf8.decode("", final=True)
+            return False
+        self.buffer += self.utf8.decode(chunk)
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character without consuming it
+        :return: unicode character or None at the end of input
+        """
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.more():
+                return None
+
+    def expect(self, chars):
+        char = self.peek()
+        if char is None or char not in chars:
+            raise ValueError("Expected one of `%s` at offset %d, got `%s`" % (chars, self.pos, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """
+        Decode the next complete JSON value
+        :return: decoded object
+        """
+        self.peek()
+        while True:
+            try:
+                result, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if self.more():
+                    continue
+                raise
+            # Numbers and literals may continue in the next chunk
+            if end == len(self.buffer) and self.more():
+                continue
+            self.pos = end
+            return result
+
+    def items(self):
+        """
+        Decode the array items one by one
+        :return: generator of decoded items
+        """
+        if self.key is not None:
+            self.expect("{")
+            while True:
+                if self.peek() == "}":
+                    raise ValueError("Key `%s` not found in JSON object" % self.key)
+                key = self.value()
+                self.expect(":")
+                if key == self.key:
+                    break
+                self.value()
+                self.expect(",")
+
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+
+def iter_items(chunks, key=None):
+    """
+    Iterate over the items of a JSON array while it is being downloaded
+    :param chunks: iterable of str with raw bytes
+    :param key: str with key of the array in the top-level object or None
+    :return: generator of decoded items
+    """
+    return ArrayStream(chunks, key).items()
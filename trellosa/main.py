@@ -16,8 +16,14 @@ import tempfile
 import threading
 import time
 
+import bugzilla
+import cache
 import cleanup
 import command
+import metrics
+import scheduler
+import session
+import trello
 
 
 # Initialize coloredlogs
@@ -57,6 +63,103 @@ def parse_args(argv=None):
                         help="Trello board ID to query (default: 5887b9767bc90fd832e669f8)",
                         action="store",
                         default="5887b9767bc90fd832e669f8")  # The Firefox board
+    parser.add_argument("-j", "--jobs",
+                        help="Number of API requests to run in parallel when fetching online state (default: 1)",
+                        type=int,
+                        action="store",
+                        default=1)
+    parser.add_argument("--bug-page-size",
+                        help="Fetch Bugzilla search results in pages of this size (default: 500, 0 to disable)",
+                        type=lambda x: int(x) if int(x) > 0 else None,
+                        action="store",
+                        default=500)
+    parser.add_argument("--fetch-timeout",
+                        help="Seconds after which fetching online state is aborted (default: no limit)",
+                        type=float,
+                        action="store",
+                        default=None)
+    parser.add_argument("--pool-size",
+                        help="Maximum number of keep-alive connections per API host (default: 10)",
+                        type=int,
+                        action="store",
+                        default=10)
+    parser.add_argument("--trello-rate",
+                        help="Maximum Trello API requests per second (default: 9)",
+                        type=float,
+                        action="store",
+                        default=None)
+    parser.add_argument("--bugzilla-rate",
+                        help="Maximum Bugzilla API requests per second (default: 20)",
+                        type=float,
+                        action="store",
+                        default=None)
+    parser.add_argument("--max-retries",
+                        help="Maximum retries for rate-limited or failed read requests (default: 5)",
+                        type=int,
+                        action="store",
+                        default=None)
+    parser.add_argument("--breaker-threshold",
+                        help="Consecutive failures after which requests to an API fail fast, 0 to never "
+                             "fail fast (default: 5)",
+                        type=int,
+                        action="store",
+                        default=None)
+    parser.add_argument("--breaker-timeout",
+                        help="Seconds to fail fast before trying a failing API again (default: 30)",
+                        type=float,
+                        action="store",
+                        default=None)
+    parser.add_argument("--metadata-ttl",
+                        help="Seconds to use cached board and bug metadata without revalidation (default: 3600)",
+                        type=float,
+                        action="store",
+                        default=cache.DEFAULT_TTL)
+    parser.add_argument("--field-values-ttl",
+                        help="Seconds to use cached Bugzilla field values without revalidation (default: 86400)",
+                        type=float,
+                        action="store",
+                        default=cache.DEFAULT_FIELD_VALUES_TTL)
+    parser.add_argument("--max-age",
+                        help="Reuse online state fetched up to this many seconds ago in read-only commands "
+                             "(default: 0, always fetch)",
+                        type=float,
+                        action="store",
+                        default=0)
+    parser.add_argument("--no-cache",
+                        help="Do not cache board and bug metadata",
+                        action="store_true")
+    parser.add_argument("--timeout",
+                        help="Timeout for API requests in seconds (default: 60)",
+                        type=float,
+                        action="store",
+                        default=60)
+    parser.add_argument("--trello-url",
+                        help="Base URL of the Trello API, for example of a fake server (default: %s)"
+                             % trello.TrelloClient.BASE_URL,
+                        action="store",
+                        default=None)
+    parser.add_argument("--bugzilla-url",
+                        help="Base URL of the Bugzilla API, for example of a fake server (default: %s)"
+                             % bugzilla.BugzillaClient.API_URL,
+                        action="store",
+                        default=None)
+    parser.add_argument("--metrics",
+                        help="Write API request metrics to a file, as JSON if it ends in .json, "
+                             "else in Prometheus text format. Use `-` to log a summary instead",
+                        metavar="FILE",
+                        action="store",
+                        default=None)
+    transport_group = parser.add_mutually_exclusive_group()
+    transport_group.add_argument("--record",
+                                 help="Record all API traffic to this directory",
+                                 type=os.path.abspath,
+                                 action="store",
+                                 default=None)
+    transport_group.add_argument("--replay",
+                                 help="Answer API requests from traffic recorded to this directory",
+                                 type=os.path.abspath,
+                                 action="store",
+                                 default=None)
 
     # Set up subparsers, one for each subcommand
     subparsers = parser.add_subparsers(help="Subcommand", dest="command")
@@ -109,6 +212,14 @@ def main(argv=None):
     logger.debug("Command arguments: %s" % args)
 
     cleanup.init()
+    session.configure(pool_maxsize=max(args.pool_size, args.jobs), timeout=args.timeout,
+                      record_dir=args.record, replay_dir=args.replay)
+    session.set_base_url("trello", args.trello_url)
+    session.set_base_url("bugzilla", args.bugzilla_url)
+    scheduler.configure("trello", rate=args.trello_rate, max_retries=args.max_retries,
+                        failure_threshold=args.breaker_threshold, reset_timeout=args.breaker_timeout)
+    scheduler.configure("bugzilla", rate=args.bugzilla_rate, max_retries=args.max_retries,
+                        failure_threshold=args.breaker_threshold, reset_timeout=args.breaker_timeout)
     tmp_dir = __create_tempdir()
 
     # Create workdir (usually ~/.trellosa, used for caching etc.)
@@ -117,6 +228,14 @@ def main(argv=None):
         logger.debug('Creating working directory %s' % args.workdir)
         os.makedirs(args.workdir)
 
+    # Cached metadata would change the sequence of requests while recording and
+    # replaying, and must not mix with data of other API servers.
+    if args.record is not None or args.replay is not None or \
+            args.trello_url is not None or args.bugzilla_url is not None:
+        logger.debug("Not caching metadata for recorded or non-default API endpoints")
+    elif not args.no_cache:
+        cache.configure(args.workdir, ttl=args.metadata_ttl, field_values_ttl=args.field_values_ttl)
+
     # Execute the specified command
     try:
         result = command.run(args, tmp_dir)
@@ -125,6 +244,12 @@ def main(argv=None):
         logger.critical("\nUser interrupt. Quitting...")
         return 10
 
+    for upstream, counters in scheduler.counters().iteritems():
+        logger.debug("Request counters for %s: %s" % (upstream, counters))
+
+    if args.metrics is not None:
+        metrics.report(args.metrics)
+
     if len(threading.enumerate()) > 1:
         logger.info("Waiting for background threads to finish")
         while len(threading.enumerate()) > 1:
@@ -0,0 +1,247 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import logging
+import re
+import threading
+import urlparse
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of latency histogram buckets in seconds
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf")]
+
+# Path segments that are IDs or tokens rather than part of the endpoint
+ID_PATTERN = re.compile(r"^([0-9]+|[0-9a-f]{24}|[0-9a-zA-Z]{64})$")
+
+
+def endpoint_name(method, url):
+    """
+    Name of the API endpoint of a request, with IDs in the path replaced
+    by a placeholder, like `GET /1/cards/{id}`
+    :param method: str with HTTP method
+    :param url: str
+    :return: str
+    """
+    segments = urlparse.urlsplit(url).path.split("/")
+    # The first segment is the API prefix, like the version in `/1/cards/{id}`
+    segments = segments[:2] + ["{id}" if ID_PATTERN.match(segment) else segment for segment in segments[2:]]
+    return "%s %s" % (method.upper(), "/".join(segments))
+
+
+def response_size(response):
+    """
+    Size of a response body. This is the size on the wire if the server
+    sent a Content-Length, or else the size of the decoded body if it was
+    already read. Streamed bodies of unknown length count as zero.
+    :param response: requests.Response
+    :return: int
+    """
+    length = response.headers.get("Content-Length")
+    if length is not None and length.isdigit():
+        return int(length)
+    if response._content_consumed and response._content:
+        return len(response._content)
+    return 0
+
+
+def request_size(response):
+    body = response.request.body if response.request is not None else None
+    return len(body) if body is not None else 0
+
+
+class EndpointMetrics(object):
+    """
+    Request metrics of one endpoint of one upstream API
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.statuses = {}
+        self.retries = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, status, latency, sent, received):
+        self.requests += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.request_bytes += sent
+        self.response_bytes += received
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        for number, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.latency_buckets[number] += 1
+                break
+
+    def percentile(self, fraction):
+        """
+        Estimate a latency percentile from the histogram
+        :param fraction: float between 0 and 1
+        :return: float with upper bound of the bucket holding the percentile
+        """
+        if self.requests == 0:
+            return 0.0
+        rank = fraction * self.requests
+        seen = 0
+        for number, count in enumerate(self.latency_buckets):
+            seen += count
+            if seen >= rank:
+                return min(LATENCY_BUCKETS[number], self.latency_max)
+        return self.latency_max
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "statuses": dict([(str(status), count) for status, count in self.statuses.iteritems()]),
+            "retries": self.retries,
+            "request_bytes": self.request_bytes,
+            "response_bytes": self.response_bytes,
+            "latency_sum": self.latency_sum,
+            "latency_max": self.latency_max,
+            "latency_buckets": dict([(str(bound), count)
+                                     for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets)])
+        }
+
+
+class Registry(object):
+    """
+    Thread-safe collection of request metrics by upstream API and endpoint
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def __get(self, upstream, endpoint):
+        key = (upstream, endpoint)
+        if key not in self.endpoints:
+            self.endpoints[key] = EndpointMetrics()
+        return self.endpoints[key]
+
+    def record(self, upstream, method, url, response, latency):
+        """
+        Record a request and its response
+        :param upstream: str with upstream name
+        :param method: str with HTTP method
+        :param url: str
+        :param response: requests.Response or None if the request failed without response
+        :param latency: float seconds until the response arrived
+        :return: None
+        """
+        endpoint = endpoint_name(method, url)
+        if response is None:
+            status, sent, received = "error", 0, 0
+        else:
+            status, sent, received = response.status_code, request_size(response), response_size(response)
+        with self.lock:
+            self.__get(upstream, endpoint).add(status, latency, sent, received)
+
+    def record_retry(self, upstream, method, url):
+        with self.lock:
+            self.__get(upstream, endpoint_name(method, url)).retries += 1
+
+    def as_dict(self):
+        """
+        :return: dict mapping upstream names to dicts mapping endpoints to metrics
+        """
+        with self.lock:
+            result = {}
+            for (upstream, endpoint), metrics in self.endpoints.iteritems():
+                result.setdefault(upstream, {})[endpoint] = metrics.as_dict()
+            return result
+
+    def summary(self):
+        """
+        Human-readable table of metrics, slowest endpoints first
+        :return: str
+        """
+        with self.lock:
+            rows = sorted(self.endpoints.iteritems(), key=lambda x: x[1].latency_sum, reverse=True)
+            lines = ["%-9s %-55s %6s %6s %8s %8s %8s %10s %s"
+                     % ("upstream", "endpoint", "count", "retry", "total_s", "p50_s", "p95_s", "recv_kB", "statuses")]
+            for (upstream, endpoint), m in rows:
+                statuses = ",".join(["%s:%d" % x for x in sorted(m.statuses.iteritems())])
+                lines.append("%-9s %-55s %6d %6d %8.2f %8.2f %8.2f %10.1f %s"
+                             % (upstream, endpoint, m.requests, m.retries, m.latency_sum, m.percentile(0.5),
+                                m.percentile(0.95), m.response_bytes / 1024.0, statuses))
+            return "\n".join(lines)
+
+    def prometheus(self):
+        """
+        Metrics in the Prometheus text exposition format
+        :return: str
+        """
+        def labels(upstream, endpoint, **extra):
+            pairs = [("upstream", upstream), ("endpoint", endpoint)] + sorted(extra.items())
+            return "{%s}" % ",".join(['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                                      for k, v in pairs])
+
+        with self.lock:
+            items = sorted(self.endpoints.iteritems())
+            lines = ["# HELP trellosa_requests_total API requests by response status",
+                     "# TYPE trellosa_requests_total counter"]
+            for (upstream, endpoint), m in items:
+                for status, count in sorted(m.statuses.iteritems()):
+                    lines.append("trellosa_requests_total%s %d" % (labels(upstream, endpoint, status=status), count))
+            lines += ["# HELP trellosa_request_retries_total Retried API requests",
+                      "# TYPE trellosa_request_retries_total counter"]
+            for (upstream, endpoint), m in items:
+                lines.append("trellosa_request_retries_total%s %d" % (labels(upstream, endpoint), m.retries))
+            for name, attribute in [("request", "request_bytes"), ("response", "response_bytes")]:
+                lines += ["# HELP trellosa_%s_bytes_total Bytes of API %s bodies" % (name, name),
+                          "# TYPE trellosa_%s_bytes_total counter" % name]
+                for (upstream, endpoint), m in items:
+                    lines.append("trellosa_%s_bytes_total%s %d"
+                                 % (name, labels(upstream, endpoint), getattr(m, attribute)))
+            lines += ["# HELP trellosa_request_duration_seconds API request latency",
+                      "# TYPE trellosa_request_duration_seconds histogram"]
+            for (upstream, endpoint), m in items:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, m.latency_buckets):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append("trellosa_request_duration_seconds_bucket%s %d"
+                                 % (labels(upstream, endpoint, le=le), cumulative))
+                lines.append("trellosa_request_duration_seconds_sum%s %f" % (labels(upstream, endpoint), m.latency_sum))
+                lines.append("trellosa_request_duration_seconds_count%s %d" % (labels(upstream, endpoint), m.requests))
+            return "\n".join(lines) + "\n"
+
+
+__registry = Registry()
+
+
+def get_registry():
+    """
+    Return the process-wide metrics registry
+    :return: Registry
+    """
+    return __registry
+
+
+def report(target):
+    """
+    Output collected metrics
+    :param target: str `-` to log a summary, or path of a file to write.
+        Files ending in `.json` get JSON, others the Prometheus text format.
+    :return: None
+    """
+    registry = get_registry()
+    if target == "-":
+        logger.info("API request metrics:\n%s" % registry.summary())
+    elif target.endswith(".json"):
+        with open(target, "w") as f:
+            json.dump(registry.as_dict(), f, indent=4, sort_keys=True)
+        logger.info("Wrote API request metrics to `%s`" % target)
+    else:
+        with open(target, "w") as f:
+            f.write(registry.prometheus())
+        logger.info("Wrote API request metrics to `%s`" % target)
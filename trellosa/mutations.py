@@ -0,0 +1,140 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import Queue
+import threading
+
+from trellosa import cleanup
+
+
+logger = logging.getLogger(__name__)
+
+# Queues that still need draining on exit
+__active_queues = set()
+__lock = threading.Lock()
+
+
+class MutationQueue(object):
+    """
+    Applies confirmed changes to Trello and Bugzilla in the background on a
+    small pool of workers. Mutations with the same key, like all changes to
+    one card, always run in the order they were submitted. Once a mutation
+    fails, later mutations with the same key are skipped.
+    """
+
+    def __init__(self, workers=2):
+        self.lanes = [Queue.Queue() for _ in xrange(max(1, workers))]
+        self.results = []
+        self.failed_keys = set()
+        self.lock = threading.Lock()
+        self.threads = []
+        for number, lane in enumerate(self.lanes):
+            thread = threading.Thread(target=self.__work, args=(lane,), name="MutationWorker-%d" % number)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        register(self)
+
+    def __work(self, lane):
+        while True:
+            job = lane.get()
+            try:
+                if job is None:
+                    return
+                self.__run(*job)
+            finally:
+                lane.task_done()
+
+    def __run(self, key, description, call, args, kwargs):
+        with self.lock:
+            skip = key in self.failed_keys
+        if skip:
+            logger.debug("Skipping `%s` after earlier failure" % description)
+            result = {"key": key, "description": description, "ok": False, "error": "Skipped after earlier failure"}
+        else:
+            try:
+                result = {"key": key, "description": description, "ok": True, "result": call(*args, **kwargs)}
+                logger.debug("Done: %s" % description)
+            except Exception as e:
+                logger.debug("Failed: %s: %s" % (description, e))
+                result = {"key": key, "description": description, "ok": False, "error": str(e)}
+        with self.lock:
+            if not result["ok"]:
+                self.failed_keys.add(key)
+            self.results.append(result)
+
+    def submit(self, key, description, call, *args, **kwargs):
+        """
+        Queue a mutation
+        :param key: str with key, mutations with the same key are ordered
+        :param description: str describing the mutation for the final report
+        :param call: callable applying the mutation
+        :return: None
+        """
+        lane = self.lanes[hash(key) % len(self.lanes)]
+        lane.put((key, description, call, args, kwargs))
+
+    def drain(self):
+        """
+        Wait until all queued mutations have been applied and stop the workers
+        :return: list of result dicts with `key`, `description`, `ok`, and `result` or `error`
+        """
+        if len(self.threads) > 0:
+            pending = sum([lane.qsize() for lane in self.lanes])
+            if pending > 0:
+                logger.info("Waiting for %d pending changes to be applied" % pending)
+            for lane in self.lanes:
+                lane.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+            unregister(self)
+        return list(self.results)
+
+    def report(self):
+        """
+        Drain the queue and log the results
+        :return: int number of failed mutations
+        """
+        results = self.drain()
+        failed = filter(lambda x: not x["ok"], results)
+        for result in results:
+            if result["ok"]:
+                logger.info("Done: %s" % result["description"])
+            else:
+                logger.error("Failed: %s: %s" % (result["description"], result["error"]))
+        return len(failed)
+
+
+def register(queue):
+    with __lock:
+        __active_queues.add(queue)
+
+
+def unregister(queue):
+    with __lock:
+        __active_queues.discard(queue)
+
+
+def drain_all():
+    """
+    Apply pending mutations of all active queues and log the results
+    :return: None
+    """
+    with __lock:
+        queues = list(__active_queues)
+    for queue in queues:
+        queue.report()
+
+
+class DrainMutationQueues(cleanup.CleanUp):
+    """
+    Cleanup helper that applies pending mutations prior to exit
+    """
+    @staticmethod
+    def at_exit():
+        drain_all()
@@ -0,0 +1,386 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Content-addressed storage for snapshots. Snapshots are split into objects
+# like single cards and bugs, which are stored once by the hash of their
+# content. A snapshot is then stored as a manifest of object hashes, so
+# objects that did not change between snapshots take no extra space. Most
+# manifests are stored as diffs against the previous one, so they only grow
+# with the number of changed objects.
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import types
+import zlib
+
+import trellosa.deltas as deltas
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FORMAT = "trellosa-manifest"
+MANIFEST_VERSION = 2
+
+
+def encode(obj):
+    """
+    Canonical JSON encoding of an object and its hash
+    :param obj: JSON-serializable object
+    :return: tuple of str with hash and str with JSON
+    """
+    data = json.dumps(obj, sort_keys=True, separators=(",", ":"))
+    if isinstance(data, unicode):
+        data = data.encode("utf-8")
+    return hashlib.sha1(data).hexdigest(), data
+
+
+def write_json(file_name, data):
+    """Write JSON file atomically"""
+    fd, tmp_file_name = tempfile.mkstemp(dir=os.path.dirname(file_name), prefix=".tmp_")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f, sort_keys=True)
+    os.rename(tmp_file_name, file_name)
+
+
+class ObjectStore(object):
+    """
+    Objects addressed by the SHA1 of their canonical JSON encoding. Objects
+    are stored zlib-compressed in pack files, one per batch of new objects,
+    rather than one file each, which would waste a file system block per
+    object. Every pack has an index file mapping hashes to offsets. Objects
+    may be read from several threads, which share the open pack files.
+    """
+
+    def __init__(self, object_dir):
+        self.object_dir = object_dir
+        if not os.path.isdir(object_dir):
+            os.makedirs(object_dir)
+        self.__index = None
+        self.__pack_files = {}
+        self.lock = threading.RLock()
+
+    @property
+    def index(self):
+        """
+        :return: dict mapping object hashes to tuples of pack name, offset and length
+        """
+        with self.lock:
+            if self.__index is None:
+                index = {}
+                for pack_name in self.packs():
+                    with open(self.pack_file_name(pack_name, ".idx")) as f:
+                        for object_hash, (offset, length) in json.load(f).iteritems():
+                            index[object_hash] = (pack_name, offset, length)
+                self.__index = index
+            return self.__index
+
+    def packs(self):
+        """
+        Names of complete packs. Packs are complete once their index exists.
+        :return: list of str
+        """
+        return sorted([os.path.basename(x)[:-4] for x in glob.glob(os.path.join(self.object_dir, "pack-*.idx"))])
+
+    def pack_file_name(self, pack_name, extension=".pack"):
+        return os.path.join(self.object_dir, pack_name + extension)
+
+    def __contains__(self, object_hash):
+        return object_hash in self.index
+
+    def writer(self):
+        """
+        Start a batch of new objects, see PackWriter
+        :return: PackWriter
+        """
+        return PackWriter(self)
+
+    def add_pack(self, pack_name, entries):
+        """
+        Register a pack written by PackWriter
+        :param pack_name: str
+        :param entries: dict mapping object hashes to tuples of offset and length
+        :return: None
+        """
+        with self.lock:
+            write_json(self.pack_file_name(pack_name, ".idx"), entries)
+            for object_hash, (offset, length) in entries.iteritems():
+                self.index[object_hash] = (pack_name, offset, length)
+
+    def read_raw(self, object_hash):
+        with self.lock:
+            pack_name, offset, length = self.index[object_hash]
+            if pack_name not in self.__pack_files:
+                self.__pack_files[pack_name] = open(self.pack_file_name(pack_name), "rb")
+            f = self.__pack_files[pack_name]
+            f.seek(offset)
+            return f.read(length)
+
+    def get(self, object_hash):
+        """
+        Load an object by hash
+        :param object_hash: str
+        :return: decoded object
+        """
+        return json.loads(zlib.decompress(self.read_raw(object_hash)).decode("utf-8"))
+
+    def hashes(self):
+        """
+        All stored object hashes
+        :return: list of str
+        """
+        return self.index.keys()
+
+    def close(self):
+        with self.lock:
+            for f in self.__pack_files.itervalues():
+                f.close()
+            self.__pack_files = {}
+
+    def remove_unreferenced(self, referenced):
+        """
+        Delete all objects that are not referenced anymore. Packs without
+        referenced objects are deleted, others are rewritten if necessary.
+        :param referenced: set of str with hashes to keep
+        :return: int number of deleted objects
+        """
+        removed = 0
+        by_pack = {}
+        for object_hash, (pack_name, _, _) in self.index.items():
+            by_pack.setdefault(pack_name, []).append(object_hash)
+        for pack_name, hashes in by_pack.iteritems():
+            keep = filter(lambda x: x in referenced, hashes)
+            if len(keep) == len(hashes):
+                continue
+            kept = [(object_hash, self.read_raw(object_hash)) for object_hash in keep]
+            for object_hash in hashes:
+                del self.index[object_hash]
+            with self.writer() as writer:
+                for object_hash, data in kept:
+                    writer.put_raw(object_hash, data)
+            self.close()
+            os.remove(self.pack_file_name(pack_name, ".idx"))
+            os.remove(self.pack_file_name(pack_name))
+            removed += len(hashes) - len(keep)
+        # Packs left incomplete by interrupted writes
+        complete = set(self.packs())
+        for file_name in glob.glob(os.path.join(self.object_dir, "pack-*.pack")):
+            if os.path.basename(file_name)[:-5] not in complete:
+                os.remove(file_name)
+        self.__index = None
+        return removed
+
+
+class PackWriter(object):
+    """
+    Context manager writing new objects to a pack of an ObjectStore.
+    Objects that are already stored are skipped.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.pack_name = None
+        self.file = None
+        self.entries = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.file is None:
+            return
+        self.file.close()
+        if exc_type is None:
+            self.store.add_pack(self.pack_name, self.entries)
+        else:
+            os.remove(self.store.pack_file_name(self.pack_name))
+
+    def put_raw(self, object_hash, data):
+        if object_hash in self.entries or object_hash in self.store:
+            return
+        if self.file is None:
+            fd, file_name = tempfile.mkstemp(dir=self.store.object_dir, prefix="pack-", suffix=".pack")
+            self.file = os.fdopen(fd, "wb")
+            self.pack_name = os.path.basename(file_name)[:-5]
+        self.entries[object_hash] = (self.file.tell(), len(data))
+        self.file.write(data)
+
+    def put(self, obj):
+        """
+        Store an object unless it already exists
+        :param obj: JSON-serializable object
+        :return: str with object hash
+        """
+        object_hash, data = encode(obj)
+        if object_hash not in self.entries and object_hash not in self.store:
+            self.put_raw(object_hash, zlib.compress(data, 6))
+        return object_hash
+
+
+def is_collection(data):
+    """
+    Collections are sections that map IDs to objects, like cards or bugs
+    :param data: object
+    :return: bool
+    """
+    if isinstance(data, types.GeneratorType):
+        return True
+    return isinstance(data, dict) and len(data) > 0 and all([isinstance(x, dict) for x in data.itervalues()])
+
+
+class Deferred(object):
+    """
+    Value in streamed snapshot data that can only be computed once the rest
+    of the data was consumed, like bugs referenced by streamed cards, see
+    ordered_items()
+    """
+
+    def __init__(self, function):
+        """
+        :param function: callable returning the value
+        """
+        self.function = function
+
+    def resolve(self):
+        return self.function()
+
+
+def is_deferred(data, depth=2):
+    """
+    Check whether snapshot data is or holds a deferred value
+    :param data: snapshot data
+    :param depth: int levels of dicts to descend into
+    :return: bool
+    """
+    if isinstance(data, Deferred):
+        return True
+    elif isinstance(data, dict) and depth > 0:
+        return any([is_deferred(value, depth - 1) for value in data.itervalues()])
+    return False
+
+
+def ordered_items(data, depth=2):
+    """
+    Items of a dict in snapshot data, sorted by key, with the items holding
+    deferred values last. Deferred values of the dict are all resolved once
+    the other items were consumed, before any of them is returned.
+    :param data: dict
+    :param depth: int levels of dicts below data to look for deferred values
+    :return: generator of (key, value) pairs
+    """
+    keys = sorted(data.keys())
+    late = [key for key in keys if is_deferred(data[key], depth)]
+    for key in keys:
+        if key not in late:
+            yield key, data[key]
+    resolved = [(key, data[key].resolve() if isinstance(data[key], Deferred) else data[key]) for key in late]
+    for key, value in resolved:
+        yield key, value
+
+
+def split(data, store, depth=2):
+    """
+    Store snapshot data as objects. Dicts are descended into up to the given
+    depth, where collections are stored as one object per item and anything
+    else as one object. Generators of (key, value) pairs count as collections
+    and are consumed item by item.
+    :param data: snapshot data
+    :param store: PackWriter
+    :param depth: int levels of dicts to descend into
+    :return: dict with manifest node
+    """
+    if depth == 0 and is_collection(data):
+        items = data if isinstance(data, types.GeneratorType) else data.iteritems()
+        return {"objects": dict([(key, store.put(value)) for key, value in items])}
+    elif isinstance(data, dict) and depth > 0:
+        return {"sections": dict([(key, split(value, store, depth - 1))
+                                  for key, value in ordered_items(data, depth - 1)])}
+    else:
+        return {"object": store.put(data)}
+
+
+def join(node, store):
+    """
+    Reassemble snapshot data from a manifest node
+    :param node: dict with manifest node
+    :param store: ObjectStore
+    :return: snapshot data
+    """
+    if "objects" in node:
+        return dict([(key, store.get(object_hash)) for key, object_hash in node["objects"].iteritems()])
+    elif "sections" in node:
+        return dict([(key, join(value, store)) for key, value in node["sections"].iteritems()])
+    else:
+        return store.get(node["object"])
+
+
+def references(node):
+    """
+    All object hashes referenced by a manifest node
+    :param node: dict with manifest node
+    :return: set of str
+    """
+    if "objects" in node:
+        return set(node["objects"].itervalues())
+    elif "sections" in node:
+        result = set()
+        for value in node["sections"].itervalues():
+            result |= references(value)
+        return result
+    else:
+        return set([node["object"]])
+
+
+def store_snapshot(store, data):
+    """
+    Store a snapshot as objects
+    :param store: ObjectStore
+    :param data: dict with snapshot data, may contain generators
+    :return: dict with manifest node, see split()
+    """
+    with store.writer() as writer:
+        return split(data, writer)
+
+
+def load_snapshot(store, root):
+    """
+    Reassemble a snapshot from its manifest node
+    :param store: ObjectStore
+    :param root: dict with manifest node, see split()
+    :return: dict with snapshot data
+    """
+    return join(root, store)
+
+
+def make_manifest(root, base=None, base_root=None, depth=0):
+    """
+    Build a manifest with the full manifest node, or with a diff against
+    the manifest node of a base snapshot
+    :param root: dict with manifest node, see split()
+    :param base: str with handle of the base snapshot, or None for a full manifest
+    :param base_root: dict with manifest node of the base snapshot
+    :param depth: int number of diffs since the last full manifest
+    :return: dict with manifest
+    """
+    manifest = {"format": MANIFEST_FORMAT, "version": MANIFEST_VERSION, "base": base, "depth": depth}
+    if base is None:
+        manifest["root"] = root
+    else:
+        manifest["diff"] = deltas.make_delta(base_root, root)
+    return manifest
+
+
+def check_manifest(manifest):
+    """
+    Raise for manifests of unknown formats. Manifests of version 1 are always full.
+    :param manifest: dict with manifest
+    :return: None
+    """
+    if manifest.get("format") != MANIFEST_FORMAT or manifest.get("version") not in [1, MANIFEST_VERSION]:
+        raise Exception("Unsupported snapshot manifest format")
@@ -0,0 +1,44 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+def call_all(calls, jobs=1):
+    """
+    Run a number of independent calls, optionally in parallel.
+    The first exception raised by any call is re-raised after all
+    calls have finished.
+    :param calls: dict mapping names to argument-less callables
+    :param jobs: int maximum number of calls to run at the same time
+    :return: dict mapping the same names to call results
+    """
+    if jobs is None or jobs <= 1 or len(calls) <= 1:
+        return dict([(name, call()) for name, call in calls.iteritems()])
+
+    workers = min(jobs, len(calls))
+    logger.debug("Running %d calls with %d workers" % (len(calls), workers))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict([(name, executor.submit(call)) for name, call in calls.iteritems()])
+        return dict([(name, future.result()) for name, future in futures.iteritems()])
+
+
+def merge(results):
+    """
+    Merge dict results of several calls into one dict
+    :param results: dict or list of dicts to merge
+    :return: dict
+    """
+    if isinstance(results, dict):
+        results = results.values()
+    merged = {}
+    for result in results:
+        merged.update(result)
+    return merged
@@ -0,0 +1,64 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Field projection profiles limit the card and bug fields requested from the APIs
+# to what a command actually reads. Trello always includes card IDs.
+PROFILES = {
+    "full": {
+        "card_fields": "all",
+        "custom_field_items": True,
+        "bug_fields": "_all"
+    },
+    "triage": {
+        "card_fields": "closed,desc,idBoard,idList,labels,name,shortUrl",
+        "custom_field_items": True,
+        "bug_fields": "id,resolution,status,summary,target_milestone,url,version"
+    },
+    "stats": {
+        "card_fields": "closed,idBoard,idList,labels,name,shortUrl",
+        "custom_field_items": False,
+        "bug_fields": "id,resolution,status,target_milestone,url,version"
+    }
+}
+
+DEFAULT_PROFILE = "full"
+
+
+def get_profile(name):
+    """
+    Return field projection profile by name
+    :param name: str with profile name or None for default
+    :return: dict with profile
+    """
+    if name is None:
+        name = DEFAULT_PROFILE
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise Exception("Unknown projection profile `%s`. Choose one of: %s"
+                        % (name, ", ".join(sorted(PROFILES.keys()))))
+
+
+def card_params(name):
+    """
+    Query parameters for fetching cards with a given profile
+    :param name: str with profile name
+    :return: dict
+    """
+    profile = get_profile(name)
+    return {
+        "fields": profile["card_fields"],
+        "customFieldItems": "true" if profile["custom_field_items"] else "false"
+    }
+
+
+def bug_fields(name):
+    """
+    Value of `include_fields` for fetching bugs with a given profile
+    :param name: str with profile name
+    :return: str
+    """
+    return get_profile(name)["bug_fields"]
@@ -0,0 +1,379 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from email.utils import mktime_tz, parsedate_tz
+import logging
+import random
+import re
+import requests
+import threading
+import time
+
+import trellosa.metrics as metrics
+import trellosa.transport as transport
+
+
+logger = logging.getLogger(__name__)
+
+# Query parameters with credentials, see scrub_secrets()
+SECRET_PATTERN = re.compile(r"\b(api_key|key|token)=[^&\s'\"]+")
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket limiting the rate of requests
+    """
+
+    def __init__(self, rate, burst):
+        """
+        :param rate: float with tokens added per second
+        :param burst: int maximum number of tokens that can be saved up
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.time()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def __refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        """
+        Take a token, blocking until one is available
+        :return: float with seconds spent waiting
+        """
+        with self.lock:
+            now = time.time()
+            self.__refill(now)
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, self.paused_until - now, 0.0)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """
+        Hand out no tokens for the given time
+        :param seconds: float
+        :return: None
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.__refill(time.time())
+            self.rate = float(rate)
+            if burst is not None:
+                self.burst = burst
+                self.tokens = min(self.tokens, burst)
+
+
+def scrub_secrets(text):
+    """
+    Mask credentials in URLs quoted by error messages
+    :param text: str
+    :return: str
+    """
+    return SECRET_PATTERN.sub(r"\1=***", text)
+
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header value
+    :param value: str with delay in seconds or HTTP date
+    :return: float with seconds to wait or None
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, mktime_tz(parsed) - time.time())
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """
+    Raised instead of sending requests to an upstream that is considered down
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Thread-safe circuit breaker for an upstream API. After a number of
+    consecutive failures the circuit opens and requests fail fast. Once the
+    reset timeout has passed, a single trial request is let through, which
+    closes the circuit if it succeeds and opens it again if it fails.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        """
+        :param name: str with upstream name
+        :param failure_threshold: int consecutive failures that open the circuit, 0 to never open
+        :param reset_timeout: float seconds before a trial request is let through
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Check whether a request may be sent, raising CircuitOpenError if not
+        :return: None
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.time() - self.opened_at >= self.reset_timeout and not self.trial_running:
+                logger.debug("Sending trial request to %s" % self.name)
+                self.trial_running = True
+                return
+        raise CircuitOpenError("%s is unavailable, not sending requests for up to %.0fs after %d failures"
+                               % (self.name, self.reset_timeout, self.failures))
+
+    def succeeded(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info("%s is available again" % self.name)
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def release(self):
+        """
+        End a request without judging the upstream, like after errors of our own
+        :return: None
+        """
+        with self.lock:
+            self.trial_running = False
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failure_threshold > 0 and self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.error("%s failed %d times in a row, failing fast for %.0fs"
+                                 % (self.name, self.failures, self.reset_timeout))
+                self.opened_at = time.time()
+
+
+class RequestScheduler(object):
+    """
+    Sends requests for one upstream API at a safe rate. Requests are spaced
+    by a token bucket, rate limit response headers pause the bucket when a
+    limit is exhausted, and idempotent requests rejected with HTTP 429 are
+    retried with jittered exponential backoff. So are idempotent requests
+    that fail with server or connection errors, and a circuit breaker stops
+    sending requests when the upstream seems to be down.
+    """
+
+    IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS"]
+
+    # Server errors which are likely transient
+    RETRY_STATUS_CODES = [500, 502, 503, 504]
+
+    # Trello reports limits per token and per API key
+    RATE_LIMIT_HEADERS = ["x-rate-limit-api-token", "x-rate-limit-api-key", "x-rate-limit"]
+
+    def __init__(self, name, rate, burst, max_retries=5, backoff=1.0, max_backoff=60.0, breaker=None):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        if breaker is None:
+            breaker = CircuitBreaker(name)
+        self.breaker = breaker
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.counters = {
+            "requests": 0,
+            "throttled": 0,
+            "errors": 0,
+            "retries": 0,
+            "failed": 0,
+            "wait_time": 0.0
+        }
+
+    def count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def retry_delay(self, response, attempt):
+        """
+        Seconds to wait before retrying a rejected request
+        :param response: requests.Response or None
+        :param attempt: int number of previous retries
+        :return: float
+        """
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+        return delay
+
+    def observe(self, response):
+        """
+        Pause the bucket if rate limit headers say that a limit is exhausted
+        :param response: requests.Response
+        :return: None
+        """
+        for prefix in self.RATE_LIMIT_HEADERS:
+            remaining = response.headers.get(prefix + "-remaining")
+            interval_ms = response.headers.get(prefix + "-interval-ms")
+            if remaining is None or interval_ms is None:
+                continue
+            try:
+                remaining = int(remaining)
+                interval = int(interval_ms) / 1000.0
+            except ValueError:
+                continue
+            if remaining <= 0:
+                logger.debug("%s rate limit `%s` exhausted, pausing for %.1fs" % (self.name, prefix, interval))
+                self.bucket.pause(interval)
+
+    def send(self, session, method, url, **kwargs):
+        """
+        Send request through session, respecting rate limits
+        :param session: requests.Session
+        :param method: str with HTTP method
+        :param url: str
+        :param kwargs: passed on to session.request()
+        :return: requests.Response, which may still be an HTTP 429 or server error
+        """
+        idempotent = method.upper() in self.IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            self.breaker.allow()
+            self.count("wait_time", self.bucket.acquire())
+            self.count("requests")
+            start = time.time()
+            try:
+                response = session.request(method, url, **kwargs)
+            except transport.CassetteMiss:
+                metrics.get_registry().record(self.name, method, url, None, time.time() - start)
+                self.count("failed")
+                self.breaker.release()
+                raise
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.get_registry().record(self.name, method, url, None, time.time() - start)
+                self.count("errors")
+                self.breaker.failed()
+                if not idempotent or attempt >= self.max_retries:
+                    self.count("failed")
+                    raise
+                delay = self.retry_delay(None, attempt)
+                logger.warning("%s request failed with `%s`, retrying %s request in %.1fs"
+                               % (self.name, scrub_secrets(str(e)), method.upper(), delay))
+                time.sleep(delay)
+            except requests.RequestException:
+                metrics.get_registry().record(self.name, method, url, None, time.time() - start)
+                self.count("errors")
+                self.count("failed")
+                self.breaker.failed()
+                raise
+            except Exception:
+                # Not an upstream failure, like programming errors
+                metrics.get_registry().record(self.name, method, url, None, time.time() - start)
+                self.breaker.release()
+                raise
+            else:
+                metrics.get_registry().record(self.name, method, url, response, time.time() - start)
+                self.observe(response)
+                if response.status_code in self.RETRY_STATUS_CODES:
+                    self.count("errors")
+                    self.breaker.failed()
+                else:
+                    self.breaker.succeeded()
+                    if response.status_code != 429:
+                        return response
+                    self.count("throttled")
+
+                if not idempotent or attempt >= self.max_retries:
+                    self.count("failed")
+                    return response
+
+                delay = self.retry_delay(response, attempt)
+                # Release the connection of streamed responses before retrying
+                response.close()
+                if response.status_code == 429:
+                    logger.warning("%s rate limit hit, retrying %s request in %.1fs"
+                                   % (self.name, method.upper(), delay))
+                    self.bucket.pause(delay)
+                else:
+                    logger.warning("%s responded with HTTP %d, retrying %s request in %.1fs"
+                                   % (self.name, response.status_code, method.upper(), delay))
+                    time.sleep(delay)
+
+            self.count("retries")
+            metrics.get_registry().record_retry(self.name, method, url)
+            attempt += 1
+
+
+# Default limits stay a bit below the published ones: Trello allows 100 requests
+# per 10 seconds per token. Bugzilla publishes no limits.
+__defaults = {
+    "trello": {"rate": 9.0, "burst": 10},
+    "bugzilla": {"rate": 20.0, "burst": 20}
+}
+__schedulers = {}
+__lock = threading.Lock()
+
+
+def configure(upstream, rate=None, burst=None, max_retries=None, failure_threshold=None, reset_timeout=None):
+    """
+    Change rate limiting and failure handling settings for an upstream API
+    :param upstream: str with upstream name
+    :param rate: float with requests per second
+    :param burst: int with maximum burst of requests
+    :param max_retries: int maximum number of retries for throttled or failed requests
+    :param failure_threshold: int consecutive failures after which requests fail fast, 0 to never fail fast
+    :param reset_timeout: float seconds to fail fast before trying again
+    :return: None
+    """
+    scheduler = get_scheduler(upstream)
+    if rate is not None or burst is not None:
+        scheduler.bucket.set_rate(rate if rate is not None else scheduler.bucket.rate, burst)
+    if max_retries is not None:
+        scheduler.max_retries = max_retries
+    if failure_threshold is not None:
+        scheduler.breaker.failure_threshold = failure_threshold
+    if reset_timeout is not None:
+        scheduler.breaker.reset_timeout = reset_timeout
+
+
+def get_scheduler(upstream):
+    """
+    Return the process-wide request scheduler for an upstream API
+    :param upstream: str with upstream name
+    :return: RequestScheduler
+    """
+    with __lock:
+        if upstream not in __schedulers:
+            defaults = __defaults.get(upstream, {"rate": 10.0, "burst": 10})
+            __schedulers[upstream] = RequestScheduler(upstream, defaults["rate"], defaults["burst"])
+        return __schedulers[upstream]
+
+
+def counters():
+    """
+    Return request counters of all schedulers
+    :return: dict mapping upstream names to dicts of counters
+    """
+    with __lock:
+        return dict([(name, dict(s.counters)) for name, s in __schedulers.iteritems()])
@@ -0,0 +1,197 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Section-addressable snapshot files. Sections are stored as independently
+# compressed blocks, so single sections can be read without decompressing
+# the whole file. Collections like cards and bugs are sorted by ID and cut
+# into blocks of similar size, so single objects can be found by ID. An
+# index of all blocks is stored last, followed by a fixed-size trailer with
+# its location.
+
+import bisect
+import json
+import logging
+import os
+import struct
+
+import trellosa.compression as compression
+import trellosa.objectstore as objectstore
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_FORMAT = "trellosa-sections"
+INDEX_VERSION = 1
+
+# Uncompressed size that blocks of collections are filled up to
+BLOCK_SIZE = 65536
+
+# Offset and length of the index block
+TRAILER = struct.Struct(">QQ")
+
+
+class SectionWriter(object):
+    """
+    Writes snapshot data as section-addressable file
+    """
+
+    def __init__(self, fileobj, codec, dictionary=None):
+        """
+        :param fileobj: file object opened for binary writing
+        :param codec: compression.Codec for blocks
+        :param dictionary: str with compression dictionary or None
+        """
+        self.fileobj = fileobj
+        self.codec = codec
+        self.dictionary = dictionary
+        self.offset = 0
+
+    def write_block(self, data):
+        """
+        Compress and write a block
+        :param data: str
+        :return: list of int with offset and length of the compressed block
+        """
+        compressed = self.codec.compress(data, self.dictionary)
+        self.fileobj.write(compressed)
+        location = [self.offset, len(compressed)]
+        self.offset += len(compressed)
+        return location
+
+    def write_collection(self, collection):
+        """
+        Write a collection in blocks of objects sorted by ID
+        :param collection: dict mapping IDs to objects
+        :return: list of lists with first ID, offset and length of each block
+        """
+        blocks = []
+        items = []
+        size = 0
+        for key in sorted(collection.keys()):
+            item = "%s: %s" % (json.dumps(key), json.dumps(collection[key], sort_keys=True))
+            items.append((key, item))
+            size += len(item)
+            if size >= BLOCK_SIZE:
+                blocks.append([items[0][0]] + self.write_block("{%s}" % ", ".join([x[1] for x in items])))
+                items = []
+                size = 0
+        if len(items) > 0:
+            blocks.append([items[0][0]] + self.write_block("{%s}" % ", ".join([x[1] for x in items])))
+        return blocks
+
+    def write_node(self, data, depth=2):
+        """
+        Write snapshot data. Dicts are descended into up to the given depth,
+        where collections are written in blocks and anything else as one block.
+        :param data: snapshot data
+        :param depth: int levels of dicts to descend into
+        :return: dict with index node
+        """
+        if depth == 0 and objectstore.is_collection(data):
+            return {"collection": self.write_collection(data)}
+        elif isinstance(data, dict) and depth > 0:
+            return {"sections": dict([(key, self.write_node(value, depth - 1)) for key, value in data.iteritems()])}
+        else:
+            return {"block": self.write_block(json.dumps(data, sort_keys=True))}
+
+    def write(self, data):
+        """
+        Write snapshot data with index and trailer
+        :param data: dict with snapshot data, with str keys only
+        :return: None
+        """
+        index = {"format": INDEX_FORMAT, "version": INDEX_VERSION, "root": self.write_node(data)}
+        offset, length = self.write_block(json.dumps(index, sort_keys=True))
+        self.fileobj.write(TRAILER.pack(offset, length))
+
+
+class SectionReader(object):
+    """
+    Reads sections or single objects from section-addressable files
+    """
+
+    def __init__(self, file_name, dictionaries=None):
+        """
+        :param file_name: str
+        :param dictionaries: compression.DictionaryStore or None
+        """
+        self.file_name = file_name
+        self.codec = compression.codec_of(file_name)
+        self.dictionaries = dictionaries
+        self.file = open(file_name, "rb")
+        self.file.seek(-TRAILER.size, os.SEEK_END)
+        self.index = json.loads(self.read_block(TRAILER.unpack(self.file.read(TRAILER.size))))
+        if self.index.get("format") != INDEX_FORMAT or self.index.get("version") != INDEX_VERSION:
+            raise Exception("Unsupported section index format in `%s`" % file_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def read_block(self, location):
+        """
+        :param location: list with offset and length of a block
+        :return: str with decompressed block
+        """
+        offset, length = location
+        self.file.seek(offset)
+        return self.codec.decompress(self.file.read(length), self.dictionaries).decode("utf-8")
+
+    def load_collection(self, blocks, ids=None):
+        """
+        :param blocks: list of lists with first ID, offset and length of each block
+        :param ids: set of str with IDs to load, or None for all
+        :return: dict mapping IDs to objects
+        """
+        if ids is None:
+            needed = range(len(blocks))
+        else:
+            firsts = [block[0] for block in blocks]
+            needed = sorted(set([bisect.bisect_right(firsts, x) - 1 for x in ids]) - set([-1]))
+        result = {}
+        for number in needed:
+            result.update(json.loads(self.read_block(blocks[number][1:])))
+        if ids is not None:
+            result = dict(filter(lambda x: x[0] in ids, result.iteritems()))
+        return result
+
+    def load_node(self, node, ids=None):
+        if "collection" in node:
+            return self.load_collection(node["collection"], ids)
+        elif "sections" in node:
+            return dict([(key, self.load_node(value, ids)) for key, value in node["sections"].iteritems()])
+        else:
+            return json.loads(self.read_block(node["block"]))
+
+    def load(self, sections=None, ids=None):
+        """
+        Load snapshot data, or parts of it
+        :param sections: list of str with section paths like `firefox_trello.cards`, or None for all
+        :param ids: iterable of str with IDs of objects to load from collections, or None for all
+        :return: dict with snapshot data
+        """
+        if ids is not None:
+            ids = set(ids)
+        if sections is None:
+            return self.load_node(self.index["root"], ids)
+        result = {}
+        for path in sections:
+            keys = path.split(".")
+            node = self.index["root"]
+            for key in keys:
+                node = node.get("sections", {}).get(key) if node is not None else None
+            if node is None:
+                continue
+            target = result
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = self.load_node(node, ids)
+        return result
@@ -0,0 +1,152 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+
+from trellosa import cleanup
+import trellosa.transport as transport
+
+
+logger = logging.getLogger(__name__)
+
+# Shared session settings, see configure()
+__config = {
+    "pool_connections": 4,
+    "pool_maxsize": 10,
+    "timeout": 60,
+    "record_dir": None,
+    "replay_dir": None
+}
+# API base URLs overriding the defaults of the clients, see set_base_url()
+__base_urls = {}
+__sessions = {}
+__lock = threading.Lock()
+
+
+def configure(pool_connections=None, pool_maxsize=None, timeout=None, record_dir=None, replay_dir=None):
+    """
+    Change settings for HTTP sessions. Sessions already created are
+    closed and will be recreated with the new settings on next use.
+    :param pool_connections: int number of per-host connection pools to cache
+    :param pool_maxsize: int maximum number of connections kept alive per pool
+    :param timeout: float default request timeout in seconds
+    :param record_dir: str with directory to record all API traffic to
+    :param replay_dir: str with directory to replay recorded API traffic from instead of the network
+    :return: None
+    """
+    if pool_connections is not None:
+        __config["pool_connections"] = pool_connections
+    if pool_maxsize is not None:
+        __config["pool_maxsize"] = pool_maxsize
+    if timeout is not None:
+        __config["timeout"] = timeout
+    if record_dir is not None and replay_dir is not None:
+        raise Exception("Can not record and replay at the same time")
+    __config["record_dir"] = record_dir
+    __config["replay_dir"] = replay_dir
+    close_all()
+
+
+def default_timeout():
+    return __config["timeout"]
+
+
+def set_base_url(upstream, url):
+    """
+    Point clients of an upstream API to another server, like a local fake server
+    :param upstream: str with upstream name
+    :param url: str with base URL or None for the default
+    :return: None
+    """
+    if url is None:
+        __base_urls.pop(upstream, None)
+    else:
+        __base_urls[upstream] = url.rstrip("/")
+
+
+def base_url(upstream, default):
+    """
+    Return the base URL to use for an upstream API
+    :param upstream: str with upstream name
+    :param default: str with default base URL of the client
+    :return: str
+    """
+    return __base_urls.get(upstream, default)
+
+
+def new_adapter():
+    """
+    Create the transport adapter for new sessions. Depending on settings,
+    traffic goes to the network, is recorded to disk, or is replayed from disk.
+    :return: requests.adapters.BaseAdapter
+    """
+    if __config["replay_dir"] is not None:
+        return transport.ReplayAdapter(transport.get_cassette(__config["replay_dir"]))
+    pool_args = {
+        "pool_connections": __config["pool_connections"],
+        "pool_maxsize": __config["pool_maxsize"]
+    }
+    if __config["record_dir"] is not None:
+        return transport.RecordingAdapter(transport.get_cassette(__config["record_dir"]), **pool_args)
+    return HTTPAdapter(**pool_args)
+
+
+def new_session():
+    """
+    Create a keep-alive session with connection pooling and gzip encoding
+    :return: requests.Session
+    """
+    session = requests.Session()
+    adapter = new_adapter()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive",
+        "User-Agent": "trellosa %s" % requests.utils.default_user_agent()
+    })
+    return session
+
+
+def get_session(upstream):
+    """
+    Return the process-wide session for an upstream API like "trello"
+    or "bugzilla". All clients of the same upstream share connections.
+    :param upstream: str with upstream name
+    :return: requests.Session
+    """
+    with __lock:
+        if upstream not in __sessions:
+            logger.debug("Creating HTTP session for `%s`" % upstream)
+            __sessions[upstream] = new_session()
+        return __sessions[upstream]
+
+
+def close_all():
+    """
+    Close all shared sessions and their pooled connections
+    :return: None
+    """
+    with __lock:
+        for upstream in __sessions.keys():
+            logger.debug("Closing HTTP session for `%s`" % upstream)
+            __sessions[upstream].close()
+            del __sessions[upstream]
+
+
+class CloseSessions(cleanup.CleanUp):
+    """
+    Cleanup helper for closing pooled connections prior to exit
+    """
+    # After other cleanup helpers that may still make requests, like draining mutations
+    order = 100
+
+    @staticmethod
+    def at_exit():
+        close_all()
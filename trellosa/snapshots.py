@@ -4,45 +4,172 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import calendar
+import collections
 import datetime
 import glob
-import gzip
 import json
 import logging
 import os
 from pygments import highlight
 from pygments.formatters import Terminal256Formatter
 from pygments.lexers import JsonLexer
+import requests
 import sys
+import threading
+import time
+import types
 
+import trellosa.asyncclient as asyncclient
 from trellosa.bugzilla import BugzillaClient
+import trellosa.cache as cache
+import trellosa.catalogue as catalogue
+import trellosa.compression as compression
+import trellosa.deltas as deltas
+import trellosa.objectstore as objectstore
+import trellosa.parallel as parallel
+import trellosa.profiles as profiles
+import trellosa.scheduler as scheduler
+import trellosa.sectionfile as sectionfile
 from trellosa.token import read_token
-from trellosa.trello import FirefoxTrello
+from trellosa.trello import extract_bugzilla_bug, find_security_notes_id, FirefoxTrello
 
 
 logger = logging.getLogger(__name__)
 
 
+class SnapshotWriter(object):
+    """
+    Snapshot file being written. It is written under a temporary name and
+    replaces any existing file of the snapshot when closed without error.
+    Files in `indexed` storage compress their blocks themselves and are
+    written as they are.
+    """
+
+    def __init__(self, snapshot_db, handle, storage, codec):
+        self.snapshot_db = snapshot_db
+        self.handle = handle
+        self.storage = storage
+        self.codec = codec
+        self.file_name = snapshot_db.handle_to_file_name(handle, storage, codec)
+        self.tmp_file_name = os.path.join(os.path.dirname(self.file_name), ".tmp_" + os.path.basename(self.file_name))
+        if storage == "indexed":
+            self.file = open(self.tmp_file_name, "wb")
+        else:
+            self.file = compression.get_codec(codec).open(self.tmp_file_name, "w", snapshot_db.dictionaries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(commit=exc_type is None)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self, commit=True):
+        """
+        :param commit: bool False to discard the file
+        :return: None
+        """
+        self.file.close()
+        if not commit:
+            os.remove(self.tmp_file_name)
+            return
+        previous = self.snapshot_db.handle_to_file_name(self.handle) if self.snapshot_db.exists(self.handle) else None
+        os.rename(self.tmp_file_name, self.file_name)
+        if previous is not None and previous != self.file_name:
+            os.remove(previous)
+        self.snapshot_db.catalogue.add(self.handle, self.storage, self.codec)
+
+
 class SnapshotDB(object):
     """
     Class to manage on-disk snapshots
     """
 
+    # File name suffixes of the storage formats, see save(). The extension
+    # of the compression codec follows, like in `.manifest.gz`.
+    STORAGE_SUFFIXES = {
+        "blob": "",
+        "dedup": ".manifest",
+        "delta": ".delta",
+        "indexed": ".sections"
+    }
+    DEFAULT_STORAGE = "blob"
+    DEFAULT_CODEC = "gzip"
+
+    # Every this many snapshots in delta storage is a full keyframe
+    DEFAULT_KEYFRAME_INTERVAL = 10
+
+    # Number of reconstructed delta snapshots kept in memory
+    RECONSTRUCTION_CACHE_SIZE = 4
+
     def __init__(self, args):
         self.args = args
         self.snap_dir = os.path.abspath(os.path.join(args.workdir, "snapshots"))
         if not os.path.isdir(self.snap_dir):
             os.makedirs(self.snap_dir)
+        self.codec = getattr(args, "compression", None) or self.DEFAULT_CODEC
+        self.dictionaries = compression.DictionaryStore(os.path.join(self.snap_dir, "dictionaries"))
+        self.__object_store = None
+        self.__catalogue = None
+        self.__reconstructed = collections.OrderedDict()
+        self.__lock = threading.RLock()
+
+    @property
+    def object_store(self):
+        with self.__lock:
+            if self.__object_store is None:
+                self.__object_store = objectstore.ObjectStore(os.path.join(self.snap_dir, "objects"))
+            return self.__object_store
+
+    @property
+    def catalogue(self):
+        """
+        Index of snapshot handles, built from the snapshot files on first use
+        :return: catalogue.Catalogue
+        """
+        with self.__lock:
+            if self.__catalogue is None:
+                self.__catalogue = catalogue.Catalogue(os.path.join(self.snap_dir, "catalogue.sqlite"))
+                if self.__catalogue.is_new:
+                    self.reindex()
+            return self.__catalogue
 
-    def handle_to_file_name(self, handle):
+    def reindex(self):
+        """
+        Rebuild the catalogue from the snapshot files
+        :return: int number of snapshots
+        """
+        entries = [self.split_file_name(file_name) for file_name in self.list_snapshots()]
+        self.catalogue.replace(entries)
+        logger.debug("Indexed %d snapshots" % len(entries))
+        return len(entries)
+
+    def handle_to_file_name(self, handle, storage=None, codec=None):
         """
         Converts a snapshot handle to its file name
         :param handle: str with handle
+        :param storage: str with storage format, or None for the format of the existing file
+        :param codec: str with compression codec, or None for the default codec
         :return: str with file name
         """
         # handle format is .strftime("%Y-%m-%dZ%H-%M-%S")
         year, month, _, _, _ = handle.split("-")
-        return os.path.join(self.snap_dir, year, month, "%s.gz" % handle)
+        if storage is None:
+            entry = self.catalogue.lookup(handle)
+            if entry is not None:
+                storage, codec = entry
+        if storage is None:
+            matches = glob.glob(os.path.join(self.snap_dir, year, month, "%s.*" % handle))
+            if len(matches) > 0:
+                return matches[0]
+            storage = self.DEFAULT_STORAGE
+        if codec is None:
+            codec = self.codec
+        extension = self.STORAGE_SUFFIXES[storage] + compression.get_codec(codec).extension
+        return os.path.join(self.snap_dir, year, month, handle + extension)
 
     @staticmethod
     def file_name_to_handle(file_name):
@@ -51,7 +178,30 @@ class SnapshotDB(object):
         :param file_name: str
         :return: str with handle
         """
-        return os.path.splitext(os.path.basename(file_name))[0]
+        # Handles contain no dots, but extensions may have several
+        return os.path.basename(file_name).split(".", 1)[0]
+
+    def split_file_name(self, file_name):
+        """
+        Handle, storage format and compression codec of a snapshot file
+        :param file_name: str
+        :return: tuple of str with handle, storage format and codec
+        """
+        parts = os.path.basename(file_name).split(".")
+        codec = compression.codec_of(file_name)
+        suffix = "".join(["." + part for part in parts[1:-1]])
+        for storage, storage_suffix in self.STORAGE_SUFFIXES.iteritems():
+            if codec is not None and suffix == storage_suffix:
+                return parts[0], storage, codec.name
+        raise Exception("Unknown snapshot file format `%s`" % file_name)
+
+    def storage_of(self, file_name):
+        """
+        Storage format of a snapshot file, by its extension
+        :param file_name: str
+        :return: str with storage format
+        """
+        return self.split_file_name(file_name)[1]
 
     def exists(self, handle):
         """
@@ -59,8 +209,7 @@ class SnapshotDB(object):
         :param handle: str with handle
         :return: bool
         """
-        matches = glob.glob(os.path.join(self.snap_dir, "2???", "??", "%s.gz" % handle))
-        return len(matches) > 0
+        return self.catalogue.storage(handle) is not None
 
     def list_snapshots(self):
         """
@@ -71,10 +220,30 @@ class SnapshotDB(object):
 
     def list(self):
         """
-        Returns a list of snapshot handles
+        Returns a sorted list of snapshot handles
         :return: list of str of snapshot handles
         """
-        return [self.file_name_to_handle(file_name) for file_name in self.list_snapshots()]
+        return self.catalogue.list()
+
+    def latest(self):
+        """
+        :return: str with handle of the latest snapshot or None
+        """
+        return self.catalogue.ordinal(1)
+
+    def by_ordinal(self, number):
+        """
+        :param number: int, 1 for the latest snapshot
+        :return: str with handle or None
+        """
+        return self.catalogue.ordinal(number)
+
+    def by_time(self, timestamp):
+        """
+        :param timestamp: float with UTC epoch time
+        :return: str with handle of the latest snapshot taken at or before that time, or None
+        """
+        return self.catalogue.at(timestamp)
 
     def delete(self, handle):
         """
@@ -86,28 +255,93 @@ class SnapshotDB(object):
         global logger
         file_name = self.handle_to_file_name(handle)
         logger.debug("Purging `%s` from run snapshot database" % file_name)
+        storage = self.storage_of(file_name)
+        if storage == "delta":
+            self.unlink_delta(handle)
+        elif storage == "dedup":
+            self.unlink_manifest(handle)
         os.remove(file_name)
+        self.catalogue.remove(handle)
+        if storage == "dedup":
+            self.collect_garbage()
+
+    def collect_garbage(self):
+        """
+        Delete stored objects that no snapshot refers to anymore
+        :return: int number of deleted objects
+        """
+        referenced = set()
+        roots = {}
+        for handle in self.catalogue.list(storage="dedup"):
+            referenced |= objectstore.references(self.manifest_root(handle, roots))
+            # Manifests are diffs against the previous one, so only the latest is needed
+            roots = {handle: roots[handle]}
+        removed = self.object_store.remove_unreferenced(referenced)
+        logger.debug("Removed %d unreferenced snapshot objects" % removed)
+        return removed
 
-    def open(self, handle, mode="r"):
+    def open(self, handle, mode="r", storage=None, codec=None):
         """
         Open a snapshot file by handle and part name
         :param handle: str log handle
         :param mode: str file mode
-        :return: file object
+        :param storage: str with storage format when writing, see STORAGE_SUFFIXES
+        :param codec: str with compression codec when writing, or None for the default codec
+        :return: file object, or sectionfile.SectionReader for reading `indexed` storage
         """
         global logger
 
-        file_name = self.handle_to_file_name(handle)
+        if "w" in mode:
+            if storage is None:
+                storage = self.DEFAULT_STORAGE
+            if codec is None:
+                codec = self.codec
+        file_name = self.handle_to_file_name(handle, storage, codec)
         if "w" in mode and not os.path.isdir(os.path.dirname(file_name)):
             os.makedirs(os.path.dirname(file_name))
 
         logger.debug("Opening snapshot file `%s` in mode `%s`" % (file_name, mode))
 
         try:
-            return gzip.open(file_name, mode)
+            if "w" in mode:
+                return SnapshotWriter(self, handle, storage, codec)
+            if self.storage_of(file_name) == "indexed":
+                return sectionfile.SectionReader(file_name, self.dictionaries)
+            return compression.codec_of(file_name).open(file_name, "r", self.dictionaries)
         except IOError as err:
             raise Exception("Error opening snapshot file for handle `%s`: %s" % (handle, err))
 
+    def recompress(self, handle, codec):
+        """
+        Convert a snapshot file to another compression codec
+        :param handle: str with handle
+        :param codec: str with codec
+        :return: tuple of int with file sizes before and after
+        """
+        file_name = self.handle_to_file_name(handle)
+        _, storage, _ = self.split_file_name(file_name)
+        size = os.path.getsize(file_name)
+        if storage == "indexed":
+            # Blocks are compressed separately, so the file is encoded anew
+            self.save_indexed(handle, self.load(handle), codec)
+            return size, os.path.getsize(self.handle_to_file_name(handle))
+        source = self.open(handle, "r")
+        target = self.open(handle, "w", storage=storage, codec=codec)
+        try:
+            while True:
+                data = source.read(compression.CHUNK_SIZE)
+                if len(data) == 0:
+                    break
+                target.write(data)
+        except Exception:
+            source.close()
+            target.close(commit=False)
+            raise
+        # Close the source first, open files can not be replaced everywhere
+        source.close()
+        target.close()
+        return size, os.path.getsize(target.file_name)
+
     def read(self, handle):
         """
         Return the string content of a snapshot referenced by its handle
@@ -116,6 +350,8 @@ class SnapshotDB(object):
         """
         global logger
         logger.debug("Reading snapshot `%s`" % handle)
+        if self.storage_of(self.handle_to_file_name(handle)) != "blob":
+            return "".join(iter_json(self.load(handle)))
         with self.open(handle, "r") as f:
             return f.read().decode("utf-8")
 
@@ -129,22 +365,374 @@ class SnapshotDB(object):
         """
         global logger
         logger.debug("Writing snapshot `%s`" % handle)
-        with self.open(handle, "w") as f:
+        with self.open(handle, "w", storage="blob") as f:
             f.write(str(data).encode("utf-8"))
 
+    def write_chunks(self, handle, chunks):
+        """
+        Write snapshot referenced by handle from an iterable of strings,
+        for writing snapshots that do not fit into memory as a whole.
+        :param handle: str with handle
+        :param chunks: iterable of str
+        :return: None
+        """
+        global logger
+        logger.debug("Writing snapshot `%s` in chunks" % handle)
+        with self.open(handle, "w", storage="blob") as f:
+            for chunk in chunks:
+                f.write(str(chunk).encode("utf-8"))
 
-def match(snapshot_db, tag_db, ref):
-    snaps = snapshot_db.list()
+    def load(self, handle, sections=None, ids=None):
+        """
+        Load and decode a snapshot in any storage format, or parts of it.
+        Only snapshots in `indexed` storage are read partially, others are
+        loaded whole and the requested parts selected, see select().
+        :param handle: str with handle
+        :param sections: list of str with section paths like `firefox_trello.cards`, or None for all
+        :param ids: list of str with IDs of objects to load from collections, or None for all
+        :return: dict with snapshot data
+        """
+        storage = self.storage_of(self.handle_to_file_name(handle))
+        if storage == "indexed":
+            logger.debug("Loading snapshot `%s` from sections" % handle)
+            with self.open(handle, "r") as f:
+                return f.load(sections, ids)
+        elif storage == "delta":
+            with self.__lock:
+                # Callers may modify the result, but not the cached reconstruction
+                data = deltas.copy_data(self.__reconstruct(handle))
+        elif storage == "dedup":
+            logger.debug("Loading snapshot `%s` from objects" % handle)
+            data = objectstore.load_snapshot(self.object_store, self.manifest_root(handle))
+        else:
+            data = json.loads(self.read(handle))
+        return select(data, sections, ids)
+
+    def save(self, handle, data, storage=None, keyframe_interval=None):
+        """
+        Encode and save snapshot data. The data may contain streamed sections.
+        With `dedup` storage, cards, bugs and other objects are stored by content
+        and the snapshot file only refers to them, so objects that did not change
+        since earlier snapshots are not stored again, and the manifests of most
+        snapshots are stored as diffs to the previous one. With `delta` storage, only
+        every few snapshots are stored in full and the ones in between as changes
+        to the previous snapshot. With `indexed` storage, sections and blocks of
+        cards, bugs and other objects are compressed separately and indexed, so
+        that parts of the snapshot can be loaded without reading all of it.
+        :param handle: str with handle
+        :param data: dict with snapshot data
+        :param storage: str with storage format, see STORAGE_SUFFIXES
+        :param keyframe_interval: int snapshots per keyframe or full manifest with `delta` or `dedup` storage
+        :return: None
+        """
+        if storage is None:
+            storage = self.DEFAULT_STORAGE
+        if storage == "delta":
+            self.save_delta(handle, data, keyframe_interval)
+        elif storage == "dedup":
+            self.save_dedup(handle, data, keyframe_interval)
+        elif storage == "indexed":
+            self.save_indexed(handle, data)
+        elif storage == "blob":
+            self.write_chunks(handle, iter_json(data))
+        else:
+            raise Exception("Unknown snapshot storage format `%s`" % storage)
 
+    def read_manifest(self, handle):
+        """
+        :param handle: str with handle of a snapshot in dedup storage
+        :return: dict with manifest
+        """
+        with self.open(handle, "r") as f:
+            manifest = json.loads(f.read().decode("utf-8"))
+        objectstore.check_manifest(manifest)
+        return manifest
+
+    def write_manifest(self, handle, manifest):
+        logger.debug("Writing snapshot manifest `%s`" % handle)
+        with self.open(handle, "w", storage="dedup") as f:
+            f.write(json.dumps(manifest, sort_keys=True).encode("utf-8"))
+
+    def manifest_root(self, handle, cache=None):
+        """
+        Manifest node of a snapshot in dedup storage, applying the diffs
+        since its last full manifest
+        :param handle: str with handle
+        :param cache: dict mapping handles to manifest nodes to reuse and extend, or None
+        :return: dict with manifest node, must not be modified
+        """
+        if cache is not None and handle in cache:
+            return cache[handle]
+        manifest = self.read_manifest(handle)
+        if manifest.get("base") is None:
+            root = manifest["root"]
+        else:
+            root = deltas.apply_delta(self.manifest_root(manifest["base"], cache), manifest["diff"])
+        if cache is not None:
+            cache[handle] = root
+        return root
+
+    def save_dedup(self, handle, data, keyframe_interval=None):
+        """
+        Save a snapshot in dedup storage. The manifest is stored in full or as
+        diff against the manifest of the previous snapshot.
+        :param handle: str with handle
+        :param data: dict with snapshot data, may contain generators
+        :param keyframe_interval: int snapshots per full manifest
+        :return: None
+        """
+        if keyframe_interval is None:
+            keyframe_interval = self.DEFAULT_KEYFRAME_INTERVAL
+        root = objectstore.store_snapshot(self.object_store, data)
+        base = self.catalogue.before(handle)
+        if base is not None and keyframe_interval > 1 and self.catalogue.storage(base) == "dedup":
+            depth = self.read_manifest(base).get("depth", 0) + 1
+            if depth < keyframe_interval:
+                self.write_manifest(handle, objectstore.make_manifest(root, base, self.manifest_root(base), depth))
+                return
+        self.write_manifest(handle, objectstore.make_manifest(root))
+
+    def unlink_manifest(self, handle):
+        """
+        Rewrite the manifest stored as diff against a snapshot that is about
+        to be deleted, so it no longer depends on it
+        :param handle: str with handle of the snapshot to be deleted
+        :return: None
+        """
+        manifest = self.read_manifest(handle)
+        child = self.catalogue.after(handle)
+        if child is None or self.catalogue.storage(child) != "dedup" \
+                or self.read_manifest(child).get("base") != handle:
+            return
+        root = self.manifest_root(child)
+        if manifest.get("base") is None:
+            logger.debug("Rewriting manifest of `%s` in full" % child)
+            self.write_manifest(child, objectstore.make_manifest(root))
+        else:
+            logger.debug("Rewriting manifest of `%s` as diff to `%s`" % (child, manifest["base"]))
+            self.write_manifest(child, objectstore.make_manifest(root, manifest["base"],
+                                                                 self.manifest_root(manifest["base"]),
+                                                                 manifest.get("depth", 0)))
+
+    def save_indexed(self, handle, data, codec=None):
+        """
+        Save a snapshot in indexed storage, see sectionfile
+        :param handle: str with handle
+        :param data: dict with snapshot data, may contain generators
+        :param codec: str with compression codec, or None for the default codec
+        :return: None
+        """
+        if codec is None:
+            codec = self.codec
+        # Encode and decode like stored snapshots, so IDs sort like stored keys
+        data = json.loads("".join(iter_json(data)))
+        dictionary = self.dictionaries.latest() if compression.get_codec(codec).supports_dictionary else None
+        logger.debug("Writing snapshot `%s` in sections" % handle)
+        with self.open(handle, "w", storage="indexed", codec=codec) as f:
+            sectionfile.SectionWriter(f, compression.get_codec(codec), dictionary).write(data)
+
+    def read_delta_header(self, handle):
+        """
+        Read the header of a snapshot in delta storage
+        :param handle: str with handle
+        :return: dict with bool `keyframe` and str `base` with handle of the previous snapshot
+        """
+        with self.open(handle, "r") as f:
+            header = json.loads(f.readline().decode("utf-8"))
+        if header.get("format") != deltas.DELTA_FORMAT or header.get("version") != deltas.DELTA_VERSION:
+            raise Exception("Unsupported delta snapshot format in `%s`" % handle)
+        return header
+
+    def write_delta(self, handle, keyframe, base, payload):
+        """
+        Write a snapshot in delta storage
+        :param handle: str with handle
+        :param keyframe: bool whether payload is the full snapshot
+        :param base: str with handle of the snapshot the delta applies to, or None for keyframes
+        :param payload: dict with snapshot data or delta
+        :return: None
+        """
+        header = {"format": deltas.DELTA_FORMAT, "version": deltas.DELTA_VERSION, "keyframe": keyframe, "base": base}
+        with self.open(handle, "w", storage="delta") as f:
+            f.write(json.dumps(header, sort_keys=True) + "\n")
+            for chunk in iter_json(payload):
+                f.write(str(chunk).encode("utf-8"))
+
+    def delta_depth(self, handle):
+        """
+        Number of deltas between a snapshot in delta storage and its keyframe
+        :param handle: str with handle
+        :return: int
+        """
+        depth = 0
+        header = self.read_delta_header(handle)
+        while not header["keyframe"]:
+            depth += 1
+            header = self.read_delta_header(header["base"])
+        return depth
+
+    def delta_base(self, handle, keyframe_interval):
+        """
+        Snapshot that a new snapshot should be stored as delta against
+        :param handle: str with handle of the new snapshot
+        :param keyframe_interval: int snapshots per keyframe
+        :return: str with handle or None if a keyframe is due
+        """
+        base = self.catalogue.before(handle)
+        if base is None or keyframe_interval <= 1:
+            return None
+        if self.catalogue.storage(base) != "delta":
+            return None
+        if self.delta_depth(base) + 1 >= keyframe_interval:
+            return None
+        return base
+
+    def __remember(self, handle, data):
+        self.__reconstructed[handle] = data
+        while len(self.__reconstructed) > self.RECONSTRUCTION_CACHE_SIZE:
+            self.__reconstructed.popitem(last=False)
+
+    def __reconstruct(self, handle):
+        """
+        Reconstruct a snapshot in delta storage by applying the deltas since
+        its keyframe. Recent results are cached, so reading consecutive
+        snapshots only applies one more delta each.
+        :param handle: str with handle
+        :return: dict with snapshot data, must not be modified
+        """
+        if handle in self.__reconstructed:
+            data = self.__reconstructed.pop(handle)
+        else:
+            header = self.read_delta_header(handle)
+            with self.open(handle, "r") as f:
+                f.readline()
+                payload = json.loads(f.read().decode("utf-8"))
+            if header["keyframe"]:
+                data = payload
+            else:
+                logger.debug("Applying delta of snapshot `%s` to `%s`" % (handle, header["base"]))
+                data = deltas.apply_delta(self.__reconstruct(header["base"]), payload)
+        self.__remember(handle, data)
+        return data
+
+    def save_delta(self, handle, data, keyframe_interval=None):
+        """
+        Save a snapshot in delta storage, as keyframe or as delta against
+        the previous snapshot
+        :param handle: str with handle
+        :param data: dict with snapshot data, may contain generators
+        :param keyframe_interval: int snapshots per keyframe
+        :return: None
+        """
+        if keyframe_interval is None:
+            keyframe_interval = self.DEFAULT_KEYFRAME_INTERVAL
+        # Encode and decode like stored snapshots, so unchanged values compare equal
+        data = json.loads("".join(iter_json(data)))
+        with self.__lock:
+            base = self.delta_base(handle, keyframe_interval)
+            if base is None:
+                logger.debug("Writing snapshot `%s` as keyframe" % handle)
+                self.write_delta(handle, True, None, data)
+            else:
+                delta = deltas.make_delta(self.__reconstruct(base), data)
+                logger.debug("Writing snapshot `%s` as delta of %d changes to `%s`"
+                             % (handle, deltas.delta_size(delta), base))
+                self.write_delta(handle, False, base, delta)
+            self.__remember(handle, data)
+
+    def unlink_delta(self, handle):
+        """
+        Re-encode the snapshot stored as delta against a snapshot that is
+        about to be deleted, so it no longer depends on it
+        :param handle: str with handle of the snapshot to be deleted
+        :return: None
+        """
+        with self.__lock:
+            header = self.read_delta_header(handle)
+            # Deltas are always stored against the previous snapshot
+            child = self.catalogue.after(handle)
+            if child is not None and self.catalogue.storage(child) == "delta" \
+                    and self.read_delta_header(child)["base"] == handle:
+                data = self.__reconstruct(child)
+                if header["keyframe"]:
+                    logger.debug("Rewriting snapshot `%s` as keyframe" % child)
+                    self.write_delta(child, True, None, data)
+                else:
+                    logger.debug("Rewriting snapshot `%s` as delta to `%s`" % (child, header["base"]))
+                    self.write_delta(child, False, header["base"],
+                                     deltas.make_delta(self.__reconstruct(header["base"]), data))
+            self.__reconstructed.pop(handle, None)
+
+    def layout(self):
+        """
+        Describe how snapshots are stored
+        :return: list of dicts with `handle`, `storage`, `codec` and `size` in bytes, and for
+            delta and dedup storage, `keyframe`, `base` and `depth` since the keyframe
+        """
+        result = []
+        depths = {}
+        for handle in self.list():
+            file_name = self.handle_to_file_name(handle)
+            _, storage, codec = self.split_file_name(file_name)
+            entry = {"handle": handle, "storage": storage, "codec": codec, "size": os.path.getsize(file_name)}
+            if entry["storage"] == "delta":
+                header = self.read_delta_header(handle)
+                entry["keyframe"] = header["keyframe"]
+                entry["base"] = header["base"]
+                if header["keyframe"]:
+                    depths[handle] = 0
+                elif header["base"] in depths:
+                    depths[handle] = depths[header["base"]] + 1
+                else:
+                    depths[handle] = self.delta_depth(handle)
+                entry["depth"] = depths[handle]
+            elif entry["storage"] == "dedup":
+                manifest = self.read_manifest(handle)
+                entry["keyframe"] = manifest.get("base") is None
+                entry["base"] = manifest.get("base")
+                entry["depth"] = manifest.get("depth", 0)
+            result.append(entry)
+        return result
+
+
+def parse_time(value):
+    """
+    Parse a time given as UTC date and time or as epoch time
+    :param value: str like `2017-03-01`, `2017-03-01T12:00`, `2017-03-01T12:00:00` or `1488369600`
+    :return: float with epoch time or None
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for time_format in ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d", catalogue.HANDLE_FORMAT]:
+        try:
+            return float(calendar.timegm(time.strptime(value, time_format)))
+        except ValueError:
+            continue
+    return None
+
+
+def match(snapshot_db, tag_db, ref):
+    """
+    Resolve a snapshot reference. References are `0` for the online state,
+    ordinals like `1` for the latest snapshot, handles, tags, or `@` and a
+    time for the latest snapshot taken at or before that time.
+    :param snapshot_db: SnapshotDB
+    :param tag_db: TagsDB
+    :param ref: str with reference
+    :return: str with handle, `online` or None
+    """
     handle = None
     if ref == "0":
         handle = "online"
     elif ref.isdigit():
-        try:
-            handle = snaps[-int(ref)]
-        except IndexError:
-            handle = None
-    elif ref in snaps:
+        handle = snapshot_db.by_ordinal(int(ref))
+    elif ref.startswith("@"):
+        timestamp = parse_time(ref[1:])
+        if timestamp is not None:
+            handle = snapshot_db.by_time(timestamp)
+    elif snapshot_db.exists(ref):
         handle = ref
     elif tag_db.exists(ref):
         handle = tag_db.tag_to_handle(ref)
@@ -152,44 +740,384 @@ def match(snapshot_db, tag_db, ref):
     return handle
 
 
-def get(args, snapshot_db, tag_db, ref):
-    """Retrieve full snapshot state referenced by `ref`"""
+def fetch_online(args, previous=None, profile=None, stream=False, use_cache=False):
+    """
+    Fetch current online state from Trello and Bugzilla.
+    All API calls are spread across a pool of `args.jobs` workers
+    and must finish within `args.fetch_timeout` seconds.
+    When streaming, large sections are generators of (id, object) pairs
+    that are fetched while the snapshot is written, see store().
+    With `args.max_age` set, fetched state is kept in the online cache, and
+    with use_cache set, recently fetched state is reused from it instead.
+    Only read-only commands should use cached state.
+    With `args.allow_partial` set, sections that can not be fetched are
+    left empty and listed as `missing` in the meta data instead of failing.
+    :param args: parsed arguments
+    :param previous: dict with previous snapshot to update incrementally or None
+    :param profile: str with field projection profile or None for default
+    :param stream: bool
+    :param use_cache: bool whether cached online state may be returned
+    :return: dict with snapshot
+    """
+    if profile is None:
+        profile = profiles.DEFAULT_PROFILE
+    allow_partial = getattr(args, "allow_partial", False)
+
+    max_age = getattr(args, "max_age", 0)
+    online_cache = cache.get_online_cache(args.workdir) if max_age > 0 else None
+    if use_cache and online_cache is not None and previous is None and not stream:
+        snapshot = online_cache.get(profile, max_age)
+        if snapshot is not None:
+            logger.info("Using online state fetched %ds ago"
+                        % (time.time() - online_cache.snapshot_time(snapshot)))
+            return snapshot
+
+    trello_token = read_token(args.workdir, token_type="trello")
+    if trello_token is None:
+        logger.critical("No Trello access token configured. Use `setup` command first")
+        raise Exception("Unable to continue without token")
+    tr = FirefoxTrello(user_token=trello_token, profile=profile)
+
+    bz_token = read_token(args.workdir, token_type="bugzilla")
+    if bz_token is None:
+        logger.critical("No Bugzilla access token configured. Use `setup` command first")
+        raise Exception("Unable to continue without token")
+    bz = BugzillaClient(token=bz_token, profile=profile, page_size=getattr(args, "bug_page_size", None),
+                        jobs=getattr(args, "jobs", 1))
+
+    now = time.time()
+    with asyncclient.Dispatcher(max_workers=getattr(args, "jobs", 1),
+                                timeout=getattr(args, "fetch_timeout", None)) as dispatcher:
+        clients = {
+            "firefox_trello": asyncclient.AsyncFirefoxTrello(client=tr, dispatcher=dispatcher),
+            "bugzilla": asyncclient.AsyncBugzillaClient(client=bz, dispatcher=dispatcher)
+        }
+        futures = {}
+        for name, client in clients.iteritems():
+            client_previous = previous.get(name) if previous is not None else None
+            for call_name, future in client.snapshot(client_previous, stream=stream).iteritems():
+                futures[(name, call_name)] = future
+        if allow_partial:
+            results, errors = dispatcher.gather_partial(futures)
+        else:
+            results = dispatcher.gather(futures)
+            errors = {}
+
+    snapshot = {}
+    for name, client in clients.iteritems():
+        client_results = [result for (n, _), result in results.iteritems() if n == name]
+        missing = []
+        for (n, call_name), error in errors.iteritems():
+            if n == name:
+                empty = client.sync.EMPTY_SECTIONS[call_name]
+                logger.error("Unable to fetch %s from %s: %s"
+                             % (", ".join(sorted(empty.keys())), name, scheduler.scrub_secrets(str(error))))
+                client_results.append(empty)
+                missing += empty.keys()
+        sections = parallel.merge(client_results)
+        snapshot[name] = client.sync.assemble_snapshot(sections, now, missing=missing)
+
+    if not stream:
+        try:
+            add_referenced_bugs(snapshot, bz)
+        except requests.RequestException as e:
+            if not allow_partial:
+                raise
+            logger.error("Unable to fetch bugs referenced by cards: %s" % scheduler.scrub_secrets(str(e)))
+            snapshot["bugzilla"]["referenced_bugs"] = {}
+            snapshot["bugzilla"]["meta"]["missing"] = sorted(snapshot["bugzilla"]["meta"].get("missing", []) +
+                                                             ["referenced_bugs"])
+
+    if is_partial(snapshot):
+        logger.warning("Online state is incomplete, missing sections are listed in `meta`")
+    elif online_cache is not None and not stream:
+        online_cache.put(profile, snapshot)
+
+    if stream:
+        defer_referenced_bugs(snapshot, bz, allow_partial=allow_partial)
+
+    return snapshot
+
+
+def is_partial(snapshot):
+    """
+    Check whether parts of a snapshot could not be fetched
+    :param snapshot: dict with snapshot
+    :return: bool
+    """
+    for part in snapshot.itervalues():
+        if part is not None and len(part.get("meta", {}).get("missing", [])) > 0:
+            return True
+    return False
+
+
+def add_referenced_bugs(snapshot, bz):
+    """
+    Fetch bugs that Trello cards reference in their security notes, but that
+    are not part of the Bugzilla search results, for example because they
+    belong to another component. They are added to the Bugzilla part of the
+    snapshot as `referenced_bugs`.
+    :param snapshot: dict with snapshot
+    :param bz: BugzillaClient
+    :return: dict mapping bug IDs to referenced bugs
+    """
+    trello = snapshot["firefox_trello"]
+    security_notes_id = find_security_notes_id(trello["custom_fields"])
+    if security_notes_id is None:
+        return {}
+    bug_ids = set()
+    for card in trello["cards"].itervalues():
+        bug_id = extract_bugzilla_bug(card, security_notes_id)
+        if bug_id is not None and bug_id not in snapshot["bugzilla"]["bugs"]:
+            bug_ids.add(bug_id)
+    logger.debug("Fetching %d bugs referenced by cards, but not among bug list" % len(bug_ids))
+    referenced_bugs = bz.get_bugs_by_id(bug_ids) if len(bug_ids) > 0 else {}
+    snapshot["bugzilla"]["referenced_bugs"] = referenced_bugs
+    return referenced_bugs
+
+
+def defer_referenced_bugs(snapshot, bz, allow_partial=False):
+    """
+    Streaming counterpart of add_referenced_bugs(). Bug IDs are collected
+    from streamed cards and bugs while the snapshot is written, and the
+    referenced bugs are fetched once both were consumed, see
+    objectstore.Deferred. The Bugzilla meta data is deferred as well, so
+    it can still list `referenced_bugs` as missing.
+    :param snapshot: dict with streamed snapshot
+    :param bz: BugzillaClient
+    :param allow_partial: bool whether to leave referenced bugs empty if they can not be fetched
+    :return: None
+    """
+    trello = snapshot["firefox_trello"]
+    bugzilla = snapshot["bugzilla"]
+    security_notes_id = find_security_notes_id(trello["custom_fields"])
+    if security_notes_id is None:
+        return
+    referenced = set()
+    listed = set()
+
+    def watch_cards(cards):
+        for card_id, card in cards:
+            bug_id = extract_bugzilla_bug(card, security_notes_id)
+            if bug_id is not None:
+                referenced.add(bug_id)
+            yield card_id, card
+
+    def watch_bugs(bugs):
+        for bug_id, bug in bugs:
+            listed.add(str(bug_id))
+            yield bug_id, bug
+
+    def fetch():
+        bug_ids = referenced - listed
+        logger.debug("Fetching %d bugs referenced by cards, but not among bug list" % len(bug_ids))
+        try:
+            return bz.get_bugs_by_id(bug_ids) if len(bug_ids) > 0 else {}
+        except requests.RequestException as e:
+            if not allow_partial:
+                raise
+            logger.error("Unable to fetch bugs referenced by cards: %s" % scheduler.scrub_secrets(str(e)))
+            meta["missing"] = sorted(meta.get("missing", []) + ["referenced_bugs"])
+            return {}
+
+    cards = trello["cards"]
+    trello["cards"] = watch_cards(cards if isinstance(cards, types.GeneratorType) else cards.iteritems())
+    bugs = bugzilla["bugs"]
+    bugzilla["bugs"] = watch_bugs(bugs if isinstance(bugs, types.GeneratorType) else bugs.iteritems())
+    meta = bugzilla["meta"]
+    bugzilla["meta"] = objectstore.Deferred(lambda: meta)
+    bugzilla["referenced_bugs"] = objectstore.Deferred(fetch)
+
+
+def get(args, snapshot_db, tag_db, ref, profile=None, sections=None, ids=None, use_cache=False):
+    """
+    Retrieve snapshot state referenced by `ref`, or parts of it, see select().
+    Snapshots in `indexed` storage only read the requested parts.
+    The projection profile and use_cache only apply to online state, see
+    fetch_online().
+    """
     handle = match(snapshot_db, tag_db, ref)
     if handle is None:
         return None, None
 
     if handle == "online":
-        trello_token = read_token(args.workdir, token_type="trello")
-        if trello_token is None:
-            logger.critical("No Trello access token configured. Use `setup` command first")
-            raise Exception("Unable to continue without token")
-        tr = FirefoxTrello(user_token=trello_token)
-
-        bz_token = read_token(args.workdir, token_type="bugzilla")
-        if bz_token is None:
-            logger.critical("No Bugzilla access token configured. Use `setup` command first")
-            raise Exception("Unable to continue without token")
-        bz = BugzillaClient(token=bz_token)
+        return handle, select(fetch_online(args, profile=profile, use_cache=use_cache), sections, ids)
 
-        snapshot = {"firefox_trello": tr.get_snapshot(), "bugzilla": bz.get_snapshot()}
-
-        return handle, snapshot
+    elif snapshot_db.catalogue.storage(handle) == "indexed":
+        return handle, snapshot_db.load(handle, sections=sections, ids=ids)
 
     else:
-        snapshot = json.loads(snapshot_db.read(handle))
+        snapshot = snapshot_db.load(handle)
         if "bugzilla" not in snapshot:
             # Old-style snapshot without bugzilla data
             snapshot = {"firefox_trello": snapshot, "bugzilla": None}
-        return handle, snapshot
+        return handle, select(snapshot, sections, ids)
+
+
+def incremental_base(snapshot_db, full_interval, profile=None):
+    """
+    Find the latest snapshot suitable as base for an incremental pull
+    :param snapshot_db: SnapshotDB
+    :param full_interval: float with maximum seconds since the last full pull
+    :param profile: str with field projection profile of the new pull
+    :return: dict with snapshot or None if a full pull is due
+    """
+    if profile is None:
+        profile = profiles.DEFAULT_PROFILE
+    latest = snapshot_db.latest()
+    if latest is None:
+        return None
+    snapshot = snapshot_db.load(latest)
+    if "bugzilla" not in snapshot:
+        logger.debug("Latest snapshot is old-style, full pull required")
+        return None
+    if is_partial(snapshot):
+        logger.debug("Latest snapshot is incomplete, full pull required")
+        return None
+    meta = snapshot["firefox_trello"]["meta"]
+    if meta.get("profile", profiles.DEFAULT_PROFILE) != profile:
+        logger.debug("Latest snapshot was pulled with a different profile, full pull required")
+        return None
+    full_time = meta.get("full_snapshot_time")
+    if full_time is None or time.time() - full_time > full_interval:
+        logger.debug("Last full pull is too old, full pull required")
+        return None
+    logger.debug("Pulling incrementally from snapshot `%s`" % latest)
+    return snapshot
+
+
+def iter_json(data, depth=2):
+    """
+    Encode snapshot data as JSON piece by piece. Generators of (key, value)
+    pairs are encoded as objects while they are consumed. Dicts are encoded
+    like json.dumps(sort_keys=True) does, except that items holding deferred
+    values come last, see objectstore.ordered_items().
+    :param data: object to encode
+    :param depth: int levels of dicts to descend into looking for generators
+    :return: generator of str
+    """
+    if isinstance(data, types.GeneratorType):
+        yield "{"
+        first = True
+        for key, value in data:
+            if not first:
+                yield ", "
+            first = False
+            yield "%s: %s" % (json.dumps(key), json.dumps(value, sort_keys=True))
+        yield "}"
+    elif isinstance(data, dict) and depth > 0:
+        yield "{"
+        first = True
+        for key, value in objectstore.ordered_items(data, depth - 1):
+            if not first:
+                yield ", "
+            first = False
+            yield "%s: " % json.dumps(key)
+            for chunk in iter_json(value, depth - 1):
+                yield chunk
+        yield "}"
+    else:
+        yield json.dumps(data, sort_keys=True)
+
+
+def materialize(data, depth=2):
+    """
+    Turn generators in streamed snapshot data into dicts
+    :param data: snapshot data
+    :param depth: int levels of dicts to descend into looking for generators
+    :return: snapshot data without generators
+    """
+    if isinstance(data, types.GeneratorType):
+        return dict(data)
+    elif isinstance(data, dict) and depth > 0:
+        return dict([(key, materialize(value, depth - 1))
+                     for key, value in objectstore.ordered_items(data, depth - 1)])
+    else:
+        return data
+
+
+def select(data, sections=None, ids=None):
+    """
+    Select parts of snapshot data. Sections that do not exist are left out.
+    :param data: dict with snapshot data
+    :param sections: list of str with section paths like `firefox_trello.cards`, or None for all
+    :param ids: list of str with IDs of objects to keep in collections, or None for all
+    :return: dict with selected snapshot data
+    """
+    if sections is not None:
+        result = {}
+        for path in sections:
+            keys = path.split(".")
+            source = data
+            for key in keys:
+                source = source.get(key) if isinstance(source, dict) else None
+            if source is None:
+                continue
+            target = result
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = source
+        data = result
+    if ids is not None:
+        data = select_ids(data, set(ids))
+    return data
+
+
+def select_ids(data, ids, depth=2):
+    """
+    :param data: snapshot data
+    :param ids: set of str with IDs of objects to keep in collections
+    :param depth: int levels of dicts to descend into looking for collections
+    :return: snapshot data
+    """
+    if objectstore.is_collection(data) and depth == 0:
+        return dict(filter(lambda x: x[0] in ids, data.iteritems()))
+    elif isinstance(data, dict) and depth > 0:
+        return dict([(key, select_ids(value, ids, depth - 1)) for key, value in data.iteritems()])
+    else:
+        return data
+
+
+def has_id(data, object_id):
+    """
+    Check whether any collection of snapshot data contains an object
+    :param data: dict with snapshot data
+    :param object_id: str with ID
+    :return: bool
+    """
+    for part in data.itervalues():
+        if isinstance(part, dict):
+            for section in part.itervalues():
+                if isinstance(section, dict) and object_id in section:
+                    return True
+    return False
+
+
+def training_samples(data, depth=2):
+    """
+    Pieces of snapshot data for training compression dictionaries, one per
+    card, bug or other object in collections and one per other section
+    :param data: dict with snapshot data
+    :param depth: int levels of dicts to descend into
+    :return: list of str with JSON
+    """
+    if objectstore.is_collection(data) and depth == 0:
+        return [json.dumps(value, sort_keys=True) for value in data.itervalues()]
+    elif isinstance(data, dict) and depth > 0:
+        samples = []
+        for value in data.itervalues():
+            samples += training_samples(value, depth - 1)
+        return samples
+    else:
+        return [json.dumps(data, sort_keys=True)]
 
 
-def store(snapshot_db, data, handle=None):
-    """Store snapshot data in snapshot db"""
+def store(snapshot_db, data, handle=None, storage=None, keyframe_interval=None):
+    """Store snapshot data in snapshot db. The data may contain streamed sections."""
     if handle is None:
         handle = datetime.datetime.utcnow().strftime("%Y-%m-%dZ%H-%M-%S")
-    data_str = json.dumps(data, sort_keys=True)
     logger.info("Writing snapshot `%s`" % handle)
-    snapshot_db.write(handle, data_str)
+    snapshot_db.save(handle, data, storage=storage, keyframe_interval=keyframe_interval)
 
 
 def json_highlight_print(json_data):
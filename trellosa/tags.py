@@ -25,6 +25,10 @@ class TagsDB(object):
                 self.tags = json.load(f)
         except IOError:
             self.tags = dict()
+        # Reverse map of handles to their tags
+        self.handle_tags = dict()
+        for tag, handle in self.tags.iteritems():
+            self.handle_tags.setdefault(handle, set()).add(tag)
 
     @staticmethod
     def is_valid_tag(tag):
@@ -47,11 +51,7 @@ class TagsDB(object):
         :param handle: str with handle
         :return: list of str with tags
         """
-        tags = []
-        for tag in self.tags:
-            if self.tags[tag] == handle:
-                tags.append(tag)
-        return tags
+        return sorted(self.handle_tags.get(handle, []))
 
     def exists(self, tag):
         """
@@ -75,6 +75,7 @@ class TagsDB(object):
         :return: None
         """
         if tag in self.tags:
+            self.handle_tags[self.tags[tag]].discard(tag)
             del self.tags[tag]
         else:
             logger.warning("Tag `%s` does not exist")
@@ -88,7 +89,10 @@ class TagsDB(object):
         :param handle: str with handle
         :return: None
         """
+        if tag in self.tags:
+            self.handle_tags[self.tags[tag]].discard(tag)
         self.tags[tag] = handle
+        self.handle_tags.setdefault(handle, set()).add(tag)
         if save:
             self.save()
 
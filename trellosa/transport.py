@@ -0,0 +1,222 @@
+# -*- coding: utf8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Transport adapters for recording API sessions to disk and replaying them
+# later without network access, for reproducible benchmarks.
+
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+import threading
+import urllib
+import urlparse
+
+
+logger = logging.getLogger(__name__)
+
+# Query parameters with credentials, which are never written to disk
+SECRET_PARAMS = ["api_key", "key", "token"]
+
+# Headers that do not apply to recorded bodies, which are stored decoded
+DROPPED_HEADERS = ["content-encoding", "content-length", "transfer-encoding", "connection", "set-cookie"]
+
+
+def strip_secrets(url):
+    """
+    Remove credentials from the query of an URL and sort its parameters
+    :param url: str
+    :return: str
+    """
+    parts = urlparse.urlsplit(url)
+    query = urlparse.parse_qsl(parts.query, keep_blank_values=True)
+    query = sorted(filter(lambda x: x[0] not in SECRET_PARAMS, query))
+    return urlparse.urlunsplit((parts.scheme, parts.netloc, parts.path, urllib.urlencode(query), ""))
+
+
+def request_key(request):
+    """
+    Key identifying a request in a cassette. Requests are matched by method,
+    URL without credentials and body.
+    :param request: requests.PreparedRequest
+    :return: str
+    """
+    body = request.body or ""
+    if isinstance(body, unicode):
+        body = body.encode("utf-8")
+    if request.headers.get("Content-Type") == "application/x-www-form-urlencoded":
+        # Trello takes credentials as form data in POST requests
+        body = urllib.urlencode(sorted(filter(lambda x: x[0] not in SECRET_PARAMS,
+                                              urlparse.parse_qsl(body, keep_blank_values=True))))
+    key = "%s %s %s" % (request.method, strip_secrets(request.url), hashlib.sha1(body).hexdigest())
+    return hashlib.sha1(key).hexdigest()
+
+
+def build_response(request, recorded):
+    """
+    Turn a recorded response into a requests.Response. The body can be
+    read as stream as well as at once.
+    :param request: requests.PreparedRequest
+    :param recorded: dict with recorded response
+    :return: requests.Response
+    """
+    if recorded.get("encoding") == "base64":
+        body = base64.b64decode(recorded["body"])
+    else:
+        body = recorded["body"].encode("utf-8")
+    response = requests.Response()
+    response.status_code = recorded["status_code"]
+    response.reason = recorded.get("reason")
+    response.headers = CaseInsensitiveDict(recorded["headers"])
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response.raw = io.BytesIO(body)
+    response.url = request.url
+    response.request = request
+    return response
+
+
+class Cassette(object):
+    """
+    Directory of recorded request/response pairs, one file per distinct
+    request. Repeated requests have their responses stored in order and
+    are replayed in the same order, with the last one repeating.
+    """
+
+    def __init__(self, cassette_dir):
+        self.cassette_dir = cassette_dir
+        self.lock = threading.Lock()
+        self.replayed = {}
+        if not os.path.isdir(cassette_dir):
+            os.makedirs(cassette_dir)
+
+    def key_to_file_name(self, key):
+        return os.path.join(self.cassette_dir, "%s.json" % key)
+
+    def load(self, key):
+        file_name = self.key_to_file_name(key)
+        if not os.path.isfile(file_name):
+            return None
+        with open(file_name) as f:
+            return json.load(f)
+
+    def record(self, request, response, body):
+        """
+        Append a response to the recording of a request
+        :param request: requests.PreparedRequest
+        :param response: requests.Response
+        :param body: str with decoded response body
+        :return: dict with recorded response
+        """
+        try:
+            recorded_body = body.decode("utf-8")
+            encoding = "utf-8"
+        except UnicodeDecodeError:
+            recorded_body = base64.b64encode(body)
+            encoding = "base64"
+        headers = dict(filter(lambda x: x[0].lower() not in DROPPED_HEADERS, response.headers.items()))
+        recorded = {
+            "status_code": response.status_code,
+            "reason": response.reason,
+            "headers": headers,
+            "body": recorded_body,
+            "encoding": encoding
+        }
+        key = request_key(request)
+        with self.lock:
+            entry = self.load(key)
+            if entry is None:
+                entry = {"method": request.method, "url": strip_secrets(request.url), "responses": []}
+            entry["responses"].append(recorded)
+            with open(self.key_to_file_name(key), "w") as f:
+                json.dump(entry, f, indent=1, sort_keys=True)
+        return recorded
+
+    def replay(self, request):
+        """
+        Return the next recorded response for a request
+        :param request: requests.PreparedRequest
+        :return: dict with recorded response or None
+        """
+        key = request_key(request)
+        with self.lock:
+            entry = self.load(key)
+            if entry is None:
+                return None
+            index = self.replayed.get(key, 0)
+            self.replayed[key] = index + 1
+        responses = entry["responses"]
+        return responses[min(index, len(responses) - 1)]
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    Sends requests to the network and records them with their responses
+    """
+
+    def __init__(self, cassette, **kwargs):
+        self.cassette = cassette
+        super(RecordingAdapter, self).__init__(**kwargs)
+
+    def send(self, request, stream=False, **kwargs):
+        response = super(RecordingAdapter, self).send(request, stream=False, **kwargs)
+        body = response.content
+        logger.debug("Recording %s %s" % (request.method, strip_secrets(request.url)))
+        recorded = self.cassette.record(request, response, body)
+        replayed = build_response(request, recorded)
+        replayed.connection = self
+        return replayed
+
+
+class CassetteMiss(requests.RequestException):
+    """
+    Raised when a replayed request was not recorded. Retrying can not help,
+    so it is neither retried nor counted as upstream failure.
+    """
+    pass
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Answers requests from recordings without network access
+    """
+
+    def __init__(self, cassette):
+        super(ReplayAdapter, self).__init__()
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        recorded = self.cassette.replay(request)
+        if recorded is None:
+            raise CassetteMiss("No recorded response for %s %s"
+                               % (request.method, strip_secrets(request.url)), request=request)
+        response = build_response(request, recorded)
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+__cassettes = {}
+__lock = threading.Lock()
+
+
+def get_cassette(cassette_dir):
+    """
+    Return the process-wide cassette for a directory
+    :param cassette_dir: str with path
+    :return: Cassette
+    """
+    cassette_dir = os.path.abspath(cassette_dir)
+    with __lock:
+        if cassette_dir not in __cassettes:
+            __cassettes[cassette_dir] = Cassette(cassette_dir)
+        return __cassettes[cassette_dir]
@@ -4,11 +4,19 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import datetime
 import logging
 import re
-import requests
 from requests.exceptions import HTTPError
 import time
+import urllib
+
+import trellosa.cache as cache
+import trellosa.jsonstream as jsonstream
+import trellosa.parallel as parallel
+import trellosa.profiles as profiles
+import trellosa.scheduler as scheduler
+import trellosa.session as session
 
 
 logger = logging.getLogger(__name__)
@@ -43,6 +51,18 @@ def extract_security_info(card, security_notes_id):
     return None
 
 
+def find_security_notes_id(custom_fields):
+    """
+    Find the ID of the `Security Notes` custom field
+    :param custom_fields: dict with custom field definitions
+    :return: str with field ID or None
+    """
+    for field in custom_fields.itervalues():
+        if field["name"].lower() == "Security Notes".lower():
+            return field["id"]
+    return None
+
+
 def extract_bugzilla_bug(card, security_notes_id):
     sec_info = extract_security_info(card, security_notes_id)
     if sec_info is None:
@@ -94,15 +114,78 @@ def security_label_should_be(bug, security_action_required_label, security_ok_la
         return security_action_required_label
 
 
+def trello_time(timestamp):
+    """
+    Convert epoch timestamp to the date format used by the Trello API
+    :param timestamp: float
+    :return: str
+    """
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def batch_url(method, **params):
+    """
+    Build a route for use in Trello batch requests. Commas must be escaped,
+    because the batch API uses them to separate routes.
+    :param method: str with API method
+    :param params: query parameters
+    :return: str with route
+    """
+    route = "/" + method.lstrip("/")
+    if len(params) > 0:
+        route += "?" + urllib.urlencode(sorted(params.items()))
+    return route.replace(",", "%2C")
+
+
+class BatchError(HTTPError):
+    """
+    Raised when routes of a batch request fail. `errors` maps failed
+    routes to their error responses, `results` holds the successful ones.
+    """
+
+    def __init__(self, errors, results):
+        message = "%d of %d batch requests failed: %s" \
+                  % (len(errors), len(errors) + len(results), ", ".join(sorted(errors.keys())))
+        super(BatchError, self).__init__(message)
+        self.errors = errors
+        self.results = results
+
+
+def batch_status(error):
+    """
+    HTTP status of a failed batch route
+    :param error: dict with error response, see TrelloClient.batch_get()
+    :return: int with status code or None if unknown
+    """
+    if "statusCode" in error:
+        return error["statusCode"]
+    for key in error.iterkeys():
+        if key.isdigit():
+            return int(key)
+    return None
+
+
 class TrelloClient(object):
 
     BASE_URL = "https://trello.com/1"
     TRELLO_APP_KEY = "fee6885be0783a3f421d5998840da9cb"
 
-    def __init__(self, app_key=TRELLO_APP_KEY, user_token=None, base_url=BASE_URL):
+    def __init__(self, app_key=TRELLO_APP_KEY, user_token=None, base_url=None, http_session=None,
+                 request_scheduler=None, metadata_cache=None):
         self.app_key = app_key
         self.user_token = user_token
+        if base_url is None:
+            base_url = session.base_url("trello", self.BASE_URL)
         self.base_url = base_url
+        if http_session is None:
+            http_session = session.get_session("trello")
+        self.session = http_session
+        if request_scheduler is None:
+            request_scheduler = scheduler.get_scheduler("trello")
+        self.scheduler = request_scheduler
+        if metadata_cache is None:
+            metadata_cache = cache.get_metadata_cache()
+        self.metadata_cache = metadata_cache
 
     def generate_token_url(self, expiration="never", scope="read,write"):
         return generate_token_url(self.TRELLO_APP_KEY, expiration=expiration, scope=scope)
@@ -128,18 +211,114 @@ class TrelloClient(object):
     def set_token(self, user_token):
         self.user_token = user_token
 
+    def send(self, http_method, method, **kwargs):
+        """
+        Make a rate-limited request through the shared keep-alive session and return the response.
+        """
+        url = "{}/{}".format(self.base_url, method.lstrip("/"))
+        kwargs.setdefault("timeout", session.default_timeout())
+        return self.scheduler.send(self.session, http_method, url, **kwargs)
+
+    def request(self, http_method, method, **kwargs):
+        """
+        Make a rate-limited request through the shared keep-alive session and return parsed JSON result.
+        """
+        r = self.send(http_method, method, **kwargs)
+        r.raise_for_status()
+        return r.json()
+
+    @staticmethod
+    def cache_key(route):
+        return "trello:%s" % route
+
+    def cache_lookup(self, route, ttl=None):
+        """
+        Return cached result for a route if it is fresh enough
+        :param route: str with route as built by batch_url()
+        :param ttl: float with maximum age in seconds, default from cache settings
+        :return: cached result or None
+        """
+        if self.metadata_cache is None:
+            return None
+        if ttl is None:
+            ttl = cache.metadata_ttl()
+        entry = self.metadata_cache.get(self.cache_key(route))
+        if self.metadata_cache.is_fresh(entry, ttl):
+            logger.debug("Using cached result for `%s`" % route)
+            return entry["data"]
+        return None
+
+    def cache_store(self, route, data, response=None):
+        if self.metadata_cache is None:
+            return
+        etag = last_modified = None
+        if response is not None:
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+        self.metadata_cache.put(self.cache_key(route), data, etag, last_modified)
+
+    def cached_get(self, method, ttl=None, **kwargs):
+        """
+        Make an authenticated GET request through the metadata cache.
+
+        Fresh entries are returned without asking Trello. Expired entries are
+        revalidated with a conditional request if Trello sent validators.
+        """
+        if self.metadata_cache is None:
+            return self.get(method, **kwargs)
+        if ttl is None:
+            ttl = cache.metadata_ttl()
+        route = batch_url(method, **kwargs)
+        key = self.cache_key(route)
+        entry = self.metadata_cache.get(key)
+        if self.metadata_cache.is_fresh(entry, ttl):
+            logger.debug("Using cached result for `%s`" % route)
+            return entry["data"]
+
+        headers = {}
+        if entry is not None:
+            if entry["etag"] is not None:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"] is not None:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        params = kwargs
+        params.update({"key": self.app_key, "token": self.user_token})
+        r = self.send("GET", method, params=params, headers=headers)
+        if r.status_code == 304 and entry is not None:
+            logger.debug("Cached result for `%s` is still valid" % route)
+            self.metadata_cache.touch(key)
+            return entry["data"]
+        r.raise_for_status()
+        result = r.json()
+        self.cache_store(route, result, r)
+        return result
+
     def get(self, method, **kwargs):
         """
         Make an authenticated GET request and return parsed JSON result.
 
         Generally used for retrieving Trello objects.
         """
-        url = "{}/{}".format(self.BASE_URL, method.lstrip("/"))
         params = kwargs
         params.update({"key": self.app_key, "token": self.user_token})
-        r = requests.get(url, params=params)
-        r.raise_for_status()
-        return r.json()
+        return self.request("GET", method, params=params)
+
+    def iter_get(self, method, **kwargs):
+        """
+        Make an authenticated GET request for a JSON array and decode its
+        items while the response is still arriving.
+
+        Used for large results like all cards of a board.
+        """
+        params = kwargs
+        params.update({"key": self.app_key, "token": self.user_token})
+        r = self.send("GET", method, params=params, stream=True)
+        try:
+            r.raise_for_status()
+            for item in jsonstream.iter_items(r.iter_content(chunk_size=jsonstream.CHUNK_SIZE)):
+                yield item
+        finally:
+            r.close()
 
     def post(self, method, json=None, **kwargs):
         """
@@ -147,12 +326,9 @@ class TrelloClient(object):
 
         Generally used for creating Trello objects.
         """
-        url = "{}/{}".format(self.BASE_URL, method.lstrip("/"))
         data = kwargs
         data.update({"key": self.app_key, "token": self.user_token})
-        r = requests.post(url, json=json, data=data)
-        r.raise_for_status()
-        return r.json()
+        return self.request("POST", method, json=json, data=data)
 
     def put(self, method, json=None, **kwargs):
         """
@@ -160,12 +336,9 @@ class TrelloClient(object):
 
         Generally used for updating Trello objects.
         """
-        url = "{}/{}".format(self.BASE_URL, method.lstrip("/"))
         params = kwargs
         params.update({"key": self.app_key, "token": self.user_token})
-        r = requests.put(url, json=json, params=params)
-        r.raise_for_status()
-        return r.json()
+        return self.request("PUT", method, json=json, params=params)
 
     def delete(self, method, **kwargs):
         """
@@ -173,21 +346,45 @@ class TrelloClient(object):
 
         Generally used for deleting Trello objects.
         """
-        url = "{}/{}".format(self.BASE_URL, method.lstrip("/"))
         params = kwargs
         params.update({"key": self.app_key, "token": self.user_token})
-        r = requests.delete(url, params=params)
-        r.raise_for_status()
-        return r.json()
+        return self.request("DELETE", method, params=params)
+
+    def batch_get(self, methods, raise_errors=True):
+        """
+        Make authenticated GET requests through the batch API.
+
+        Routes are passed on as they are, so query parameters must already be
+        part of them, see batch_url(). Failed routes raise a BatchError, or are
+        logged and left out of the result if raise_errors is False.
 
-    def batch_get(self, methods):
+        :param methods: iterable of str with API routes
+        :param raise_errors: bool
+        :return: dict mapping routes to parsed JSON results
+        """
         methods = list(methods)  # Ensuring that we're not touching the parameter object
-        results = []
+        results = {}
+        errors = {}
         while len(methods) > 0:
             # Trello batches are limited to 10 requests which must be prefixed with a /
-            urls = ",".join(["/" + method if not method.startswith("/") else method for method in methods[:10]])
-            results.append(self.get("/batch/", urls=urls))
+            chunk = methods[:10]
+            urls = ",".join(["/" + method if not method.startswith("/") else method for method in chunk])
+            responses = self.get("/batch/", urls=urls)
+            for method, response in zip(chunk, responses):
+                # Responses are either {"200": result} or error objects like
+                # {"name": ..., "message": ..., "statusCode": 404}
+                if "200" in response:
+                    results[method] = response["200"]
+                else:
+                    errors[method] = response
             methods = methods[min(len(methods), 10):]
+
+        if len(errors) > 0:
+            if raise_errors:
+                raise BatchError(errors, results)
+            for method, error in errors.iteritems():
+                logger.warning("Batch request for `%s` failed: %s" % (method, error))
+
         return results
 
 
@@ -195,9 +392,15 @@ class FirefoxTrello(TrelloClient):
 
     FIREFOX_BOARD_ID = "5887b9767bc90fd832e669f8"
 
-    def __init__(self, user_token=None, board_id=FIREFOX_BOARD_ID):
+    # Stand-ins for the results of snapshot calls that failed, see assemble_snapshot()
+    EMPTY_SECTIONS = {
+        "sections": {"board": None, "labels": {}, "lists": {}, "cards": {}, "custom_fields": {}}
+    }
+
+    def __init__(self, user_token=None, board_id=FIREFOX_BOARD_ID, profile=profiles.DEFAULT_PROFILE):
         super(FirefoxTrello, self).__init__(user_token=user_token)
         self.board_id = board_id
+        self.profile = profile
         self.board = None
         self.labels = None
         self.__custom_fields = None
@@ -211,48 +414,272 @@ class FirefoxTrello(TrelloClient):
 
     def get_labels(self, caching=True):
         if self.labels is None or not caching:
-            result = self.get("/boards/{}/labels".format(self.board_id))
-            self.labels = dict(map(lambda x: (x["id"], x), result))
+            self.get_metadata(refresh=not caching)
         return self.labels
 
+    def get_metadata(self, refresh=False):
+        """
+        Fetch labels and custom field definitions from the metadata cache,
+        or in a single batch request if they are missing or expired
+        :param refresh: bool to bypass the cache
+        :return: None
+        """
+        labels_url = batch_url("/boards/{}/labels".format(self.board_id))
+        custom_fields_url = batch_url("/boards/{}/customFields".format(self.board_id))
+        result = {}
+        if not refresh:
+            for url in [labels_url, custom_fields_url]:
+                cached = self.cache_lookup(url)
+                if cached is not None:
+                    result[url] = cached
+        missing = [url for url in [labels_url, custom_fields_url] if url not in result]
+        if len(missing) > 0:
+            fetched = self.batch_get(missing)
+            for url in missing:
+                self.cache_store(url, fetched[url])
+            result.update(fetched)
+        self.labels = dict(map(lambda x: (x["id"], x), result[labels_url]))
+        self.__custom_fields = dict(map(lambda x: (x["id"], x), result[custom_fields_url]))
+
     @property
     def custom_fields(self):
         if self.__custom_fields is None:
-            result = self.get("/boards/{}/customFields".format(self.board_id))
-            self.__custom_fields = dict(map(lambda x: (x["id"], x), result))
+            self.get_metadata()
         return self.__custom_fields
 
     @property
     def security_notes_id(self):
         if self.__security_notes_id is None:
-            for field in self.custom_fields.itervalues():
-                if field["name"].lower() == "Security Notes".lower():
-                    self.__security_notes_id = field["id"]
-                    break
+            self.__security_notes_id = find_security_notes_id(self.custom_fields)
             if self.__security_notes_id is None:
                 raise Exception("Custom field `Security Notes` is gone, can't live without it")
         return self.__security_notes_id
 
     def get_cards(self):
-        result = self.get("/boards/{}/cards/all".format(self.board_id), customFieldItems="true")
+        result = self.get("/boards/{}/cards/all".format(self.board_id), **profiles.card_params(self.profile))
         return dict(map(lambda x: (x["id"], x), result))
 
+    def iter_cards(self, page_size=1000):
+        """
+        Fetch cards page by page, using card IDs as cursors. Cards are
+        decoded while each page is still downloading.
+        :param page_size: int number of cards per request, 1000 at most
+        :return: generator of cards
+        """
+        params = profiles.card_params(self.profile)
+        params["limit"] = page_size
+        while True:
+            count = 0
+            oldest = None
+            for card in self.iter_get("/boards/{}/cards/all".format(self.board_id), **dict(params)):
+                count += 1
+                if oldest is None or card["id"] < oldest:
+                    oldest = card["id"]
+                yield card
+            if count < page_size:
+                return
+            # Card IDs grow monotonically, so continue with cards older than the oldest seen
+            params["before"] = oldest
+
     def get_card(self, card_id):
         return self.get("/cards/{}".format(card_id), customFieldItems="true")
 
     def get_lists(self):
-        result = self.get("/boards/{}/lists/all".format(self.board_id))
+        # Always revalidated, because lists change with every release cycle
+        result = self.cached_get("/boards/{}/lists/all".format(self.board_id), ttl=0)
         return dict(map(lambda x: (x["id"], x), result))
 
-    def get_snapshot(self):
-        now = time.time()
-        board = self.get_board()
-        labels = self.get_labels()
-        lists = self.get_lists()
-        cards = self.get_cards()
-        meta = {"board": board, "snapshot_time": now}
+    def get_actions(self, since, page_size=1000, max_actions=None):
+        """
+        Fetch all board actions since a given time, newest first
+        :param since: float with epoch timestamp
+        :param page_size: int number of actions per request, 1000 at most
+        :param max_actions: int to stop after that many actions or None
+        :return: list of actions
+        """
+        actions = []
+        params = {"filter": "all", "limit": page_size, "since": trello_time(since)}
+        while True:
+            page = self.get("/boards/{}/actions".format(self.board_id), **dict(params))
+            actions += page
+            if len(page) < page_size or (max_actions is not None and len(actions) >= max_actions):
+                return actions
+            params["before"] = page[-1]["id"]
+
+    @staticmethod
+    def touched_by_actions(actions):
+        """
+        Extract IDs of cards and lists affected by board actions
+        :param actions: list of actions
+        :return: tuple of sets with card IDs and list IDs
+        """
+        card_ids = set()
+        list_ids = set()
+        for action in actions:
+            data = action.get("data", {})
+            if "card" in data and "id" in data["card"]:
+                card_ids.add(data["card"]["id"])
+            for key in ["list", "listBefore", "listAfter"]:
+                if key in data and "id" in data[key]:
+                    list_ids.add(data[key]["id"])
+        return card_ids, list_ids
+
+    def get_incremental_sections(self, previous, max_cards=500):
+        """
+        Update the sections of a previous snapshot by replaying board actions.
+        Only the cards and lists touched since the previous snapshot are fetched
+        again, along with board, labels and custom fields. Falls back to a full
+        fetch when too many cards were touched, when there were too many actions
+        to fetch them all, or when fetching touched cards or lists failed.
+        :param previous: dict with previous Trello snapshot
+        :param max_cards: int maximum number of touched cards
+        :return: dict mapping section names to results
+        """
+        prev_meta = previous["meta"]
+        max_actions = max_cards * 2
+        # Overlap a little with the previous snapshot to be safe from clock skew
+        actions = self.get_actions(prev_meta["snapshot_time"] - 60, max_actions=max_actions)
+        if len(actions) >= max_actions:
+            # Older actions were cut off, so their changes would be missed
+            logger.info("Too many actions on the board for incremental pull, doing full pull instead")
+            return self.get_sections()
+        card_ids, list_ids = self.touched_by_actions(actions)
+        logger.debug("%d board actions touched %d cards and %d lists"
+                     % (len(actions), len(card_ids), len(list_ids)))
+        if len(card_ids) > max_cards:
+            logger.info("Too many changes on the board for incremental pull, doing full pull instead")
+            return self.get_sections()
+
+        urls = {
+            "board": batch_url("/boards/{}".format(self.board_id)),
+            "labels": batch_url("/boards/{}/labels".format(self.board_id)),
+            "custom_fields": batch_url("/boards/{}/customFields".format(self.board_id))
+        }
+        card_params = profiles.card_params(self.profile)
+        card_urls = dict([(batch_url("/cards/{}".format(cid), **card_params), cid) for cid in card_ids])
+        list_urls = dict([(batch_url("/lists/{}".format(lid)), lid) for lid in list_ids])
+        try:
+            result = self.batch_get(urls.values() + card_urls.keys() + list_urls.keys())
+            deleted = set()
+        except BatchError as e:
+            # Cards that were deleted are gone for good, but any other error may be
+            # temporary and must not drop cards or lists from the snapshot
+            failed = [url for url, error in e.errors.iteritems()
+                      if batch_status(error) != 404 or url in urls.values()]
+            if len(failed) > 0:
+                logger.warning("Unable to fetch %d sections, cards or lists for incremental pull, "
+                               "doing full pull instead" % len(failed))
+                return self.get_sections()
+            result = e.results
+            deleted = set(e.errors.keys())
+
+        self.board = result[urls["board"]]
+        self.labels = dict(map(lambda x: (x["id"], x), result[urls["labels"]]))
+        self.__custom_fields = dict(map(lambda x: (x["id"], x), result[urls["custom_fields"]]))
+        self.cache_store(urls["labels"], result[urls["labels"]])
+        self.cache_store(urls["custom_fields"], result[urls["custom_fields"]])
+
+        lists = dict(previous["lists"])
+        for url, lid in list_urls.iteritems():
+            if url in result:
+                lists[lid] = result[url]
+
+        cards = dict(previous["cards"])
+        for url, cid in card_urls.iteritems():
+            if url in result and result[url]["idBoard"] == self.board_id:
+                cards[cid] = result[url]
+            elif (url in deleted or url in result) and cid in cards:
+                # Deleted or moved to another board
+                logger.debug("Removing card %s from snapshot" % cid)
+                del cards[cid]
+
+        return {
+            "board": self.board,
+            "labels": self.labels,
+            "lists": lists,
+            "cards": cards,
+            "custom_fields": self.__custom_fields,
+            "profile": self.profile,
+            "pull_mode": "incremental",
+            "full_snapshot_time": prev_meta.get("full_snapshot_time", prev_meta["snapshot_time"])
+        }
+
+    def get_sections(self, stream=False):
+        """
+        Fetch all snapshot sections in a single batch request.
+        When streaming, cards are not part of the batch, but returned as
+        generator of (id, card) pairs that fetches them page by page.
+        :param stream: bool
+        :return: dict mapping section names to results
+        """
+        urls = {
+            "board": batch_url("/boards/{}".format(self.board_id)),
+            "labels": batch_url("/boards/{}/labels".format(self.board_id)),
+            "lists": batch_url("/boards/{}/lists/all".format(self.board_id)),
+            "custom_fields": batch_url("/boards/{}/customFields".format(self.board_id))
+        }
+        if not stream:
+            urls["cards"] = batch_url("/boards/{}/cards/all".format(self.board_id),
+                                      **profiles.card_params(self.profile))
+        result = self.batch_get(urls.values())
+
+        if stream:
+            cards = ((card["id"], card) for card in self.iter_cards())
+        else:
+            cards = dict(map(lambda x: (x["id"], x), result[urls["cards"]]))
+
+        self.board = result[urls["board"]]
+        self.labels = dict(map(lambda x: (x["id"], x), result[urls["labels"]]))
+        self.__custom_fields = dict(map(lambda x: (x["id"], x), result[urls["custom_fields"]]))
+        self.cache_store(urls["labels"], result[urls["labels"]])
+        self.cache_store(urls["custom_fields"], result[urls["custom_fields"]])
+        return {
+            "board": self.board,
+            "labels": self.labels,
+            "lists": dict(map(lambda x: (x["id"], x), result[urls["lists"]])),
+            "cards": cards,
+            "custom_fields": self.__custom_fields,
+            "profile": self.profile
+        }
+
+    def snapshot_calls(self, previous=None, stream=False):
+        """
+        Independent API calls required for a snapshot, see assemble_snapshot()
+        :param previous: dict with previous snapshot for incremental pulls or None
+        :param stream: bool whether to return cards as generator, see get_sections()
+        :return: dict mapping call names to callables returning dicts of sections
+        """
+        if previous is None:
+            return {"sections": lambda: self.get_sections(stream=stream)}
+        else:
+            return {"sections": lambda: self.get_incremental_sections(previous)}
 
-        return {"meta": meta, "cards": cards, "lists": lists, "labels": labels, "custom_fields": self.custom_fields}
+    @staticmethod
+    def assemble_snapshot(sections, now, missing=None):
+        """
+        Build snapshot from the merged results of snapshot_calls()
+        :param sections: dict mapping section names to results
+        :param now: float with snapshot time
+        :param missing: list of section names that could not be fetched and are empty, see EMPTY_SECTIONS
+        :return: dict with snapshot
+        """
+        meta = {
+            "board": sections["board"],
+            "snapshot_time": now,
+            "profile": sections.get("profile", profiles.DEFAULT_PROFILE),
+            "pull_mode": sections.get("pull_mode", "full"),
+            "full_snapshot_time": sections.get("full_snapshot_time", now)
+        }
+        if missing:
+            meta["missing"] = sorted(missing)
+        return {"meta": meta, "cards": sections["cards"], "lists": sections["lists"],
+                "labels": sections["labels"], "custom_fields": sections["custom_fields"]}
+
+    def get_snapshot(self, jobs=1, now=None, previous=None):
+        if now is None:
+            now = time.time()
+        sections = parallel.merge(parallel.call_all(self.snapshot_calls(previous), jobs=jobs))
+        return self.assemble_snapshot(sections, now)
 
     def set_custom_field_text(self, card_id, field_id, text):
         data = {"value": {"text": text}}